@@ -0,0 +1,78 @@
+"""
+Command line client for the gitreload admin endpoints
+"""
+import argparse
+import json
+import os
+import sys
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+
+def call(args, path, payload=None):
+    """
+    Call an admin endpoint of the server and return the decoded json
+    response, or the error message for a failed request.
+    """
+    data = None if payload is None else json.dumps(payload).encode('utf-8')
+    request = Request(
+        '{0}{1}'.format(args.url.rstrip('/'), path),
+        data=data,
+        headers={
+            'Authorization': 'Bearer {0}'.format(args.token),
+            'Content-Type': 'application/json',
+        },
+    )
+    try:
+        with urlopen(request, timeout=args.timeout) as response:
+            return json.loads(response.read().decode('utf-8'))
+    except HTTPError as exc:
+        return json.loads(exc.read().decode('utf-8') or '{}')
+
+
+def refresh(args):
+    """
+    Queue an action for every (matching) checkout
+    """
+    return call(args, '/refresh', {'action': args.action, 'pattern': args.pattern})
+
+
+def status(args):
+    """
+    Show the progress of a refresh batch
+    """
+    return call(args, '/refresh/{0}'.format(args.batch_id))
+
+
+def main(argv=None):
+    """
+    Entry point of the ``gitreload-admin`` command
+    """
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--url', default=os.environ.get('GITRELOAD_URL', 'http://localhost:5000'),
+                        help='base URL of the gitreload server')
+    parser.add_argument('--token', default=os.environ.get('ADMIN_TOKEN', ''),
+                        help='admin token, defaults to $ADMIN_TOKEN')
+    parser.add_argument('--timeout', type=int, default=30)
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    refresh_parser = subparsers.add_parser('refresh', help=refresh.__doc__.strip())
+    refresh_parser.add_argument('--action', default='GET_LATEST',
+                                choices=['GET_LATEST', 'COURSE_IMPORT', 'MAINTENANCE'])
+    refresh_parser.add_argument('--pattern', default='*',
+                                help='glob matched against checkout names')
+    refresh_parser.set_defaults(func=refresh)
+
+    status_parser = subparsers.add_parser('status', help=status.__doc__.strip())
+    status_parser.add_argument('batch_id')
+    status_parser.set_defaults(func=status)
+
+    args = parser.parse_args(argv)
+    result = args.func(args)
+    print(json.dumps(result, indent=2, sort_keys=True))
+    return 0 if 'batch_id' in result else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
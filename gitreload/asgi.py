@@ -0,0 +1,183 @@
+"""
+ASGI receiver for the webhooks, serving the same hook, queue and probe
+routes as the Flask application in ``gitreload.web``, for example with::
+
+    uvicorn gitreload.asgi:app
+
+Request bodies are read on the event loop, while the repo checks and
+queueing, which touch the filesystem and the job queue, run in a
+thread pool so slow ones don't hold up other requests.
+"""
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+
+from werkzeug.wrappers import Response
+
+from gitreload import cluster, web
+from gitreload.config import Config, configure_logging
+
+log = logging.getLogger('gitreload')  # pylint: disable=C0103
+
+HOOK_ROUTES = {
+    '/': 'COURSE_IMPORT',
+    '/gitreload': 'COURSE_IMPORT',
+    '/update': 'GET_LATEST',
+}
+
+executor = ThreadPoolExecutor(  # pylint: disable=C0103
+    Config.ASGI_THREADS, thread_name_prefix='gitreload-asgi'
+)
+
+
+class PayloadTooLarge(Exception):
+    """
+    Raised when a request body grows past ``MAX_PAYLOAD_BYTES``
+    """
+
+
+async def read_body(receive):
+    """
+    Read the whole request body, giving up once it is larger than
+    ``MAX_PAYLOAD_BYTES``
+    """
+    chunks = []
+    size = 0
+    more_body = True
+    while more_body:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            break
+        chunk = message.get('body', b'')
+        size += len(chunk)
+        if Config.MAX_PAYLOAD_BYTES and size > Config.MAX_PAYLOAD_BYTES:
+            raise PayloadTooLarge(size)
+        chunks.append(chunk)
+        more_body = message.get('more_body', False)
+    return b''.join(chunks)
+
+
+def request_headers(scope):
+    """
+    Headers of an ASGI request by lowercase name
+    """
+    return {
+        name.decode('latin-1').lower(): value.decode('latin-1')
+        for name, value in scope['headers']
+    }
+
+
+def make_hook(scope, body):
+    """
+    Build the HookRequest of an ASGI request with its body read
+    """
+    headers = request_headers(scope)
+    mimetype = headers.get('content-type', '').split(';')[0].strip().lower()
+    is_json = mimetype == 'application/json' or (
+        mimetype.startswith('application/') and mimetype.endswith('+json')
+    )
+    query = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+    return web.HookRequest(
+        headers.get('x-github-event', ''),
+        len(body),
+        not is_json,
+        bool(query.get('force', [''])[0]),
+        lambda: body,
+        bool(headers.get(cluster.FORWARDED_HEADER.lower())),
+    )
+
+
+def to_response(result):
+    """
+    Turn what the shared handlers return into a Response
+    """
+    if isinstance(result, Response):
+        return result
+    return Response(result, mimetype='text/html')
+
+
+async def send_response(send, response):
+    """
+    Send a Response to the ASGI client
+    """
+    await send({
+        'type': 'http.response.start',
+        'status': response.status_code,
+        'headers': [
+            (name.lower().encode('latin-1'), value.encode('latin-1'))
+            for name, value in response.headers.items()
+        ],
+    })
+    # Streamed responses are sent as they are produced, off the event
+    # loop since producing them may look at the queue
+    loop = asyncio.get_event_loop()
+    chunks = response.iter_encoded()
+    while True:
+        chunk = await loop.run_in_executor(executor, next, chunks, None)
+        if chunk is None:
+            break
+        await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+async def lifespan(receive, send):
+    """
+    Setup logging and start the backend when the server starts up,
+    and acknowledge its shutdown
+    """
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            configure_logging()
+            await asyncio.get_event_loop().run_in_executor(executor, web.get_backend)
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            executor.shutdown(wait=False)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    """
+    ASGI application entry point
+    """
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+    path, method = scope['path'], scope['method']
+    loop = asyncio.get_event_loop()
+
+    if path in HOOK_ROUTES:
+        if method != 'POST':
+            await send_response(send, Response('Method Not Allowed', 405))
+            return
+        try:
+            body = await read_body(receive)
+        except PayloadTooLarge as exc:
+            log.warning('Refusing payload of over %s bytes', exc.args[0])
+            await send_response(
+                send, Response(web.json_dump_msg('Payload too large'), 413)
+            )
+            return
+        result = await loop.run_in_executor(
+            executor, web.receive_hook, HOOK_ROUTES[path], make_hook(scope, body)
+        )
+    elif path == '/queue':
+        if method not in ('GET', 'HEAD'):
+            await send_response(send, Response('Method Not Allowed', 405))
+            return
+        query = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+        result = await loop.run_in_executor(
+            executor, web.queue_response, {name: values[0] for name, values in query.items()},
+            request_headers(scope).get('if-none-match')
+        )
+    elif path == '/healthz':
+        result = await loop.run_in_executor(executor, web.liveness_response)
+    elif path == '/readyz':
+        result = await loop.run_in_executor(executor, web.readiness_response)
+    else:
+        result = Response('Not Found', 404)
+    await send_response(send, to_response(result))
@@ -0,0 +1,131 @@
+"""
+Cluster mode, sharding repos over several gitreload nodes.  Each repo
+is owned by one node of ``CLUSTER_PEERS``, picked with a consistent
+hash ring so adding or removing a node only moves the repos of its
+share of the ring.  Webhooks received for a repo owned by another node
+are forwarded to it.
+"""
+import bisect
+import hashlib
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from urllib.error import HTTPError
+from urllib.parse import urlencode
+from urllib.request import Request, urlopen
+
+from gitreload import config
+
+log = logging.getLogger('gitreload')  # pylint: disable=C0103
+
+FORWARDED_HEADER = 'X-Gitreload-Forwarded'
+
+
+def _hash(key):
+    """
+    Position of ``key`` on the ring
+    """
+    return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:16], 16)
+
+
+class HashRing:
+    """
+    Consistent hash ring placing each peer at ``vnodes`` points
+    """
+
+    def __init__(self, peers, vnodes):
+        """
+        Build the ring of ``peers``
+        """
+        self.peers = tuple(peers)
+        self.vnodes = vnodes
+        points = sorted(
+            (_hash('{0}#{1}'.format(peer, index)), peer)
+            for peer in self.peers for index in range(vnodes)
+        )
+        self._hashes = [point for point, _ in points]
+        self._peers = [peer for _, peer in points]
+
+    def owner(self, key):
+        """
+        Peer owning ``key``, the first one clockwise from it
+        """
+        if not self._peers:
+            return None
+        index = bisect.bisect(self._hashes, _hash(key)) % len(self._hashes)
+        return self._peers[index]
+
+
+_ring = None  # pylint: disable=C0103
+
+
+def ring():
+    """
+    Hash ring of the configured peers, rebuilt when they change
+    """
+    global _ring  # pylint: disable=C0103,W0603
+    peers = tuple(config.Config.CLUSTER_PEERS)
+    if _ring is None or _ring.peers != peers or _ring.vnodes != config.Config.CLUSTER_VNODES:
+        _ring = HashRing(peers, config.Config.CLUSTER_VNODES)
+    return _ring
+
+
+def enabled():
+    """
+    Whether this node is part of a cluster
+    """
+    return bool(config.Config.CLUSTER_PEERS)
+
+
+def owner(repo_name):
+    """
+    Base URL of the node owning ``repo_name``, None when it is this
+    node or there is no cluster
+    """
+    if not enabled():
+        return None
+    peer = ring().owner(repo_name)
+    return None if peer == config.Config.CLUSTER_SELF else peer
+
+
+def forward(peer, path, body, headers):
+    """
+    POST a webhook to ``path`` on ``peer``, marked as forwarded so the
+    peer handles it itself.  Returns the status, headers and body of
+    the peer's response.
+    """
+    request = Request(
+        '{0}{1}'.format(peer.rstrip('/'), path),
+        data=body,
+        headers=dict(headers, **{FORWARDED_HEADER: config.Config.CLUSTER_SELF or 'unknown'}),
+    )
+    try:
+        with urlopen(request, timeout=config.Config.CLUSTER_TIMEOUT) as response:
+            return response.status, dict(response.headers), response.read()
+    except HTTPError as exc:
+        return exc.code, dict(exc.headers), exc.read()
+
+
+def fetch_queue(peer, filters=None):
+    """
+    Local queue contents of ``peer``, limited to the jobs matching
+    ``filters``, or None if it can't be reached
+    """
+    url = '{0}/queue?{1}'.format(peer.rstrip('/'), urlencode(dict(filters or {}, local=1)))
+    try:
+        with urlopen(url, timeout=config.Config.CLUSTER_TIMEOUT) as response:
+            return json.loads(response.read().decode('utf-8'))
+    except (OSError, ValueError):
+        log.warning('Unable to get queue of cluster peer %s', peer)
+        return None
+
+
+def peer_queues(filters=None):
+    """
+    Local queue contents of every other node of the cluster, by node
+    """
+    peers = [peer for peer in config.Config.CLUSTER_PEERS if peer != config.Config.CLUSTER_SELF]
+    if not peers:
+        return {}
+    with ThreadPoolExecutor(len(peers)) as pool:
+        return dict(zip(peers, pool.map(fetch_queue, peers, [filters] * len(peers))))
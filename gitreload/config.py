@@ -1,15 +1,37 @@
 """
 Setup configuration from a json file with defaults
 """
+import json
 import logging
 import os
 import platform
+import tempfile
 from logging.handlers import RotatingFileHandler
 from pathlib import Path
 
 log = logging.getLogger('gitreload')  # pylint: disable=C0103
 
 MINUTE = 60  # seconds
+HOUR = 60 * MINUTE
+
+
+def json_setting(name, default):
+    """
+    Setting given as JSON in the environment variable ``name``, or in
+    the file whose path it holds, ``default`` if it is unset or
+    can't be read
+    """
+    value = os.environ.get(name, '').strip()
+    if not value:
+        return default
+    try:
+        if value[0] not in '{["':
+            with open(value) as setting_file:
+                return json.load(setting_file)
+        return json.loads(value)
+    except (OSError, ValueError) as exc:
+        log.error('Ignoring %s, it is neither valid JSON nor a JSON file: %s', name, exc)
+        return default
 
 
 class Config:
@@ -22,9 +44,11 @@ class Config:
     REVISION_CFG = os.environ.get('REVISION_CFG', '/edx/etc/revisions.yml')
     DJANGO_SETTINGS = os.environ.get('DJANGO_SETTINGS', 'production')
     EDX_PLATFORM = os.environ.get('EDX_PLATFORM', '/edx/app/edxapp/edx-platform')
-    LINKED_REPOS = os.environ.get('LINKED_REPOS', {})
-    ALSO_CLONE_REPOS = os.environ.get('ALSO_CLONE_REPOS', {})
+    LINKED_REPOS = json_setting('LINKED_REPOS', {})
+    ALSO_CLONE_REPOS = json_setting('ALSO_CLONE_REPOS', {})
+    DEPENDENCY_CONCURRENCY = int(os.environ.get('DEPENDENCY_CONCURRENCY', 4))
     NUM_THREADS = int(os.environ.get('NUM_THREADS', 1))
+    EXECUTOR = os.environ.get('EXECUTOR', 'process')
     LOG_LEVEL = os.environ.get('LOG_LEVEL', None)
     HOSTNAME = platform.node().split('.')[0]
     LOG_FORMATTER = ('%(asctime)s %(levelname)s %(process)d [%(name)s] '
@@ -32,6 +56,65 @@ class Config:
                      '{hostname}- %(message)s').format(hostname=HOSTNAME)
     LOG_FILE_PATH = os.environ.get('LOG_FILE_PATH', '')
     SUBPROCESS_TIMEOUT = int(os.environ.get('SUBPROCESS_TIMEOUT_MINUTES', 60)) * MINUTE
+    IMPORT_LEDGER_PATH = os.environ.get('IMPORT_LEDGER_PATH', '')
+    IMPORT_LEDGER_SIZE = int(os.environ.get('IMPORT_LEDGER_SIZE', 1000))
+    DEBOUNCE_SECONDS = int(os.environ.get('DEBOUNCE_SECONDS', 0))
+    DEBOUNCE_OVERRIDES = json_setting('DEBOUNCE_OVERRIDES', {})
+    DEBOUNCE_MAX_DELAY = int(os.environ.get('DEBOUNCE_MAX_DELAY_SECONDS', 5 * MINUTE))
+    MAX_QUEUE_DEPTH = int(os.environ.get('MAX_QUEUE_DEPTH', 0))
+    MAX_REPO_QUEUE_DEPTH = int(os.environ.get('MAX_REPO_QUEUE_DEPTH', 0))
+    QUEUE_RETRY_AFTER = int(os.environ.get('QUEUE_RETRY_AFTER_SECONDS', MINUTE))
+    SCHEDULING_POLICY = os.environ.get('SCHEDULING_POLICY', 'fifo')
+    SJF_AGING = float(os.environ.get('SJF_AGING', 1))
+    SJF_DEFAULT_ESTIMATE = int(os.environ.get('SJF_DEFAULT_ESTIMATE_SECONDS', 5 * MINUTE))
+    DURATIONS_PATH = os.environ.get('DURATIONS_PATH', '')
+    DURATIONS_ALPHA = float(os.environ.get('DURATIONS_ALPHA', 0.3))
+    ADAPTIVE_TIMEOUT_FACTOR = float(os.environ.get('ADAPTIVE_TIMEOUT_FACTOR', 3))
+    ADAPTIVE_TIMEOUT_MIN = int(os.environ.get('ADAPTIVE_TIMEOUT_MIN_MINUTES', 10)) * MINUTE
+    RECONCILE_INTERVAL = int(os.environ.get('RECONCILE_INTERVAL_SECONDS', 0))
+    RECONCILE_CONCURRENCY = int(os.environ.get('RECONCILE_CONCURRENCY', 16))
+    RECONCILE_TIMEOUT = int(os.environ.get('RECONCILE_TIMEOUT_SECONDS', 30))
+    RECONCILE_DEFAULT_ACTION = os.environ.get('RECONCILE_DEFAULT_ACTION', 'GET_LATEST')
+    RECONCILE_ACTIONS = json_setting('RECONCILE_ACTIONS', {})
+    ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN', '')
+    BULK_CONCURRENCY = int(os.environ.get('BULK_CONCURRENCY', 1))
+    MIRROR_DIR = os.environ.get('MIRROR_DIR', '')
+    SPARSE_CHECKOUTS = json_setting('SPARSE_CHECKOUTS', {})
+    RUNTIME_DIR = os.environ.get(
+        'RUNTIME_DIR', os.path.join(tempfile.gettempdir(), 'gitreload')
+    )
+    SSH_CONTROL_PERSIST = int(os.environ.get('SSH_CONTROL_PERSIST_SECONDS', 0))
+    SSH_OPTIONS = os.environ.get('SSH_OPTIONS', '')
+    SUPERSEDE_REPOS = json_setting('SUPERSEDE_REPOS', [])
+    SUPERSEDE_MAX_CANCELS = int(os.environ.get('SUPERSEDE_MAX_CANCELS', 3))
+    SUPERSEDE_GRACE = int(os.environ.get('SUPERSEDE_GRACE_SECONDS', 10))
+    MAX_PAYLOAD_BYTES = int(os.environ.get('MAX_PAYLOAD_BYTES', 25 * 1024 * 1024))
+    JSON_DECODER = os.environ.get('JSON_DECODER', 'auto')
+    CHECKOUT_INDEX_TTL = int(os.environ.get('CHECKOUT_INDEX_TTL_SECONDS', MINUTE))
+    REPO_CACHE_SIZE = int(os.environ.get('REPO_CACHE_SIZE', 16))
+    PREFETCH_CONCURRENCY = int(os.environ.get('PREFETCH_CONCURRENCY', 0))
+    RETRY_MAX_ATTEMPTS = int(os.environ.get('RETRY_MAX_ATTEMPTS', 3))
+    RETRY_BASE_DELAY = int(os.environ.get('RETRY_BASE_DELAY_SECONDS', 30))
+    RETRY_MAX_DELAY = int(os.environ.get('RETRY_MAX_DELAY_SECONDS', 15 * MINUTE))
+    RETRY_POLICIES = json_setting('RETRY_POLICIES', {})
+    RESOURCE_CLASSES = json_setting('RESOURCE_CLASSES', {})
+    JOB_RESOURCE_CLASSES = json_setting('JOB_RESOURCE_CLASSES', {})
+    CGROUP_PARENT = os.environ.get('CGROUP_PARENT', '')
+    LEASE_TTL = int(os.environ.get('LEASE_TTL_SECONDS', 0))
+    HEALTH_INTERVAL = int(os.environ.get('HEALTH_REFRESH_SECONDS', 5))
+    READY_MIN_WORKERS = int(os.environ.get('READY_MIN_WORKERS', 1))
+    READY_MAX_JOB_AGE = int(os.environ.get('READY_MAX_JOB_AGE_SECONDS', 30 * MINUTE))
+    PORT = int(os.environ.get('PORT', 5000))
+    CLUSTER_PEERS = json_setting('CLUSTER_PEERS', [])
+    CLUSTER_SELF = os.environ.get('CLUSTER_SELF', '')
+    CLUSTER_VNODES = int(os.environ.get('CLUSTER_VNODES', 64))
+    CLUSTER_TIMEOUT = int(os.environ.get('CLUSTER_TIMEOUT_SECONDS', 10))
+    ASGI_THREADS = int(os.environ.get('ASGI_THREADS', 16))
+    MAINTENANCE_INTERVAL = int(os.environ.get('MAINTENANCE_INTERVAL_SECONDS', 0))
+    MAINTENANCE_MIN_AGE = int(os.environ.get('MAINTENANCE_MIN_AGE_HOURS', 24)) * HOUR
+    MAINTENANCE_TASKS = os.environ.get(
+        'MAINTENANCE_TASKS', 'commit-graph,loose-objects,incremental-repack'
+    ).split(',')
 
 
 def configure_logging(level_override=None, config=Config):
@@ -67,7 +150,11 @@ def configure_logging(level_override=None, config=Config):
     elif Path('/dev/log').is_file():
         address = '/dev/log'
 
-    if address:
+    # Configuring again, e.g. after forking, mustn't duplicate log lines
+    if address and not any(
+            getattr(handler, 'baseFilename', None) == os.path.abspath(address)
+            for handler in root_logger.handlers
+    ):
         root_logger.addHandler(
             RotatingFileHandler(address, maxBytes=1048576, backupCount=10)
         )
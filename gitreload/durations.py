@@ -0,0 +1,98 @@
+"""
+Rolling history of how long jobs take per repository and action,
+used to schedule short jobs first and to size job timeouts.
+"""
+import json
+import logging
+
+from gitreload import config
+from gitreload.statefile import locked, write_atomic
+
+log = logging.getLogger('gitreload')  # pylint: disable=C0103
+
+
+class DurationHistory:
+    """
+    Exponentially weighted moving average of job durations, persisted
+    as a json object of ``"<repo_name> <ACTION>": seconds`` in a file
+    shared between worker processes.
+    """
+
+    def __init__(self, path, alpha):
+        """
+        Setup history stored at ``path``, weighting each new duration
+        by ``alpha``.
+        """
+        self.path = path
+        self.alpha = alpha
+
+    @classmethod
+    def from_config(cls):
+        """
+        Build the history configured for the application
+        """
+        return cls(config.Config.DURATIONS_PATH, config.Config.DURATIONS_ALPHA)
+
+    @staticmethod
+    def _key(action_call):
+        """
+        History key of an action call
+        """
+        return '{0} {1}'.format(action_call.repo_name, action_call.action_text)
+
+    def _read(self):
+        """
+        Load the stored averages
+        """
+        try:
+            with open(self.path) as history_file:
+                return json.load(history_file)
+        except FileNotFoundError:
+            return {}
+
+    def estimate(self, action_call):
+        """
+        Expected duration in seconds of ``action_call``, or None if it
+        has no history.
+        """
+        if not self.path:
+            return None
+        try:
+            return self._read().get(self._key(action_call))
+        except (OSError, ValueError):
+            log.exception('Unable to read job duration history %s', self.path)
+            return None
+
+    def record(self, action_call, seconds):
+        """
+        Fold the duration of a finished job into its average
+        """
+        if not self.path:
+            return
+        try:
+            with locked(self.path):
+                history = self._read()
+                key = self._key(action_call)
+                previous = history.get(key)
+                if previous is None:
+                    history[key] = seconds
+                else:
+                    history[key] = self.alpha * seconds + (1 - self.alpha) * previous
+                write_atomic(self.path, json.dumps(history, sort_keys=True))
+        except (OSError, ValueError):
+            log.exception('Unable to update job duration history %s', self.path)
+
+    def timeout(self, action_call):
+        """
+        Timeout for the subprocess of ``action_call``: a multiple of
+        its expected duration with a floor, capped by (and defaulting
+        to) the global ``SUBPROCESS_TIMEOUT``.
+        """
+        ceiling = config.Config.SUBPROCESS_TIMEOUT
+        estimate = self.estimate(action_call)
+        if not estimate or not config.Config.ADAPTIVE_TIMEOUT_FACTOR:
+            return ceiling
+        return min(ceiling, max(
+            config.Config.ADAPTIVE_TIMEOUT_MIN,
+            estimate * config.Config.ADAPTIVE_TIMEOUT_FACTOR
+        ))
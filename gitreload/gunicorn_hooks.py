@@ -0,0 +1,17 @@
+"""
+gunicorn server hooks, used with ``-c python:gitreload.gunicorn_hooks``.
+They start the job queue and workers in each gunicorn worker right
+after it is forked, so the application can be preloaded with
+``--preload`` without sharing the backend across forks.
+"""
+from gitreload.config import configure_logging
+from gitreload.web import get_backend
+
+
+def post_fork(server, worker):  # pylint: disable=W0613
+    """
+    Setup logging and start the backend of the freshly forked
+    gunicorn worker
+    """
+    configure_logging()
+    get_backend()
@@ -0,0 +1,128 @@
+"""
+Health of the backend for load balancer probes.  The checks run in a
+background thread every ``HEALTH_REFRESH_SECONDS``, so probes only
+read the last results and never wait on the filesystem or the job
+queue.  With no refresh interval the checks run on each probe.
+"""
+import logging
+import os
+import threading
+import time
+
+from gitreload import config
+from gitreload.processing import ActionCall
+
+log = logging.getLogger('gitreload')  # pylint: disable=C0103
+
+# Results older than this many refresh intervals count as not ready,
+# e.g. when the checks hang on an unresponsive REPODIR mount
+STALE_INTERVALS = 3
+
+
+def check_workers(workers):
+    """
+    Whether enough of the workers are alive
+    """
+    alive = sum(1 for worker in workers if worker.is_alive())
+    return {'ok': alive >= config.Config.READY_MIN_WORKERS, 'alive': alive, 'total': len(workers)}
+
+
+def check_queue(queue):
+    """
+    Whether the job queue can be reached and its oldest webhook job
+    hasn't been waiting too long
+    """
+    try:
+        age = queue.oldest_age(ActionCall.LANES['WEBHOOK'])
+    except Exception as exc:  # pylint: disable=W0703
+        return {'ok': False, 'reachable': False, 'error': str(exc)}
+    max_age = config.Config.READY_MAX_JOB_AGE
+    return {
+        'ok': not max_age or age is None or age <= max_age,
+        'reachable': True,
+        'oldest_job_age': age,
+    }
+
+
+def check_repodir():
+    """
+    Whether ``REPODIR`` is there and usable
+    """
+    path = config.Config.REPODIR
+    return {'ok': os.path.isdir(path) and os.access(path, os.R_OK | os.W_OK | os.X_OK)}
+
+
+def run_checks(backend):
+    """
+    Run the health checks of ``backend``
+    """
+    return {
+        'workers': check_workers(backend.workers),
+        'queue': check_queue(backend.queue),
+        'repodir': check_repodir(),
+    }
+
+
+def check_readiness(backend):
+    """
+    Readiness of ``backend`` checked right away, for when no monitor
+    refreshes the checks in the background
+    """
+    checks = run_checks(backend)
+    return {'ready': all(check['ok'] for check in checks.values()), 'checks': checks}
+
+
+class HealthMonitor(threading.Thread):
+    """
+    Daemon thread refreshing the health checks of a backend
+    """
+
+    def __init__(self, backend, interval):
+        """
+        Setup monitor of ``backend`` checking every ``interval`` seconds
+        """
+        super().__init__(name='gitreload-health')
+        self.daemon = True
+        self.backend = backend
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.results = None
+
+    def run(self):  # pragma: no cover due to threading
+        """
+        Refresh until stopped
+        """
+        while not self.stopped.wait(self.interval):
+            try:
+                self.refresh()
+            except Exception:  # pylint: disable=W0703
+                log.exception('%s refresh failed', self.name)
+
+    def refresh(self):
+        """
+        Run the checks and keep their results
+        """
+        self.results = (time.monotonic(), run_checks(self.backend))
+
+    def readiness(self):
+        """
+        Readiness according to the last results, without checking
+        anything
+        """
+        if self.results is None:
+            return {'ready': False, 'reason': 'not checked yet'}
+        checked, checks = self.results
+        age = time.monotonic() - checked
+        if age > STALE_INTERVALS * self.interval:
+            return {'ready': False, 'reason': 'checks are stale', 'age': age, 'checks': checks}
+        return {
+            'ready': all(check['ok'] for check in checks.values()),
+            'age': age,
+            'checks': checks,
+        }
+
+    def stop(self):
+        """
+        Stop refreshing
+        """
+        self.stopped.set()
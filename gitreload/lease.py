@@ -0,0 +1,219 @@
+"""
+Leases on checkouts, so that gitreload hosts sharing ``REPODIR`` over
+a network filesystem don't run jobs on the same checkout at once.
+
+A lease is a small JSON file in the git directory of the checkout
+naming its holder, the action and SHA it is working on and when it
+expires.  It is created by hard linking a fully written temporary
+file, which atomically fails if the lease exists, also over NFS.  The
+holder renews it while the job runs, so the leases of crashed holders
+expire and are reclaimed by the next host wanting the checkout.
+"""
+import json
+import logging
+import os
+import subprocess
+import tempfile
+import threading
+import time
+from contextlib import contextmanager, suppress
+
+from gitreload import config, metrics
+from gitreload.refs import git_dir
+from gitreload.resources import job_prefix
+from gitreload.statefile import write_atomic
+
+log = logging.getLogger('gitreload')  # pylint: disable=C0103
+
+LEASE_FILE = 'gitreload.lease'
+# Seconds between checks of a lease held by another host
+POLL_INTERVAL = 2
+
+
+def lease_path(repo_dir):
+    """
+    Path of the lease file of the checkout at ``repo_dir``
+    """
+    return os.path.join(git_dir(repo_dir), LEASE_FILE)
+
+
+def holder_id():
+    """
+    Identity of this worker as a lease holder
+    """
+    return '{0}:{1}:{2}'.format(
+        config.Config.HOSTNAME, os.getpid(), threading.get_ident()
+    )
+
+
+def read_lease(path):
+    """
+    Content of the lease at ``path``, or None if there is none
+    """
+    try:
+        with open(path) as lease_file:
+            return json.load(lease_file)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError):
+        # Leases are written whole, so this one is damaged, let it expire
+        log.warning('Unreadable lease %s', path)
+        with suppress(OSError):
+            return {'holder': None, 'expires': os.path.getmtime(path) + config.Config.LEASE_TTL}
+        return None
+
+
+def is_ancestor(repo_dir, sha, newer_sha, action_call):
+    """
+    Whether commit ``sha`` is contained in ``newer_sha``, False when
+    either is unknown to the checkout.  git runs with the resource
+    class of ``action_call``.
+    """
+    return subprocess.run(
+        job_prefix(action_call) + ['git', 'merge-base', '--is-ancestor', sha, newer_sha],
+        cwd=repo_dir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        check=False,
+    ).returncode == 0
+
+
+class Lease:
+    """
+    Lease held, or wanted, by this worker on a checkout for an action
+    """
+
+    def __init__(self, repo_dir, action_call):
+        """
+        Setup lease on ``repo_dir`` for running ``action_call``
+        """
+        self.repo_dir = repo_dir
+        self.path = lease_path(repo_dir)
+        self.action_call = action_call
+        self.holder = holder_id()
+        self._stop = threading.Event()
+        self._renewer = None
+
+    def _content(self):
+        """
+        Lease file content, expiring one TTL from now
+        """
+        return json.dumps({
+            'holder': self.holder,
+            'action': self.action_call.action_type,
+            'sha': self.action_call.kwargs.get('sha'),
+            'expires': time.time() + config.Config.LEASE_TTL,
+        })
+
+    def _create(self):
+        """
+        Create the lease file if there is none, returns whether it was
+        created
+        """
+        handle, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path))
+        try:
+            with os.fdopen(handle, 'w') as lease_file:
+                lease_file.write(self._content())
+            os.link(tmp_path, self.path)
+        except FileExistsError:
+            return False
+        finally:
+            os.remove(tmp_path)
+        return True
+
+    def _reclaim(self, expired):
+        """
+        Take away the expired lease ``expired``, putting it back if
+        another host replaced it in the meantime
+        """
+        stale_path = '{0}.{1}'.format(self.path, self.holder.replace(':', '-'))
+        try:
+            os.rename(self.path, stale_path)
+        except FileNotFoundError:
+            return
+        if read_lease(stale_path) != expired:
+            with suppress(FileExistsError):
+                os.link(stale_path, self.path)
+        else:
+            log.warning('Reclaimed expired lease of %s on %s',
+                        expired.get('holder'), self.repo_dir)
+            metrics.incr('leases_reclaimed')
+        os.remove(stale_path)
+
+    def covered_by(self, lease):
+        """
+        Whether the job of ``lease`` does this job's work, running the
+        same action for the same or a newer SHA
+        """
+        sha = self.action_call.kwargs.get('sha')
+        if not sha or not lease.get('sha') or lease.get('action') != self.action_call.action_type:
+            return False
+        return lease['sha'] == sha or is_ancestor(
+            self.repo_dir, sha, lease['sha'], self.action_call
+        )
+
+    def acquire(self):
+        """
+        Wait for the checkout to be free and take the lease, returns
+        False without waiting further if another host takes care of
+        this job
+        """
+        while True:
+            if self._create():
+                self._renewer = threading.Thread(target=self._renew, daemon=True)
+                self._renewer.start()
+                return True
+            current = read_lease(self.path)
+            if current is None:
+                continue
+            if current['expires'] < time.time():
+                self._reclaim(current)
+            elif self.covered_by(current):
+                return False
+            else:
+                time.sleep(POLL_INTERVAL)
+
+    def _renew(self):
+        """
+        Push back the expiry of the lease while it is held
+        """
+        while not self._stop.wait(config.Config.LEASE_TTL / 3):
+            current = read_lease(self.path)
+            if not current or current.get('holder') != self.holder:
+                log.error('Lost lease on %s to %s', self.repo_dir, current and current.get('holder'))
+                return
+            write_atomic(self.path, self._content())
+
+    def release(self):
+        """
+        Give up the lease
+        """
+        self._stop.set()
+        if self._renewer:
+            self._renewer.join()
+        current = read_lease(self.path)
+        if current and current.get('holder') == self.holder:
+            os.remove(self.path)
+
+
+@contextmanager
+def leased(action_call):
+    """
+    Hold the lease on the checkout of ``action_call`` for the duration
+    of the block, which gets whether the job should run.  Nothing is
+    leased when ``LEASE_TTL_SECONDS`` is not set or the checkout
+    doesn't exist yet.
+    """
+    repo_dir = os.path.join(config.Config.REPODIR, action_call.repo_name)
+    if not config.Config.LEASE_TTL or not os.path.isdir(git_dir(repo_dir)):
+        yield True
+        return
+    lease = Lease(repo_dir, action_call)
+    if not lease.acquire():
+        log.info('Skipping %s, another host is running it for the same or a newer commit',
+                 action_call)
+        metrics.incr('lease_skips')
+        yield False
+        return
+    try:
+        yield True
+    finally:
+        lease.release()
@@ -0,0 +1,90 @@
+"""
+On-disk ledger of the repository tree last imported successfully for
+each repo, so pushing content that is already in the LMS again doesn't
+import it twice.
+"""
+import logging
+from collections import OrderedDict
+
+from gitreload.statefile import locked, write_atomic
+
+log = logging.getLogger('gitreload')  # pylint: disable=C0103
+
+
+class ImportLedger:
+    """
+    Bounded record of the tree SHA last imported successfully for each
+    repo.  The ledger is a plain text file with one
+    ``<repo_name> <tree_sha>`` entry per line, least recently imported
+    repo first, that is shared between worker processes using an
+    advisory lock file.  Only the latest tree of a repo counts, an
+    older one being pushed again (e.g. by a revert) has to be
+    imported again.
+    """
+
+    def __init__(self, path, size):
+        """
+        Setup ledger stored at ``path`` retaining the entries of at
+        most ``size`` repos.
+        """
+        self.path = path
+        self.size = size
+
+    @property
+    def enabled(self):
+        """
+        The ledger is only used when it has been given a location.
+        """
+        return bool(self.path)
+
+    def _read(self):
+        """
+        Load the latest tree of each repo, least recently imported repo
+        first.
+        """
+        entries = OrderedDict()
+        try:
+            with open(self.path) as ledger_file:
+                for line in ledger_file:
+                    parts = line.split()
+                    if len(parts) == 2:
+                        entries.pop(parts[0], None)
+                        entries[parts[0]] = parts[1]
+        except FileNotFoundError:
+            pass
+        return entries
+
+    def contains(self, repo_name, tree_sha):
+        """
+        Check whether ``tree_sha`` is the tree last imported for
+        ``repo_name``.  Failures to read the ledger are logged and
+        treated as a miss so that imports are never blocked by it.
+        """
+        if not self.enabled or not tree_sha:
+            return False
+        try:
+            with locked(self.path):
+                return self._read().get(repo_name) == tree_sha
+        except OSError:
+            log.exception('Unable to read import ledger %s', self.path)
+            return False
+
+    def record(self, repo_name, tree_sha):
+        """
+        Record a successful import as the latest of its repo, dropping
+        the least recently imported repos beyond the configured size.
+        """
+        if not self.enabled or not tree_sha:
+            return
+        try:
+            with locked(self.path):
+                entries = self._read()
+                entries.pop(repo_name, None)
+                entries[repo_name] = tree_sha
+                while len(entries) > self.size:
+                    entries.popitem(last=False)
+                write_atomic(self.path, ''.join(
+                    '{0} {1}\n'.format(*entry) for entry in entries.items()
+                ))
+        except OSError:
+            log.exception('Unable to update import ledger %s', self.path)
@@ -0,0 +1,27 @@
+"""
+Repositories that others depend on, like shared asset and library
+repos of courses.  ``LINKED_REPOS`` maps a repo name to the names of
+the checkouts it needs current, and ``ALSO_CLONE_REPOS`` to the names
+and URLs of repos to clone into ``REPODIR`` when they are missing.
+"""
+from gitreload import config
+
+
+def dependencies(repo_name):
+    """
+    Names of the repos ``repo_name`` depends on, with the URL to clone
+    them from when it is known
+    """
+    repos = dict.fromkeys(config.Config.LINKED_REPOS.get(repo_name, []))
+    repos.update(config.Config.ALSO_CLONE_REPOS.get(repo_name, {}))
+    return repos
+
+
+def dependents(repo_name):
+    """
+    Sorted names of the repos depending on ``repo_name``
+    """
+    return sorted(
+        {name for name, linked in config.Config.LINKED_REPOS.items() if repo_name in linked}
+        | {name for name, cloned in config.Config.ALSO_CLONE_REPOS.items() if repo_name in cloned}
+    )
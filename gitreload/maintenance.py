@@ -0,0 +1,74 @@
+"""
+Background maintenance of the checkouts in REPODIR, so the packs and
+loose objects built up by fetching don't slow down later updates.
+"""
+import logging
+import os
+import time
+
+from gitreload import config
+from gitreload.processing import ActionCall
+from gitreload.refs import last_maintained, list_checkouts, origin_url
+from gitreload.scheduler import QueueFullError
+from gitreload.sweeper import Sweeper
+
+log = logging.getLogger('gitreload')  # pylint: disable=C0103
+
+
+def stale_checkouts(now=None):
+    """
+    Names of the checkouts not maintained for ``MAINTENANCE_MIN_AGE``
+    seconds, stalest first, never maintained ones before all others.
+    """
+    now = time.time() if now is None else now
+    stale = []
+    for repo_name in list_checkouts(config.Config.REPODIR):
+        maintained = last_maintained(os.path.join(config.Config.REPODIR, repo_name))
+        if maintained is None or now - maintained >= config.Config.MAINTENANCE_MIN_AGE:
+            stale.append((maintained or 0, repo_name))
+    return [repo_name for _, repo_name in sorted(stale)]
+
+
+def sweep(submit):
+    """
+    Pass a maintenance action for every stale checkout to ``submit``,
+    returning the list of actions submitted.
+    """
+    actions = []
+    for repo_name in stale_checkouts():
+        action = ActionCall(
+            repo_name,
+            origin_url(os.path.join(config.Config.REPODIR, repo_name)),
+            ActionCall.ACTION_TYPES['MAINTENANCE'],
+            lane=ActionCall.LANES['MAINTENANCE'],
+            priority=ActionCall.PRIORITIES['LOW'],
+        )
+        try:
+            submit(action)
+        except QueueFullError:
+            log.warning('Queue full, maintenance of %s skipped', repo_name)
+            continue
+        actions.append(action)
+    if actions:
+        log.info('Queued maintenance of %s checkouts', len(actions))
+    return actions
+
+
+class Maintainer(Sweeper):
+    """
+    Daemon thread queueing maintenance of stale checkouts every
+    ``interval`` seconds.  The maintenance lane only runs while the
+    queue is otherwise idle.
+    """
+
+    def __init__(self, submit, interval):
+        """
+        Setup maintainer handing maintenance actions to ``submit``
+        """
+        super().__init__('gitreload-maintainer', submit, interval)
+
+    def sweep(self):
+        """
+        Queue maintenance of the stale checkouts
+        """
+        return sweep(self.submit)
@@ -0,0 +1,29 @@
+"""
+Simple process local counters.  Workers periodically drain their
+counters into the shared job queue, which aggregates them for the
+``/metrics`` endpoint.
+"""
+import threading
+from collections import Counter
+
+_counters = Counter()  # pylint: disable=C0103
+_lock = threading.Lock()  # pylint: disable=C0103
+
+
+def incr(name, amount=1):
+    """
+    Increment counter ``name`` by ``amount``
+    """
+    with _lock:
+        _counters[name] += amount
+
+
+def drain():
+    """
+    Return the counters accumulated since the last drain and reset
+    them.
+    """
+    with _lock:
+        counts = dict(_counters)
+        _counters.clear()
+    return counts
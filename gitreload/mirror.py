@@ -0,0 +1,121 @@
+"""
+Local bare mirrors of the origin repositories, shared by all
+checkouts of the same origin.  Checkouts fetch from the mirror and
+borrow its objects through ``objects/info/alternates``, so each push
+is only transferred over the network once.
+"""
+import hashlib
+import logging
+import os
+import re
+import subprocess
+
+from gitreload import config, metrics, ssh
+from gitreload.refs import git_dir
+from gitreload.resources import job_prefix
+from gitreload.statefile import locked
+
+log = logging.getLogger('gitreload')  # pylint: disable=C0103
+
+# Checkouts borrow the mirror's objects through their alternates, so
+# the mirror must never prune objects, e.g. of force pushed or deleted
+# branches, that checkouts may still reference.
+NO_GC = ['-c', 'gc.auto=0', '-c', 'gc.pruneExpire=never', '-c', 'maintenance.auto=false']
+
+
+def git(args, url, action_call=None, **kwargs):
+    """
+    Run a git command that may talk to ``url``, with the resource class
+    of ``action_call`` if given, returning its output
+    """
+    metrics.incr('git_spawns')
+    return subprocess.check_output(
+        (job_prefix(action_call) if action_call else []) + ['git'] + args,
+        env=dict(os.environ, **ssh.git_environment(url)),
+        stderr=subprocess.STDOUT,
+        timeout=config.Config.SUBPROCESS_TIMEOUT,
+        **kwargs
+    )
+
+
+def mirror_path(url):
+    """
+    Location of the mirror of ``url`` in ``MIRROR_DIR``
+    """
+    name = re.sub(r'(\.git)?/*$', '', url).rsplit('/', 1)[-1].rsplit(':', 1)[-1]
+    digest = hashlib.sha1(url.encode('utf-8')).hexdigest()[:12]
+    return os.path.join(
+        config.Config.MIRROR_DIR,
+        '{0}-{1}.git'.format(re.sub(r'[^\w.-]', '_', name), digest)
+    )
+
+
+def has_commit(path, sha):
+    """
+    Whether the repository at ``path`` already has commit ``sha``
+    """
+    try:
+        git(['--git-dir', path, 'cat-file', '-e', '{0}^{{commit}}'.format(sha)], '')
+    except subprocess.CalledProcessError:
+        return False
+    return True
+
+
+def refresh_mirror(url, sha=None, action_call=None):
+    """
+    Create or update the mirror of ``url``, with automatic garbage
+    collection turned off, and return its path.  If
+    the mirror already has the pushed commit ``sha``, for example
+    because another checkout of the same origin was just updated, it
+    isn't fetched again.  git runs with the resource class of
+    ``action_call``, if given.
+    """
+    os.makedirs(config.Config.MIRROR_DIR, exist_ok=True)
+    path = mirror_path(url)
+    with locked(path):
+        if not os.path.isdir(path):
+            log.info('Creating mirror of %s in %s', url, path)
+            # clone's -c options are written to the mirror's config
+            git(['clone', '--mirror'] + NO_GC + [url, path], url, action_call)
+            metrics.incr('mirror_clones')
+        elif sha and has_commit(path, sha):
+            metrics.incr('mirror_fetches_skipped')
+        else:
+            # Also for mirrors created without the settings
+            git(NO_GC + ['--git-dir', path, 'fetch', '--prune', 'origin'], url, action_call)
+            metrics.incr('mirror_fetches')
+    return path
+
+
+def link_checkout(repo_dir, path):
+    """
+    Make the checkout at ``repo_dir`` borrow objects from the mirror at
+    ``path``, returns whether it wasn't already
+    """
+    alternates = os.path.join(git_dir(repo_dir), 'objects', 'info', 'alternates')
+    objects = os.path.join(os.path.abspath(path), 'objects')
+    try:
+        with open(alternates) as alternates_file:
+            if objects in alternates_file.read().splitlines():
+                return False
+    except FileNotFoundError:
+        pass
+    os.makedirs(os.path.dirname(alternates), exist_ok=True)
+    with open(alternates, 'a') as alternates_file:
+        alternates_file.write('{0}\n'.format(objects))
+    log.info('Linked objects of %s to mirror %s', repo_dir, path)
+    return True
+
+
+def fetch_via_mirror(repo_dir, url, sha=None, action_call=None):
+    """
+    Refresh the mirror of ``url`` and fetch the ``origin`` branches of
+    the checkout at ``repo_dir`` from it, with the resource class of
+    ``action_call`` if given.  Returns whether the checkout was newly
+    linked to the mirror.
+    """
+    path = refresh_mirror(url, sha, action_call)
+    linked = link_checkout(repo_dir, path)
+    git(['fetch', '--prune', '--tags', path, '+refs/heads/*:refs/remotes/origin/*'],
+        '', action_call, cwd=repo_dir)
+    return linked
@@ -0,0 +1,83 @@
+"""
+Cheap handling of webhook request bodies, so that pushes which are
+going to be ignored are turned away without decoding the whole
+payload.
+"""
+import json
+import re
+from urllib.parse import unquote_plus
+
+from gitreload import config
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None  # pylint: disable=C0103
+
+# Github sends ``ref`` and ``repository`` ahead of the commits, so a
+# prefix of the body is enough to find them.
+PEEK_BYTES = 16 * 1024
+FORM_FIELD_RE = re.compile(rb'(?:^|&)payload=')
+TOKEN_RE = re.compile(r'"((?:[^"\\]|\\.)*)"\s*(:)?|([\[\]{}])')
+PEEKED = {
+    (None, 'ref'): 'ref',
+    (None, 'repository', 'name'): 'name',
+    (None, 'repository', 'html_url'): 'url',
+}
+
+
+def loads(data):
+    """
+    Decode a json document, with orjson if it is installed and not
+    turned off with ``JSON_DECODER``
+    """
+    if orjson is not None and config.Config.JSON_DECODER != 'json':
+        return orjson.loads(data)  # pylint: disable=E1101
+    return json.loads(data)
+
+
+def peek(text):
+    """
+    Scan ``text``, the start of a json push payload, for the
+    ``repository.name``, the pushed ``ref`` and the repository's
+    ``html_url`` without decoding the rest of it.  Any of them is None
+    if it wasn't found.
+    """
+    path = []
+    key = None
+    found = {}
+    for match in TOKEN_RE.finditer(text):
+        string, colon, bracket = match.groups()
+        if bracket in ('{', '['):
+            path.append(key)
+            key = None
+        elif bracket:
+            if path:
+                path.pop()
+            key = None
+        elif colon:
+            key = string
+        else:
+            name = PEEKED.get(tuple(path) + (key,))
+            if name:
+                found[name] = json.loads('"{0}"'.format(string))
+                if len(found) == len(PEEKED):
+                    break
+            key = None
+    return found.get('name'), found.get('ref'), found.get('url')
+
+
+def peek_body(data, form):
+    """
+    Repository name, ref and URL of the raw request body ``data``, which is
+    form encoded with the json in a ``payload`` field if ``form`` is
+    set.
+    """
+    head = data[:PEEK_BYTES]
+    if form:
+        match = FORM_FIELD_RE.search(head)
+        if not match:
+            return None, None, None
+        field = head[match.end():].split(b'&', 1)[0]
+        return peek(unquote_plus(field.decode('ascii', 'replace')))
+    return peek(head.decode('utf-8', 'replace'))
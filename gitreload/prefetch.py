@@ -0,0 +1,99 @@
+"""
+Prefetching of pushed commits, the I/O stage of the pipelined mode.
+
+When ``PREFETCH_CONCURRENCY`` is set, the objects of a push are
+fetched into the checkout, through its mirror if there is one, as soon
+as the webhook is accepted.  The repo's jobs are held in the JobQueue
+meanwhile, so workers run other jobs instead of waiting on the
+network and the import starts from local objects.
+"""
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from gitreload import config, metrics
+from gitreload.mirror import fetch_via_mirror, git
+from gitreload.refs import git_dir, read_head, resolve_ref
+from gitreload.statefile import locked
+
+log = logging.getLogger('gitreload')  # pylint: disable=C0103
+
+
+def prefetch(action_call):
+    """
+    Fetch the ``origin`` branches of the checkout of ``action_call``,
+    unless its branch already is at the pushed SHA.  Returns whether
+    anything was fetched.
+    """
+    repo_dir = os.path.join(config.Config.REPODIR, action_call.repo_name)
+    if not os.path.isdir(git_dir(repo_dir)):
+        return False
+    sha = action_call.kwargs.get('sha')
+    # Serialized with updates, which fetch into the same refs
+    with locked(os.path.join(git_dir(repo_dir), 'gitreload-update')):
+        branch = read_head(repo_dir)[0]
+        if sha and branch and resolve_ref(
+                repo_dir, 'refs/remotes/origin/{0}'.format(branch[len('refs/heads/'):])
+        ) == sha:
+            metrics.incr('prefetches_skipped')
+            return False
+        if config.Config.MIRROR_DIR:
+            fetch_via_mirror(repo_dir, action_call.repo_url, sha, action_call)
+        else:
+            git(['fetch', '--prune', 'origin'], action_call.repo_url, action_call, cwd=repo_dir)
+    metrics.incr('prefetches')
+    return True
+
+
+class Prefetcher:
+    """
+    Pool of threads prefetching pushes for the jobs in a JobQueue
+    """
+
+    def __init__(self, queue, concurrency):
+        """
+        Setup prefetching for the jobs of ``queue`` with
+        ``concurrency`` fetches at a time
+        """
+        self.queue = queue
+        self.executor = ThreadPoolExecutor(concurrency, thread_name_prefix='gitreload-prefetch')
+        # Latest action of each repo waiting for a prefetch thread
+        self._waiting = {}
+        self._lock = threading.Lock()
+
+    def submit(self, action_call):
+        """
+        Prefetch the push of ``action_call``, taking over a hold on its
+        repo placed in the queue before the job was put.  Pushes for a
+        repo already waiting to be prefetched are fetched together.
+        """
+        with self._lock:
+            waiting = action_call.repo_name in self._waiting
+            self._waiting[action_call.repo_name] = action_call
+        if waiting:
+            self.queue.release(action_call.repo_name)
+            return None
+        return self.executor.submit(self._run, action_call.repo_name)
+
+    def _run(self, repo_name):
+        """
+        Prefetch the latest waiting push of ``repo_name`` and let its
+        jobs run, even if it failed and they have to fetch themselves
+        """
+        with self._lock:
+            action_call = self._waiting.pop(repo_name)
+        try:
+            prefetch(action_call)
+        except Exception:  # pylint: disable=W0703
+            log.exception('Prefetch for %s failed', action_call)
+            metrics.incr('prefetch_failures')
+        finally:
+            self.queue.release(repo_name)
+
+    def stop(self):
+        """
+        Stop taking prefetches, fetches still running finish by
+        themselves
+        """
+        self.executor.shutdown(wait=False)
@@ -6,23 +6,203 @@ incluydes the workers and import task.
 import logging
 import multiprocessing
 import os
+import signal
 import subprocess
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import suppress
 
-from git import Repo
-
-from gitreload import config
+from gitreload import config, metrics, ssh
+from gitreload.durations import DurationHistory
+from gitreload.lease import leased
+from gitreload.ledger import ImportLedger
+from gitreload.links import dependencies
+from gitreload.mirror import fetch_via_mirror, git
+from gitreload.refs import BranchIndex, git_dir, maintenance_stamp, origin_url, resolve_ref
+from gitreload.resources import command_prefix, join_cgroup, open_repo
+from gitreload.retry import is_transient, retry_delay
+from gitreload.scheduler import JobQueue, QueueFullError
+from gitreload.statefile import locked
 
 log = logging.getLogger('gitreload')  # pylint: disable=C0103
 
+# Records the directories of a sparse checkout applied by gitreload
+SPARSE_MARKER = 'gitreload-sparse'
+
+# Repos of recently updated checkouts with their git directory inode
+_repos = OrderedDict()  # pylint: disable=C0103
+_repos_lock = threading.Lock()  # pylint: disable=C0103
+branches = BranchIndex()  # pylint: disable=C0103
+
+
+class SupersededError(Exception):
+    """
+    Raised when a running command was terminated because a newer
+    push for the same repo arrived.
+    """
+
+
+class DependencyError(Exception):
+    """
+    Raised when repos an action depends on couldn't be brought up to
+    date.
+    """
+
+
+def _runtime_file(repo_name, suffix):
+    """
+    Path of a per repo state file in the runtime directory
+    """
+    return os.path.join(
+        config.Config.RUNTIME_DIR, '{0}.{1}'.format(repo_name, suffix)
+    )
+
+
+def _read_cancels(repo_name):
+    """
+    Number of times in a row the commands for a repo were superseded
+    """
+    try:
+        with open(_runtime_file(repo_name, 'superseded')) as cancels_file:
+            return int(cancels_file.read() or 0)
+    except (OSError, ValueError):
+        return 0
+
+
+def _kill_group(pgid, sig):
+    """
+    Send ``sig`` to a process group if it is still around
+    """
+    with suppress(ProcessLookupError):
+        if os.getpgid(pgid) == pgid:
+            os.killpg(pgid, sig)
+
+
+def run_command(cmd, action_call, **kwargs):
+    """
+    Run ``cmd`` like ``subprocess.check_output``, but in its own
+    process group that is recorded in a pid file for the action's
+    repo so that ``supersede`` can terminate the whole group, and
+    with the resource class of the action.
+    """
+    timeout = kwargs.pop('timeout', None)
+    kwargs['env'] = dict(
+        kwargs.get('env') or os.environ,
+        **ssh.git_environment(action_call.repo_url)
+    )
+    cmd = command_prefix(action_call) + list(cmd)
+    os.makedirs(config.Config.RUNTIME_DIR, exist_ok=True)
+    metrics.incr('command_spawns')
+    pid_path = _runtime_file(action_call.repo_name, 'pid')
+    superseded_path = _runtime_file(action_call.repo_name, 'superseded')
+    started = time.time()
+    with subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                          start_new_session=True, **kwargs) as process:
+        join_cgroup(action_call, process.pid)
+        with open(pid_path, 'w') as pid_file:
+            pid_file.write('{0} {1} {2}'.format(
+                process.pid, action_call.action_type, action_call.kwargs.get('sha') or '-'
+            ))
+        try:
+            output = process.communicate(timeout=timeout)[0]
+        except subprocess.TimeoutExpired as exc:
+            _kill_group(process.pid, signal.SIGKILL)
+            output = process.communicate()[0]
+            raise subprocess.TimeoutExpired(cmd, timeout, output=output) from exc
+        finally:
+            with suppress(FileNotFoundError):
+                os.remove(pid_path)
+
+    if process.returncode < 0 and os.path.isfile(superseded_path) \
+            and os.path.getmtime(superseded_path) >= started:
+        raise SupersededError(
+            'Command for {0} was superseded'.format(action_call.repo_name)
+        )
+    # The command ran its course, so reset the run of cancellations
+    with suppress(FileNotFoundError):
+        os.remove(superseded_path)
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, cmd, output=output)
+    return output
+
+
+def supersede(action_call):
+    """
+    Terminate the process group of a command running for the same
+    repo and action as ``action_call``, unless it runs for the same
+    pushed SHA (e.g. for a redelivered webhook) or that repo has
+    already been superseded ``SUPERSEDE_MAX_CANCELS`` times in a row,
+    so that constant pushes can't keep it from ever finishing.
+    Returns True if a running command was terminated.
+    """
+    repo_name = action_call.repo_name
+    try:
+        with open(_runtime_file(repo_name, 'pid')) as pid_file:
+            pgid, action_type, sha = pid_file.read().split()
+        pgid, action_type = int(pgid), int(action_type)
+    except (OSError, ValueError):
+        return False
+    if action_type != action_call.action_type:
+        return False
+    if sha == action_call.kwargs.get('sha'):
+        log.info('Not superseding running %s of %s, it is for the same commit %s',
+                 action_call.action_text, repo_name, sha)
+        return False
+
+    cancels = _read_cancels(repo_name)
+    if cancels >= config.Config.SUPERSEDE_MAX_CANCELS:
+        log.warning('Not superseding running %s of %s, already superseded '
+                    '%s times in a row', action_call.action_text, repo_name, cancels)
+        return False
+    with open(_runtime_file(repo_name, 'superseded'), 'w') as cancels_file:
+        cancels_file.write(str(cancels + 1))
+
+    try:
+        if os.getpgid(pgid) != pgid:
+            return False
+        os.killpg(pgid, signal.SIGTERM)
+    except ProcessLookupError:
+        return False
+    killer = threading.Timer(
+        config.Config.SUPERSEDE_GRACE, _kill_group, (pgid, signal.SIGKILL)
+    )
+    killer.daemon = True
+    killer.start()
+    log.info('Superseded running %s of %s (process group %s)',
+             action_call.action_text, repo_name, pgid)
+    return True
+
 
 def import_repo(action_call):
     """
     Import the repository course into the configured edx-platform
     installation.
+
+    If the webhook told us the tree SHA being imported and the import
+    ledger shows that tree was the last one imported for this repo,
+    the import is skipped unless the action was forced.  Returns
+    whether the import ran to completion.
     """
-    os.environ['SERVICE_VARIANT'] = 'lms'
-    os.environ['LMS_CFG'] = config.Config.LMS_CFG
-    os.environ['REVISION_CFG'] = config.Config.REVISION_CFG
+    ledger = ImportLedger(
+        config.Config.IMPORT_LEDGER_PATH, config.Config.IMPORT_LEDGER_SIZE
+    )
+    tree_sha = action_call.kwargs.get('tree_sha')
+    if (not action_call.kwargs.get('force')
+            and ledger.contains(action_call.repo_name, tree_sha)):
+        log.info('Tree %s of course repo %s was already imported, skipping',
+                 tree_sha, action_call.repo_name)
+        return False
+
+    env = dict(
+        os.environ,
+        SERVICE_VARIANT='lms',
+        LMS_CFG=config.Config.LMS_CFG,
+        REVISION_CFG=config.Config.REVISION_CFG,
+    )
+    repo_dir = os.path.join(config.Config.REPODIR, action_call.repo_name)
     cmd = [
         '{0}/bin/python'.format(config.Config.VIRTUAL_ENV),
         'manage.py',
@@ -31,51 +211,237 @@ def import_repo(action_call):
         'git_add_course',
         action_call.repo_url,
         '--directory_path',
-        os.path.join(config.Config.REPODIR, action_call.repo_name),
+        repo_dir,
     ]
 
     log.info('Beginning import of course repo %s with command %s',
              action_call.repo_name, ' '.join(cmd))
     try:
-        import_process = subprocess.check_output(
+        update_dependencies(action_call)
+        if config.Config.MIRROR_DIR and os.path.isdir(repo_dir):
+            # Have objects local so the import's own fetch is cheap
+            fetch_via_mirror(
+                repo_dir, action_call.repo_url, action_call.kwargs.get('sha'), action_call
+            )
+        import_process = run_command(
             cmd,
+            action_call,
             cwd=config.Config.EDX_PLATFORM,
+            env=env,
             stderr=subprocess.STDOUT,
-            timeout=config.Config.SUBPROCESS_TIMEOUT,
+            timeout=DurationHistory.from_config().timeout(action_call),
         )
+    except SupersededError:
+        log.info('Import of course repo %s was superseded by a newer push',
+                 action_call.repo_name)
+    except DependencyError as exc:
+        log.error('Not importing course repo %s: %s', action_call.repo_name, exc)
     except subprocess.CalledProcessError as exc:
         log.exception('Import command failed with: %s', exc.output)
+        if is_transient(exc):
+            raise
     except subprocess.TimeoutExpired as exc:
         log.exception('Import command timed out after %s seconds with: %s', exc.timeout, exc.output)
     except OSError as ex:
         log.exception('System or configuration error occurred: %s', str(ex))
     else:
         log.info('Import complete, command output was: %s', import_process)
+        ledger.record(action_call.repo_name, tree_sha)
+        return True
+    return False
+
+
+def apply_sparse_checkout(repo, paths):
+    """
+    Limit the working tree of ``repo`` to the directories ``paths``
+    with a cone mode sparse checkout, or restore the full working tree
+    if there are none.  git is only run when ``paths`` differ from the
+    ones last applied.
+    """
+    marker = os.path.join(repo.git_dir, SPARSE_MARKER)
+    try:
+        with open(marker) as marker_file:
+            applied = marker_file.read()
+    except OSError:
+        applied = None
+    wanted = '\n'.join(paths)
+    if applied == wanted or (applied is None and not paths):
+        return
+    if paths:
+        repo.git.sparse_checkout('set', '--cone', *paths)
+        with open(marker, 'w') as marker_file:
+            marker_file.write(wanted)
+        log.info('Limited checkout %s to %s', repo.working_tree_dir, ', '.join(paths))
+    else:
+        repo.git.sparse_checkout('disable')
+        os.remove(marker)
+        log.info('Restored full checkout of %s', repo.working_tree_dir)
+
+
+def cached_repo(repo_dir, action_call):
+    """
+    Repo of the checkout at ``repo_dir`` for running ``action_call``.
+    Up to ``REPO_CACHE_SIZE`` Repos are kept between jobs, least
+    recently used first out, so their persistent ``cat-file``
+    processes serve the object lookups of later jobs too.
+    """
+    inode = os.stat(git_dir(repo_dir)).st_ino
+    with _repos_lock:
+        cached = _repos.pop(repo_dir, None)
+        if cached and cached[0] != inode:
+            # The checkout was cloned again
+            cached[1].close()
+            cached = None
+        if cached is None:
+            cached = (inode, open_repo(repo_dir, action_call))
+        else:
+            cached[1].git.limit(action_call)
+        _repos[repo_dir] = cached
+        while len(_repos) > config.Config.REPO_CACHE_SIZE:
+            _repos.popitem(last=False)[1][1].close()
+    return cached[1]
+
+
+def close_repos():
+    """
+    Close the cached Repos, ending their ``cat-file`` processes
+    """
+    with _repos_lock:
+        while _repos:
+            _repos.popitem()[1][1].close()
 
 
 def git_get_latest(action_call):
     """
     Performs a `git fetch origin`, `git clean -df`,
     and `git reset --hard origin/<repo_branch>`
-    on the passed in repo.
-    """
-    repo = Repo(os.path.join(config.Config.REPODIR, action_call.repo_name))
-    # Grab HEAD sha to see if we actually are updating
-    orig_head = repo.head.commit.tree.hexsha
-    repo.git.fetch('--all')
-    repo.head.reset(
-        index=True, working_tree=True,
-        commit='origin/{0}'.format(repo.git.rev_parse('--abbrev-ref', 'HEAD'))
+    on the passed in repo, limited to the directories in
+    ``SPARSE_CHECKOUTS`` for the repo if there are any.  Updates of
+    the same checkout, also as a dependency of other repos, are run
+    one at a time.
+
+    Refs are read from the git directory rather than with git, and the
+    fetch is skipped if ``origin/<repo_branch>`` already is at the
+    pushed SHA, so a no-op update only runs git for the reset and clean.
+    """
+    repo_dir = os.path.join(config.Config.REPODIR, action_call.repo_name)
+    with locked(os.path.join(git_dir(repo_dir), 'gitreload-update')):
+        repo = cached_repo(repo_dir, action_call)
+        branch = branches.branch(repo_dir)
+        if branch is None:
+            raise InvalidGitActionException(
+                'No branch checked out in {0}'.format(action_call.repo_name)
+            )
+        remote_ref = 'refs/remotes/origin/{0}'.format(branch[len('refs/heads/'):])
+        # Grab HEAD sha to see if we actually are updating
+        orig_commit = resolve_ref(repo_dir, branch)
+        sha = action_call.kwargs.get('sha')
+        if sha and resolve_ref(repo_dir, remote_ref) == sha:
+            metrics.incr('fetches_skipped')
+        elif config.Config.MIRROR_DIR:
+            if fetch_via_mirror(repo.working_tree_dir, action_call.repo_url, sha, action_call):
+                # Restart the persistent cat-file helpers so they pick up
+                # the mirror's objects through the new alternates.
+                repo.git.clear_cache()
+        else:
+            repo.git.update_environment(**ssh.git_environment(action_call.repo_url))
+            repo.git.fetch('--all')
+        # With a sparse checkout, reset and clean only touch its directories
+        paths = [
+            path.strip('/') for path in config.Config.SPARSE_CHECKOUTS.get(action_call.repo_name, [])
+        ]
+        apply_sparse_checkout(repo, paths)
+        new_commit = resolve_ref(repo_dir, remote_ref) or remote_ref
+        repo.head.reset(index=True, working_tree=True, commit=new_commit)
+        repo.git.clean('-xdf', '--', *paths)
+        orig_head = repo.commit(orig_commit).tree.hexsha
+        new_head = orig_head if new_commit == orig_commit else repo.commit(new_commit).tree.hexsha
+        if new_head == orig_head:
+            log.warning('Attempted update of %s at HEAD %s, but no updates',
+                        action_call.repo_name, orig_head)
+        else:
+            log.info('Updated to latest revision of repo %s. '
+                     'Original SHA: %s. Head SHA: %s',
+                     action_call.repo_name, orig_head, new_head)
+        return True
+
+
+def update_dependency(repo_name, repo_url):
+    """
+    Clone a repo another one depends on if it is missing and has a
+    URL to clone it from, or update its checkout.
+    """
+    repo_dir = os.path.join(config.Config.REPODIR, repo_name)
+    cloned = os.path.isdir(repo_dir)
+    if not cloned and repo_url is None:
+        raise DependencyError('Linked repo {0} is not checked out'.format(repo_name))
+    action_call = ActionCall(
+        repo_name, repo_url or origin_url(repo_dir), ActionCall.ACTION_TYPES['GET_LATEST']
     )
-    repo.git.clean('-xdf')
-    new_head = repo.head.commit.tree.hexsha
-    if new_head == orig_head:
-        log.warning('Attempted update of %s at HEAD %s, but no updates',
-                    action_call.repo_name, orig_head)
+    if not cloned:
+        git(['clone', repo_url, repo_dir], repo_url, action_call)
+        log.info('Cloned repo %s from %s', repo_name, repo_url)
     else:
-        log.info('Updated to latest revision of repo %s. '
-                 'Original SHA: %s. Head SHA: %s',
-                 action_call.repo_name, orig_head, new_head)
+        git_get_latest(action_call)
+    metrics.incr('dependency_updates')
+
+
+def update_dependencies(action_call):
+    """
+    Bring the repos the action's repo depends on up to date, with at
+    most ``DEPENDENCY_CONCURRENCY`` of them at once.  Raises
+    DependencyError naming the ones that failed, unless one failed on
+    a transient error, which is raised instead so the job is retried.
+    """
+    repos = dependencies(action_call.repo_name)
+    if not repos:
+        return
+    with ThreadPoolExecutor(min(len(repos), config.Config.DEPENDENCY_CONCURRENCY)) as pool:
+        futures = {
+            name: pool.submit(update_dependency, name, url) for name, url in repos.items()
+        }
+    failed = []
+    transient = None
+    for name, future in futures.items():
+        try:
+            future.result()
+        except Exception as exc:  # pylint: disable=W0703
+            log.exception('Failed to update repo %s needed by %s', name, action_call.repo_name)
+            failed.append(name)
+            if transient is None and is_transient(exc):
+                transient = exc
+    if transient is not None:
+        raise transient
+    if failed:
+        raise DependencyError('Unable to update {0}'.format(', '.join(failed)))
+
+
+def git_maintenance(action_call):
+    """
+    Runs `git maintenance` with the configured tasks on the passed in
+    repo to repack it, write its commit-graph and multi-pack-index
+    and prune its loose objects, then records when it was maintained.
+    Holds the update lock of the checkout, so dependency updates and
+    prefetches, which run outside of the checkout's own jobs, and the
+    jobs of other backends don't fetch or reset while it is repacked.
+    """
+    repo_dir = os.path.join(config.Config.REPODIR, action_call.repo_name)
+    cmd = ['git', 'maintenance', 'run'] + [
+        '--task={0}'.format(task.strip()) for task in config.Config.MAINTENANCE_TASKS
+    ]
+    with locked(os.path.join(git_dir(repo_dir), 'gitreload-update')):
+        output = run_command(
+            cmd,
+            action_call,
+            cwd=repo_dir,
+            stderr=subprocess.STDOUT,
+            timeout=config.Config.SUBPROCESS_TIMEOUT,
+        )
+    with open(maintenance_stamp(repo_dir), 'w'):
+        pass
+    metrics.incr('maintenance_runs')
+    log.info('Maintained repo %s, output was: %s', action_call.repo_name, output)
+    return True
 
 
 class InvalidGitActionException(Exception):
@@ -92,6 +458,17 @@ class ActionCall:
     ACTION_TYPES = {
         'COURSE_IMPORT': 0,
         'GET_LATEST': 1,
+        'MAINTENANCE': 2,
+    }
+    PRIORITIES = {
+        'LOW': 0,
+        'NORMAL': 1,
+        'HIGH': 2,
+    }
+    LANES = {
+        'WEBHOOK': 'webhook',
+        'BULK': 'bulk',
+        'MAINTENANCE': 'maintenance',
     }
 
     def __init__(
@@ -111,6 +488,22 @@ class ActionCall:
             )
         self.action_type = action_type
         self.kwargs = kwargs
+        # Identity of the job, kept by the copies passed between
+        # processes and taken over by a newer action merged into the job
+        self.job_id = uuid.uuid4().hex
+
+    def __eq__(self, other):
+        """
+        Actions are the same job if they have the same job id, so the
+        entry of a job is found in the shared list of queued jobs
+        """
+        return isinstance(other, ActionCall) and other.job_id == self.job_id
+
+    def __hash__(self):
+        """
+        Hash by job id, like equality
+        """
+        return hash(self.job_id)
 
     @property
     def action_text(self):
@@ -121,6 +514,30 @@ class ActionCall:
                        if value == self.action_type]
         return action_type[0]
 
+    @property
+    def priority(self):
+        """
+        Scheduling priority of the job, lower priority jobs are shed
+        first when the queue is full.
+        """
+        return self.kwargs.get('priority', self.PRIORITIES['NORMAL'])
+
+    @property
+    def lane(self):
+        """
+        Queue lane of the job, internal bulk work is kept apart from
+        jobs triggered by webhooks.
+        """
+        return self.kwargs.get('lane', self.LANES['WEBHOOK'])
+
+    @property
+    def key(self):
+        """
+        Identity of the job for coalescing, pushes for the same repo
+        and action are interchangeable while they wait.
+        """
+        return (self.repo_name, self.action_type)
+
     def __repr__(self):
         """
         String representation of class for use in logs and such
@@ -131,25 +548,27 @@ class ActionCall:
                 ))
 
 
-class GitAction(multiprocessing.Process):
+class Worker:
     """
-    Simple queue worker thread. Runs import_repo
-    one at a time as they come in using the queue
+    Queue loop shared by the process and thread workers
     """
 
     EXIT_CODE = 9
 
+    # Each returns whether it ran to completion, only the durations of
+    # those runs are recorded
     ACTION_COMMANDS = (
         import_repo,
         git_get_latest,
+        git_maintenance,
     )
 
-    def __init__(self, queue, thread_num, queued_jobs):
+    def __init__(self, queue, thread_num, queued_jobs, name=None):
         """
         Build class with needed information to work the queue
         """
-        super(GitAction, self).__init__()
-        # Make daemon thread so we exit when the program exits
+        super().__init__(name=name)
+        # Make daemon so we exit when the program exits
         self.daemon = True
 
         self.queue = queue
@@ -168,12 +587,80 @@ class GitAction(multiprocessing.Process):
                 len(self.queued_jobs),
                 self.thread_num
             )
+            failure = None
             try:
                 log.debug('Used %s as index to ACTION_COMMANDS',
                           action_call.action_type)
-                self.ACTION_COMMANDS[action_call.action_type](action_call)
-            except Exception:  # pylint: disable=W0703
+                with leased(action_call) as run:
+                    if run:
+                        metrics.incr('jobs_run')
+                        started = time.monotonic()
+                        if self.ACTION_COMMANDS[action_call.action_type](action_call):
+                            DurationHistory.from_config().record(
+                                action_call, time.monotonic() - started
+                            )
+            except Exception as exc:  # pylint: disable=W0703
                 log.exception('Failed to run command GitAction')
+                failure = exc
             finally:
-                self.queued_jobs.pop()
-                self.queue.task_done()
+                self.forget(action_call)
+                if failure is not None:
+                    self.retry(action_call, failure)
+                self.queue.add_metrics(metrics.drain())
+                self.queue.task_done(action_call)
+
+    def forget(self, action_call):
+        """
+        Remove the entry of ``action_call`` from the list of queued jobs
+        """
+        with suppress(ValueError):
+            self.queued_jobs.remove(action_call)
+
+    def retry(self, action_call, exc):
+        """
+        Queue ``action_call`` again after a backoff delay if it failed
+        on a transient error and has attempts left
+        """
+        delay = retry_delay(action_call, exc)
+        if delay is None:
+            return
+        attempt = action_call.kwargs.get('attempt', 1) + 1
+        retried = ActionCall(
+            action_call.repo_name, action_call.repo_url, action_call.action_type,
+            **dict(action_call.kwargs, attempt=attempt)
+        )
+        # Listed before it is queued, so a worker taking it finds it
+        self.queued_jobs.append(retried)
+        try:
+            status = self.queue.retry(retried, delay)
+        except QueueFullError:
+            log.warning('Queue full, not retrying %s', action_call)
+            self.forget(retried)
+            return
+        if status == JobQueue.MERGED:
+            self.forget(retried)
+        else:
+            metrics.incr('job_retries')
+            log.info('Retrying %s in %.0f seconds, attempt %s', action_call, delay, attempt)
+
+
+class GitAction(Worker, multiprocessing.Process):
+    """
+    Simple queue worker process. Runs import_repo
+    one at a time as they come in using the queue
+    """
+
+
+class GitActionThread(Worker, threading.Thread):
+    """
+    Queue worker thread, a lighter alternative to GitAction as the
+    work mostly consists of waiting on git and import subprocesses.
+    """
+
+    def __init__(self, queue, thread_num, queued_jobs):
+        """
+        Name the thread after its number
+        """
+        super().__init__(
+            queue, thread_num, queued_jobs, name='gitreload-worker-{0}'.format(thread_num)
+        )
@@ -0,0 +1,107 @@
+"""
+Background reconciliation of checkouts against their remotes, to catch
+up on pushes whose webhooks never arrived.
+"""
+import logging
+import os
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from gitreload import config, ssh
+from gitreload.processing import ActionCall
+from gitreload.refs import list_checkouts, origin_url, read_head
+from gitreload.resources import job_prefix
+from gitreload.scheduler import QueueFullError
+from gitreload.sweeper import Sweeper
+
+log = logging.getLogger('gitreload')  # pylint: disable=C0103
+
+
+def remote_sha(repo_dir, branch, action_call):
+    """
+    SHA of ``branch`` on the origin remote of the checkout, as reported
+    by ``git ls-remote`` run with the resource class of
+    ``action_call``.  Returns None if it can't be determined.
+    """
+    try:
+        output = subprocess.check_output(
+            job_prefix(action_call) + ['git', 'ls-remote', 'origin', branch],
+            cwd=repo_dir,
+            env=dict(os.environ, **ssh.git_environment(action_call.repo_url or '')),
+            stderr=subprocess.DEVNULL,
+            timeout=config.Config.RECONCILE_TIMEOUT,
+        )
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired, OSError):
+        log.warning('Unable to list remote refs of %s', repo_dir)
+        return None
+    for line in output.decode('utf-8', 'replace').splitlines():
+        parts = line.split()
+        if len(parts) == 2 and parts[1] == branch:
+            return parts[0]
+    return None
+
+
+def check_drift(repo_name):
+    """
+    Compare the checked out branch of ``repo_name`` with its remote,
+    returning an ActionCall for the repo if it drifted, else None.
+    """
+    repo_dir = os.path.join(config.Config.REPODIR, repo_name)
+    try:
+        branch, local_sha = read_head(repo_dir)
+    except OSError:
+        return None
+    if not branch:
+        return None
+    action_text = config.Config.RECONCILE_ACTIONS.get(
+        repo_name, config.Config.RECONCILE_DEFAULT_ACTION
+    )
+    action_call = ActionCall(
+        repo_name,
+        origin_url(repo_dir),
+        ActionCall.ACTION_TYPES[action_text],
+        priority=ActionCall.PRIORITIES['LOW'],
+    )
+    remote = remote_sha(repo_dir, branch, action_call)
+    if remote is None or remote == local_sha:
+        return None
+    log.info('Checkout %s at %s drifted from remote %s at %s',
+             repo_name, local_sha, branch, remote)
+    return action_call
+
+
+def sweep(submit):
+    """
+    Check every checkout in ``REPODIR`` for drift with bounded
+    concurrency and pass an action for each drifted one to ``submit``.
+    Returns the list of actions submitted.
+    """
+    repo_names = list_checkouts(config.Config.REPODIR)
+    with ThreadPoolExecutor(config.Config.RECONCILE_CONCURRENCY) as pool:
+        actions = [action for action in pool.map(check_drift, repo_names) if action]
+    for action in actions:
+        try:
+            submit(action)
+        except QueueFullError:
+            log.warning('Queue full, reconciliation of %s skipped', action.repo_name)
+    log.info('Reconciled %s checkouts, %s drifted', len(repo_names), len(actions))
+    return actions
+
+
+class Reconciler(Sweeper):
+    """
+    Daemon thread sweeping the checkouts for drift every ``interval``
+    seconds
+    """
+
+    def __init__(self, submit, interval):
+        """
+        Setup reconciler handing drifted repos to ``submit``
+        """
+        super().__init__('gitreload-reconciler', submit, interval)
+
+    def sweep(self):
+        """
+        Run one sweep
+        """
+        return sweep(self.submit)
@@ -0,0 +1,216 @@
+"""
+Cheap lookups of checkout state read straight from the ``.git``
+directory, without spawning git.
+"""
+import os
+import re
+import time
+
+HEAD_REF_PREFIX = 'ref: '
+MAINTENANCE_STAMP = 'gitreload-maintenance'
+URL_RE = re.compile(r'^(?:[\w+]+://)?(?:[^@/]+@)?(?P<host>[^/:]+)(?::\d+)?[:/]+(?P<path>.*)$')
+
+
+def git_dir(repo_dir):
+    """
+    Path of the git directory of the checkout at ``repo_dir``
+    """
+    return os.path.join(repo_dir, '.git')
+
+
+def list_checkouts(repodir):
+    """
+    Sorted names of the git checkouts directly inside ``repodir``
+    """
+    try:
+        names = os.listdir(repodir)
+    except OSError:
+        return []
+    return sorted(
+        name for name in names
+        if os.path.isdir(git_dir(os.path.join(repodir, name)))
+    )
+
+
+def resolve_ref(repo_dir, ref):
+    """
+    SHA that ``ref`` (e.g. ``refs/heads/master``) points to, looking
+    at loose refs first and packed refs second.  Returns None if the
+    ref doesn't exist.
+    """
+    try:
+        with open(os.path.join(git_dir(repo_dir), ref)) as ref_file:
+            return ref_file.read().strip()
+    except OSError:
+        pass
+    try:
+        with open(os.path.join(git_dir(repo_dir), 'packed-refs')) as packed_file:
+            for line in packed_file:
+                parts = line.split()
+                if len(parts) == 2 and parts[1] == ref:
+                    return parts[0]
+    except OSError:
+        pass
+    return None
+
+
+def read_head(repo_dir):
+    """
+    Branch ref checked out at ``repo_dir`` and the SHA it points to.
+    The branch is None for a detached HEAD, and the SHA is None for a
+    branch without commits.
+    """
+    with open(os.path.join(git_dir(repo_dir), 'HEAD')) as head_file:
+        head = head_file.read().strip()
+    if not head.startswith(HEAD_REF_PREFIX):
+        return None, head
+    branch = head[len(HEAD_REF_PREFIX):]
+    return branch, resolve_ref(repo_dir, branch)
+
+
+def origin_url(repo_dir):
+    """
+    URL of the ``origin`` remote of the checkout, or None
+    """
+    section = None
+    try:
+        with open(os.path.join(git_dir(repo_dir), 'config')) as config_file:
+            for line in config_file:
+                line = line.strip()
+                if line.startswith('['):
+                    section = line
+                elif section == '[remote "origin"]' and line.startswith('url'):
+                    key, _, value = line.partition('=')
+                    if key.strip() == 'url':
+                        return value.strip()
+    except OSError:
+        pass
+    return None
+
+
+def maintenance_stamp(repo_dir):
+    """
+    Path of the file whose mtime records when the checkout was last
+    maintained
+    """
+    return os.path.join(git_dir(repo_dir), MAINTENANCE_STAMP)
+
+
+def last_maintained(repo_dir):
+    """
+    Time the checkout was last maintained, or None if it never was
+    """
+    try:
+        return os.path.getmtime(maintenance_stamp(repo_dir))
+    except OSError:
+        return None
+
+
+class BranchIndex:
+    """
+    Cache of the branch checked out in each checkout, refreshed
+    whenever the checkout's HEAD file changes.
+    """
+
+    def __init__(self):
+        """
+        Setup empty index
+        """
+        self._branches = {}
+
+    def branch(self, repo_dir):
+        """
+        Branch ref checked out at ``repo_dir``, None for a detached
+        HEAD.  Raises OSError if it isn't a checkout.
+        """
+        mtime = os.stat(os.path.join(git_dir(repo_dir), 'HEAD')).st_mtime_ns
+        cached = self._branches.get(repo_dir)
+        if cached is None or cached[0] != mtime:
+            cached = (mtime, read_head(repo_dir)[0])
+            self._branches[repo_dir] = cached
+        return cached[1]
+
+
+def normalize_url(url):
+    """
+    Canonical ``host/path`` form of a repository URL, so that the
+    https, ssh and scp-like URLs of a repository compare equal
+    """
+    url = url.strip()
+    if url.startswith('file://'):
+        url = url[len('file://'):]
+    match = None if url.startswith('/') else URL_RE.match(url)
+    if match:
+        url = '{0}/{1}'.format(match.group('host'), match.group('path'))
+    return re.sub(r'(\.git)?/*$', '', url).lower()
+
+
+class CheckoutIndex:
+    """
+    Index of the checkouts in a directory by their normalized origin
+    URL and checked out branch, so a push can be dispatched to every
+    checkout tracking the pushed branch.  The directory is scanned
+    again when checkouts are added or removed, when an indexed
+    checkout switched branches, or after ``ttl`` seconds.
+    """
+
+    def __init__(self, ttl):
+        """
+        Setup empty index
+        """
+        self.ttl = ttl
+        self._repodir = None
+        self._stamp = None
+        self._built = None
+        self._index = {}
+
+    def rebuild(self, repodir):
+        """
+        Scan ``repodir`` for checkouts and index them
+        """
+        index = {}
+        for name in list_checkouts(repodir):
+            repo_dir = os.path.join(repodir, name)
+            url = origin_url(repo_dir)
+            try:
+                branch = read_head(repo_dir)[0]
+            except OSError:
+                continue
+            if url and branch:
+                index.setdefault((normalize_url(url), branch), []).append((name, url))
+        self._index = index
+        self._repodir = repodir
+        self._stamp = os.stat(repodir).st_mtime_ns
+        self._built = time.monotonic()
+
+    def _stale(self, repodir):
+        """
+        Whether the index has to be rebuilt before a lookup
+        """
+        return (
+            repodir != self._repodir
+            or os.stat(repodir).st_mtime_ns != self._stamp
+            or time.monotonic() - self._built > self.ttl
+        )
+
+    def lookup(self, repodir, url, ref):
+        """
+        Names and origin URLs of the checkouts in ``repodir`` of the
+        repository at ``url`` with ``ref`` checked out
+        """
+        try:
+            if self._stale(repodir):
+                self.rebuild(repodir)
+        except OSError:
+            return []
+        key = (normalize_url(url), ref)
+        checkouts = self._index.get(key, [])
+        for name, _ in checkouts:
+            try:
+                branch = read_head(os.path.join(repodir, name))[0]
+            except OSError:
+                branch = None
+            if branch != ref:
+                self.rebuild(repodir)
+                return list(self._index.get(key, []))
+        return list(checkouts)
@@ -0,0 +1,206 @@
+"""
+Resource classes for the subprocesses of jobs, so heavy imports don't
+starve the webhook receiver and quick updates.
+
+``RESOURCE_CLASSES`` names classes of settings::
+
+    {"background": {"nice": 10, "ionice": "idle",
+                    "cpu_max": "50000 100000", "memory_max": "2G"}}
+
+and ``JOB_RESOURCE_CLASSES`` picks the class of a job by repo name,
+action type or lane, in that order of precedence.  ``nice`` and
+``ionice`` (``idle``, or ``best-effort`` or ``realtime`` with an
+optional ``:level``) are applied by running each subprocess through
+``nice`` and ``ionice``, while ``cpu_max`` and ``memory_max`` place it
+in a cgroup v2 of the class under ``CGROUP_PARENT``, when that is set
+and usable.  None of it uses ``preexec_fn``, which isn't safe in the
+threads gitreload runs and keeps subprocess from spawning fast.
+"""
+import logging
+import os
+import shutil
+from contextlib import suppress
+from functools import lru_cache
+
+from git import Git, Repo
+
+from gitreload import config, metrics
+
+log = logging.getLogger('gitreload')  # pylint: disable=C0103
+
+IOPRIO_CLASSES = {'realtime': 1, 'best-effort': 2, 'idle': 3}
+# Joins the cgroup whose cgroup.procs is the first argument, then runs
+# the command in the same process
+JOIN_CGROUP = ['sh', '-c', 'echo 0 2>/dev/null >"$0"; exec "$@"']
+
+_cgroups = {}  # pylint: disable=C0103
+
+
+def class_name(action_call):
+    """
+    Name of the resource class of a job, or None
+    """
+    for key in (action_call.repo_name, action_call.action_text, action_call.lane):
+        if key in config.Config.JOB_RESOURCE_CLASSES:
+            return config.Config.JOB_RESOURCE_CLASSES[key]
+    return None
+
+
+@lru_cache(maxsize=None)
+def tool(name):
+    """
+    Whether the command ``name`` is available, warning once if not
+    """
+    if shutil.which(name) is None:
+        log.warning('%s is not installed, running jobs without its limits', name)
+        return False
+    return True
+
+
+def cgroup_procs(name, settings):
+    """
+    Path of the ``cgroup.procs`` file of the cgroup of class ``name``,
+    creating it with the class limits, or None when the class has no
+    limits or cgroups aren't usable
+    """
+    limits = {
+        control: settings[key]
+        for key, control in (('cpu_max', 'cpu.max'), ('memory_max', 'memory.max'))
+        if settings.get(key)
+    }
+    if not limits or not config.Config.CGROUP_PARENT:
+        return None
+    if name in _cgroups:
+        return _cgroups[name]
+    path = os.path.join(config.Config.CGROUP_PARENT, 'gitreload-{0}'.format(name))
+    try:
+        with suppress(OSError):
+            with open(os.path.join(config.Config.CGROUP_PARENT, 'cgroup.subtree_control'), 'w') \
+                    as control_file:
+                control_file.write('+cpu +memory')
+        os.makedirs(path, exist_ok=True)
+        for control, value in limits.items():
+            with open(os.path.join(path, control), 'w') as control_file:
+                control_file.write(str(value))
+    except OSError as exc:
+        log.warning('Unable to set up cgroup %s, running without its limits: %s', path, exc)
+        _cgroups[name] = None
+    else:
+        _cgroups[name] = os.path.join(path, 'cgroup.procs')
+    return _cgroups[name]
+
+
+def command_prefix(action_call):
+    """
+    Prefix running a command of a job with the niceness and I/O
+    priority of its resource class, using ``nice`` and ``ionice`` so
+    nothing has to run in the child between fork and exec.  Empty if
+    the job has no such limits.
+    """
+    name = class_name(action_call)
+    if name is None:
+        return []
+    settings = config.Config.RESOURCE_CLASSES[name]
+    prefix = []
+    if settings.get('nice') is not None and tool('nice'):
+        # nice adds to the niceness of gitreload, the setting is absolute
+        increment = settings['nice'] - os.getpriority(os.PRIO_PROCESS, 0)
+        if increment > 0:
+            prefix += ['nice', '-n', str(increment)]
+    if settings.get('ionice') and tool('ionice'):
+        io_class, _, level = settings['ionice'].partition(':')
+        prefix += ['ionice', '-c', str(IOPRIO_CLASSES[io_class])]
+        if level:
+            prefix += ['-n', level]
+    return prefix
+
+
+def check_classes():
+    """
+    Raise ValueError if ``RESOURCE_CLASSES`` or ``JOB_RESOURCE_CLASSES``
+    are invalid, so mistakes show at startup rather than in each job
+    """
+    for name, settings in config.Config.RESOURCE_CLASSES.items():
+        if not isinstance(settings, dict):
+            raise ValueError('Invalid resource class {0}: {1!r}'.format(name, settings))
+        if settings.get('nice') is not None and not isinstance(settings['nice'], int):
+            raise ValueError('Invalid nice of resource class {0}: {1!r}'.format(
+                name, settings['nice']
+            ))
+        if settings.get('ionice'):
+            io_class, _, level = str(settings['ionice']).partition(':')
+            if io_class not in IOPRIO_CLASSES or (level and not level.isdigit()):
+                raise ValueError('Invalid ionice of resource class {0}: {1!r}'.format(
+                    name, settings['ionice']
+                ))
+    for key, name in config.Config.JOB_RESOURCE_CLASSES.items():
+        if name not in config.Config.RESOURCE_CLASSES:
+            raise ValueError('Unknown resource class {0} for {1}'.format(name, key))
+
+
+def job_cgroup(action_call):
+    """
+    Path of the ``cgroup.procs`` file of the cgroup of a job, or None
+    """
+    name = class_name(action_call)
+    if name is None:
+        return None
+    return cgroup_procs(name, config.Config.RESOURCE_CLASSES[name])
+
+
+def job_prefix(action_call):
+    """
+    Prefix running a command of a job with its resource class, for
+    commands not started through ``run_command``.  As their processes
+    aren't known before they run, they join the cgroup of the job
+    through a shell that then execs the command.
+    """
+    procs = job_cgroup(action_call)
+    return command_prefix(action_call) + (JOIN_CGROUP + [procs] if procs else [])
+
+
+def join_cgroup(action_call, pid):
+    """
+    Move the started process ``pid`` of a job into its cgroup, if any
+    """
+    procs = job_cgroup(action_call)
+    if procs is not None:
+        with suppress(OSError):
+            with open(procs, 'w') as procs_file:
+                procs_file.write(str(pid))
+
+
+class LimitedGit(Git):
+    """
+    Git command wrapper starting git with the resource class of a job
+    """
+    prefix = ()
+
+    def execute(self, command, *args, **kwargs):  # pylint: disable=W0221
+        """
+        Run ``command`` with the job's limits applied, counting it
+        """
+        metrics.incr('git_spawns')
+        return super().execute(list(self.prefix) + list(command), *args, **kwargs)
+
+    def limit(self, action_call):
+        """
+        Apply the resource class of ``action_call`` to later commands
+        """
+        self.prefix = job_prefix(action_call)
+
+
+class LimitedRepo(Repo):
+    """
+    Repo whose git commands run with the resource class of a job
+    """
+    GitCommandWrapperType = LimitedGit
+
+
+def open_repo(repo_dir, action_call):
+    """
+    Repo of the checkout at ``repo_dir`` for running ``action_call``
+    """
+    repo = LimitedRepo(repo_dir)
+    repo.git.limit(action_call)
+    return repo
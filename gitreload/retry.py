@@ -0,0 +1,104 @@
+"""
+Retries of jobs that failed on transient errors, like GitHub server
+errors during a fetch or a lost database connection during an import.
+Failed jobs are queued again with an exponential backoff, and wait
+in the JobQueue like debounced jobs so they never hold up a worker.
+"""
+import random
+import re
+import subprocess
+from collections import namedtuple
+
+from git import GitCommandError
+
+from gitreload import config
+
+# Output of git and import commands that failed for reasons likely to
+# go away by themselves
+TRANSIENT_ERRORS = re.compile('|'.join([
+    r'The requested URL returned error: 5\d\d',
+    r'\b50[234] (Bad Gateway|Service Unavailable|Gateway Time-?out)',
+    r'Internal Server Error',
+    r'RPC failed',
+    r'remote end hung up unexpectedly',
+    r'early EOF',
+    r'Could not resolve host',
+    r'Temporary failure in name resolution',
+    r'Connection (timed out|reset by peer|refused)',
+    r'Operation timed out',
+    r'(kex|ssh)_exchange_identification',
+    r'gnutls_handshake\(\) failed',
+    r'SSL_ERROR_SYSCALL',
+    r'Lost connection to MySQL server',
+    r'MySQL server has gone away',
+    r"Can't connect to MySQL server",
+    r'Deadlock found when trying to get lock',
+    r'Lock wait timeout exceeded',
+    r'ServerSelectionTimeoutError',
+    r'AutoReconnect',
+]))
+
+
+class RetryPolicy(namedtuple('RetryPolicy', ['max_attempts', 'base_delay', 'max_delay'])):
+    """
+    How often and how soon a failed job is tried again
+    """
+    __slots__ = ()
+
+    def delay(self, attempt):
+        """
+        Seconds to wait after failed attempt number ``attempt``,
+        doubling with each attempt up to ``max_delay``, half of it
+        random so retries of many jobs spread out
+        """
+        ceiling = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return ceiling / 2 + random.uniform(0, ceiling / 2)
+
+
+def policy_for(action_call):
+    """
+    Retry policy of an action, the defaults overridden by the ones of
+    its action type in ``RETRY_POLICIES``
+    """
+    settings = {
+        'max_attempts': config.Config.RETRY_MAX_ATTEMPTS,
+        'base_delay': config.Config.RETRY_BASE_DELAY,
+        'max_delay': config.Config.RETRY_MAX_DELAY,
+    }
+    settings.update(config.Config.RETRY_POLICIES.get(action_call.action_text, {}))
+    return RetryPolicy(**settings)
+
+
+def error_output(exc):
+    """
+    Output of the failed command behind ``exc``
+    """
+    if isinstance(exc, GitCommandError):
+        output = [exc.stderr, exc.stdout]
+    else:
+        output = [exc.output, getattr(exc, 'stderr', None)]
+    return ' '.join(
+        part.decode('utf-8', 'replace') if isinstance(part, bytes) else str(part)
+        for part in output if part
+    )
+
+
+def is_transient(exc):
+    """
+    Whether ``exc`` is a command failure worth retrying
+    """
+    if not isinstance(exc, (GitCommandError, subprocess.CalledProcessError)):
+        return False
+    return TRANSIENT_ERRORS.search(error_output(exc)) is not None
+
+
+def retry_delay(action_call, exc):
+    """
+    Seconds to wait before trying ``action_call`` again after it
+    failed with ``exc``, or None if it isn't to be retried
+    """
+    attempt = action_call.kwargs.get('attempt', 1)
+    policy = policy_for(action_call)
+    if attempt >= policy.max_attempts or not is_transient(exc):
+        return None
+    return policy.delay(attempt)
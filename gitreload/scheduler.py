@@ -0,0 +1,430 @@
+"""
+Job queue shared between the web application and the GitAction
+workers.  Jobs are coalesced per repository and action, and held back
+until they are runnable before being handed out to workers.
+"""
+import itertools
+import threading
+import time
+from collections import Counter, OrderedDict
+from multiprocessing.managers import SyncManager
+from queue import Empty
+
+
+class QueueFullError(Exception):
+    """
+    Raised when a job can't be queued because the queue is at its
+    depth limit and holds no lower priority job to make room.
+    """
+
+    def __init__(self, retry_after):
+        """
+        Keep the suggested number of seconds to wait before retrying
+        """
+        super().__init__(retry_after)
+        self.retry_after = retry_after
+
+
+class ShortestJobFirst:
+    """
+    Scheduling policy handing out the runnable job with the shortest
+    expected duration first.  Every second a job waits is credited
+    against its expected duration ``aging`` times, so long jobs are
+    not starved by a steady stream of short ones.
+    """
+
+    def __init__(self, aging, default_estimate):
+        """
+        Setup policy, jobs without history are expected to take
+        ``default_estimate`` seconds.
+        """
+        self.aging = aging
+        self.default_estimate = default_estimate
+
+    def rank(self, job, now):
+        """
+        Sort key of a runnable job, lowest goes first
+        """
+        expected = self.default_estimate if job.expected is None else job.expected
+        return expected - self.aging * (now - job.first_push)
+
+
+class PendingJob:
+    """
+    Book keeping for a job waiting in the JobQueue
+    """
+
+    def __init__(self, action_call, now):
+        """
+        Start tracking ``action_call`` first pushed at ``now``
+        """
+        self.action_call = action_call
+        self.first_push = now
+        self.ready_at = now
+        self.expected = None
+        self.started = None
+        self.batches = set()
+
+    def schedule(self, now, debounce, max_delay):
+        """
+        Make the job runnable ``debounce`` seconds after the latest
+        push, but never later than ``max_delay`` seconds after the
+        first one.
+        """
+        self.ready_at = now + debounce
+        if max_delay is not None:
+            self.ready_at = min(self.ready_at, self.first_push + max_delay)
+
+
+class JobQueue:
+    """
+    Queue of ActionCall jobs with the same get/put/task_done interface
+    as a JoinableQueue.
+
+    A job put while one for the same repo and action is still waiting
+    is merged into it, keeping the newest action call.  Each job is
+    only handed out once its debounce window has passed with no new
+    push for it.
+
+    The number of waiting jobs can be limited in total and per repo
+    (0 meaning unlimited).  A new job for a full queue replaces the
+    newest of the lowest priority jobs that rank below it, if there is
+    one, and is refused otherwise.
+
+    Runnable jobs are handed out oldest first, unless a scheduling
+    ``policy`` such as ShortestJobFirst is given to rank them.
+
+    Jobs belong to a lane (see ``ActionCall.lane``).  The depth limits
+    only apply to the webhook lane, while other lanes can be limited
+    in how many of their jobs run at the same time, and to only run
+    while no job of another lane is waiting or running.  Jobs submitted
+    as part of a batch are tracked so the progress of the batch can be
+    reported, for the ``KEEP_FINISHED_BATCHES`` most recently finished
+    batches once they are done.
+
+    Only one job per repo is handed out at a time, a job for a repo
+    with a running job waits until that job is done.  Jobs of a repo
+    can also be held back from the outside, e.g. while its push is
+    being prefetched.
+    """
+    # pylint: disable=R0902
+    QUEUED = 'queued'
+    MERGED = 'merged'
+    KEEP_FINISHED_BATCHES = 100
+
+    def __init__(self, max_depth=0, max_repo_depth=0, retry_after=60, policy=None):
+        """
+        Setup empty queue with its depth limits and scheduling policy
+        """
+        self.max_depth = max_depth
+        self.max_repo_depth = max_repo_depth
+        self.retry_after = retry_after
+        self.policy = policy
+        self._condition = threading.Condition()
+        self._pending = OrderedDict()
+        self._running = {}
+        self._unfinished = 0
+        self._lane_limits = {}
+        self._idle_lanes = set()
+        self._lane_running = Counter()
+        self._batches = {}
+        # Finished batches, least recently finished first
+        self._finished_batches = OrderedDict()
+        self._metrics = Counter()
+        self._held = Counter()
+        # Bumped whenever jobs are added, handed out or finished
+        self._version = 0
+
+    def set_lane_limit(self, lane, limit, idle_only=False):
+        """
+        Run at most ``limit`` jobs of ``lane`` at the same time, and if
+        ``idle_only`` is set only while the other lanes are idle.
+        """
+        with self._condition:
+            self._lane_limits[lane] = limit
+            if idle_only:
+                self._idle_lanes.add(lane)
+            else:
+                self._idle_lanes.discard(lane)
+            self._condition.notify_all()
+
+    def _make_room(self, action_call):
+        """
+        Find the waiting jobs to shed so ``action_call`` fits within the
+        depth limits, raising ``QueueFullError`` if it can't.
+        """
+        victims = []
+        if action_call.lane != action_call.LANES['WEBHOOK']:
+            return victims
+        for limit, repo_only in ((self.max_repo_depth, True), (self.max_depth, False)):
+            jobs = [
+                job for job in self._pending.values()
+                if job not in victims and job.action_call.lane == action_call.lane and (
+                    not repo_only or job.action_call.repo_name == action_call.repo_name
+                )
+            ]
+            if not limit or len(jobs) < limit:
+                continue
+            candidates = [
+                job for job in reversed(jobs)
+                if job.action_call.priority < action_call.priority
+            ]
+            if not candidates:
+                raise QueueFullError(self.retry_after)
+            victims.append(min(candidates, key=lambda job: job.action_call.priority))
+        return victims
+
+    def put(self, action_call, debounce=0, max_delay=None, expected=None):
+        """
+        Add a job, expected to run for ``expected`` seconds if known.
+        Returns ``JobQueue.MERGED`` if it was folded into a waiting job
+        and ``JobQueue.QUEUED`` otherwise, along with the list of lower
+        priority action calls shed to make room for it.
+        """
+        with self._condition:
+            status, shed, job = self._add(action_call, debounce, max_delay, expected)
+            batch_id = action_call.kwargs.get('batch')
+            if batch_id and batch_id not in job.batches:
+                self._finished_batches.pop(batch_id, None)
+                batch = self._batches.setdefault(batch_id, {'total': 0, 'done': 0})
+                batch['total'] += 1
+                job.batches.add(batch_id)
+        return status, shed
+
+    def _add(self, action_call, debounce, max_delay, expected):
+        """
+        Add or merge the job of ``put``, returning its status, the shed
+        action calls and the pending job.
+        """
+        now = time.monotonic()
+        shed = []
+        with self._condition:
+            job = self._pending.get(action_call.key)
+            if job:
+                # Keep the more important of the two equivalent jobs
+                if action_call.priority >= job.action_call.priority:
+                    action_call.job_id = job.action_call.job_id
+                    job.action_call = action_call
+                status = self.MERGED
+            else:
+                for victim in self._make_room(action_call):
+                    del self._pending[victim.action_call.key]
+                    self._unfinished -= 1
+                    shed.append(victim.action_call)
+                job = PendingJob(action_call, now)
+                self._pending[action_call.key] = job
+                self._unfinished += 1
+                status = self.QUEUED
+            job.schedule(now, debounce, max_delay)
+            job.expected = expected
+            self._version += 1
+            self._condition.notify_all()
+        return status, shed, job
+
+    def retry(self, action_call, delay):
+        """
+        Queue a failed job again to run in ``delay`` seconds, unless a
+        job for the same repo and action is waiting, as that one will
+        do the work.  Returns ``JobQueue.MERGED`` in that case and
+        ``JobQueue.QUEUED`` otherwise.  Retries don't shed other jobs,
+        ``QueueFullError`` is raised if there is no room for one.  The
+        waiting job takes over the batches of the failed run instead of
+        counting again toward them.
+        """
+        with self._condition:
+            job = self._pending.get(action_call.key)
+            status = self.MERGED
+            if job is None:
+                if self._make_room(action_call):
+                    raise QueueFullError(self.retry_after)
+                job = self._add(action_call, delay, None, None)[2]
+                status = self.QUEUED
+            for running in self._running.values():
+                if running.action_call.key == action_call.key:
+                    job.batches |= running.batches
+                    running.batches = set()
+            return status
+
+    def _lane_full(self, lane):
+        """
+        Whether ``lane`` already runs as many jobs as it may
+        """
+        limit = self._lane_limits.get(lane)
+        return limit is not None and self._lane_running[lane] >= limit
+
+    def _busy(self):
+        """
+        Whether any job outside the idle only lanes is waiting or running
+        """
+        return any(
+            job.action_call.lane not in self._idle_lanes
+            for job in itertools.chain(self._pending.values(), self._running.values())
+        )
+
+    def _next_ready(self, now):
+        """
+        Return the job to hand out next of those runnable at ``now``,
+        if any.
+        """
+        busy_repos = {job.action_call.repo_name for job in self._running.values()}
+        busy = self._busy()
+        ready = [
+            job for job in self._pending.values()
+            if job.ready_at <= now
+            and job.action_call.repo_name not in busy_repos
+            and job.action_call.repo_name not in self._held
+            and not self._lane_full(job.action_call.lane)
+            and not (busy and job.action_call.lane in self._idle_lanes)
+        ]
+        if not ready:
+            return None
+        if self.policy is None:
+            return ready[0]
+        return min(ready, key=lambda job: self.policy.rank(job, now))
+
+    def get(self, block=True, timeout=None):
+        """
+        Remove and return the next runnable ActionCall, waiting for one
+        if ``block`` is set.  Raises ``queue.Empty`` when nothing became
+        runnable in time.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                job = self._next_ready(now)
+                if job:
+                    del self._pending[job.action_call.key]
+                    job.started = now
+                    self._running[job.action_call.job_id] = job
+                    self._lane_running[job.action_call.lane] += 1
+                    self._version += 1
+                    return job.action_call
+                if not block or (deadline is not None and now >= deadline):
+                    raise Empty
+                # Jobs held back by lane limits, busy repos or busy
+                # lanes wait for a notify from task_done, the rest until
+                # they become ready.
+                waits = [
+                    pending.ready_at - now for pending in self._pending.values()
+                    if pending.ready_at > now
+                ]
+                if deadline is not None:
+                    waits.append(deadline - now)
+                self._condition.wait(min(waits) if waits else None)
+
+    def task_done(self, action_call=None):
+        """
+        Indicate that a job taken with ``get`` is complete.  Passing
+        the job's ``action_call`` frees its lane slot and updates the
+        progress of its batches.
+        """
+        with self._condition:
+            if self._unfinished <= 0:
+                raise ValueError('task_done() called too many times')
+            self._unfinished -= 1
+            self._version += 1
+            job = self._running.pop(getattr(action_call, 'job_id', None), None)
+            if job:
+                self._lane_running[job.action_call.lane] -= 1
+                for batch_id in job.batches:
+                    self._finish_batch_job(batch_id)
+            self._condition.notify_all()
+
+    def _finish_batch_job(self, batch_id):
+        """
+        Count a completed job of a batch, and forget the least recently
+        finished batches beyond ``KEEP_FINISHED_BATCHES`` once it is done.
+        """
+        batch = self._batches[batch_id]
+        batch['done'] += 1
+        if batch['done'] < batch['total']:
+            return
+        self._finished_batches[batch_id] = True
+        while len(self._finished_batches) > self.KEEP_FINISHED_BATCHES:
+            del self._batches[self._finished_batches.popitem(last=False)[0]]
+
+    def hold(self, repo_name):
+        """
+        Keep the jobs of ``repo_name`` from being handed out until
+        ``release`` is called as often as ``hold``
+        """
+        with self._condition:
+            self._held[repo_name] += 1
+
+    def release(self, repo_name):
+        """
+        Take back one hold on the jobs of ``repo_name``
+        """
+        with self._condition:
+            self._held[repo_name] -= 1
+            if self._held[repo_name] <= 0:
+                del self._held[repo_name]
+                self._condition.notify_all()
+
+    def batch_progress(self, batch_id):
+        """
+        Total and completed job counts of a batch, or None if there is
+        no such batch.
+        """
+        with self._condition:
+            batch = self._batches.get(batch_id)
+            if batch is None:
+                return None
+            return dict(batch, pending=batch['total'] - batch['done'])
+
+    def add_metrics(self, counts):
+        """
+        Add counters drained from a worker to the totals
+        """
+        with self._condition:
+            self._metrics.update(counts)
+
+    def metrics(self):
+        """
+        Totals of all counters reported so far
+        """
+        with self._condition:
+            return dict(self._metrics)
+
+    def version(self):
+        """
+        Number changing whenever the queued or running jobs change
+        """
+        with self._condition:
+            return self._version
+
+    def oldest_age(self, lane=None):
+        """
+        Seconds since the first push of the oldest waiting job of
+        ``lane``, or of any lane, None if there is none
+        """
+        with self._condition:
+            pushes = [
+                job.first_push for job in self._pending.values()
+                if lane is None or job.action_call.lane == lane
+            ]
+            return time.monotonic() - min(pushes) if pushes else None
+
+    def running_ids(self):
+        """
+        Job ids of the jobs being run, oldest first
+        """
+        with self._condition:
+            return list(self._running)
+
+    def qsize(self):
+        """
+        Number of jobs waiting to be handed out.
+        """
+        with self._condition:
+            return len(self._pending)
+
+
+class QueueManager(SyncManager):
+    """
+    Multiprocessing manager that can also host a JobQueue
+    """
+
+
+QueueManager.register('JobQueue', JobQueue)  # pylint: disable=E1101
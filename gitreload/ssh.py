@@ -0,0 +1,118 @@
+"""
+SSH connection multiplexing for the git commands gitreload spawns, so
+fetches reuse an already authenticated connection instead of doing a
+full handshake every time.
+"""
+import logging
+import os
+import re
+import shlex
+import socket
+from urllib.parse import urlparse
+
+from gitreload import config, metrics
+
+log = logging.getLogger('gitreload')  # pylint: disable=C0103
+
+SCP_URL_RE = re.compile(r'^(?:(?P<user>[^@/]+)@)?(?P<host>[^:/]+):(?!//)')
+
+
+def control_dir():
+    """
+    Directory holding the ssh control sockets
+    """
+    return os.path.join(config.Config.RUNTIME_DIR, 'ssh')
+
+
+def ssh_command():
+    """
+    ssh command line for ``GIT_SSH_COMMAND`` that shares a master
+    connection per user, host and port.
+    """
+    base = os.environ.get('GIT_SSH_COMMAND', 'ssh')
+    return ' '.join([
+        base,
+        '-o ControlMaster=auto',
+        '-o {0}'.format(shlex.quote('ControlPath={0}/%r@%h:%p'.format(control_dir()))),
+        '-o ControlPersist={0}'.format(config.Config.SSH_CONTROL_PERSIST),
+        config.Config.SSH_OPTIONS,
+    ]).strip()
+
+
+def socket_path(url):
+    """
+    Path of the control socket that would be used for ``url``, or None
+    if it isn't an ssh URL.
+    """
+    parsed = urlparse(url)
+    if parsed.scheme in ('ssh', 'git+ssh'):
+        user, host, port = parsed.username, parsed.hostname, parsed.port
+    elif not parsed.scheme or len(parsed.scheme) == 1:
+        match = SCP_URL_RE.match(url)
+        if not match:
+            return None
+        user, host, port = match.group('user'), match.group('host'), None
+    else:
+        return None
+    return os.path.join(control_dir(), '{0}@{1}:{2}'.format(
+        user or os.environ.get('USER', ''), host, port or 22
+    ))
+
+
+def is_live(path):
+    """
+    Whether a master connection is listening on the socket at ``path``
+    """
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except OSError:
+        return False
+    finally:
+        probe.close()
+    return True
+
+
+def cleanup_stale_sockets():
+    """
+    Remove control sockets whose master connection has gone away,
+    returning how many were removed.
+    """
+    try:
+        names = os.listdir(control_dir())
+    except OSError:
+        return 0
+    removed = 0
+    for name in names:
+        path = os.path.join(control_dir(), name)
+        if not is_live(path):
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            removed += 1
+    if removed:
+        log.info('Removed %s stale ssh control sockets', removed)
+        metrics.incr('ssh_stale_sockets_removed', removed)
+    return removed
+
+
+def git_environment(url):
+    """
+    Environment variables for a git command talking to ``url``.  Empty
+    unless multiplexing is enabled with ``SSH_CONTROL_PERSIST``.  Counts
+    whether an ssh connection to the URL's host will be reused.
+    """
+    if not config.Config.SSH_CONTROL_PERSIST:
+        return {}
+    os.makedirs(control_dir(), mode=0o700, exist_ok=True)
+    path = socket_path(url)
+    if path:
+        if is_live(path):
+            metrics.incr('ssh_connections_reused')
+        else:
+            if os.path.exists(path):
+                os.remove(path)
+                metrics.incr('ssh_stale_sockets_removed')
+            metrics.incr('ssh_connections_new')
+    return {'GIT_SSH_COMMAND': ssh_command()}
@@ -0,0 +1,49 @@
+"""
+Helpers for small state files shared between worker processes.
+"""
+import fcntl
+import os
+import tempfile
+from contextlib import contextmanager
+
+
+@contextmanager
+def locked(path):
+    """
+    Hold an exclusive advisory lock for the state file at ``path`` for
+    the duration of the block.
+    """
+    with open('{0}.lock'.format(path), 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def try_lock(path):
+    """
+    Take an exclusive advisory lock on ``path`` without waiting,
+    returning the open lock file that holds it until closed, or None
+    if another process holds it.
+    """
+    lock_file = open(path, 'w')  # pylint: disable=R1732
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock_file.close()
+        return None
+    return lock_file
+
+
+def write_atomic(path, content):
+    """
+    Replace the file at ``path`` with ``content`` so readers never
+    see a partially written file.
+    """
+    handle, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(path))
+    )
+    with os.fdopen(handle, 'w') as state_file:
+        state_file.write(content)
+    os.replace(tmp_path, path)
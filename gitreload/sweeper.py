@@ -0,0 +1,47 @@
+"""
+Base of the background threads sweeping the checkouts at a fixed
+interval, like the reconciler and the maintainer.
+"""
+import logging
+import threading
+
+log = logging.getLogger('gitreload')  # pylint: disable=C0103
+
+
+class Sweeper(threading.Thread):
+    """
+    Daemon thread running ``sweep`` every ``interval`` seconds, handing
+    the actions it finds to ``submit``
+    """
+
+    def __init__(self, name, submit, interval):
+        """
+        Setup sweeper thread ``name`` handing actions to ``submit``
+        """
+        super().__init__(name=name)
+        self.daemon = True
+        self.submit = submit
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):  # pragma: no cover due to threading
+        """
+        Sweep until stopped
+        """
+        while not self.stopped.wait(self.interval):
+            try:
+                self.sweep()
+            except Exception:  # pylint: disable=W0703
+                log.exception('%s sweep failed', self.name)
+
+    def sweep(self):
+        """
+        Run one sweep, returning the actions submitted
+        """
+        raise NotImplementedError
+
+    def stop(self):
+        """
+        Stop sweeping after the current sweep
+        """
+        self.stopped.set()
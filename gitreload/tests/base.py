@@ -3,13 +3,40 @@ Define a base classes for testing
 """
 # pylint: disable=import-outside-toplevel
 import os
-from multiprocessing import JoinableQueue
+import tempfile
 import unittest
 
+import mock
+
 TEST_ROOT = os.path.join(os.path.dirname(__file__), 'data')
 
 
-class GitreloadTestBase(unittest.TestCase):
+class GitreloadTestCase(unittest.TestCase):
+    """
+    Test case with helpers for configuration and scratch directories
+    """
+    # pylint: disable=R0904
+
+    def patch_config(self, **settings):
+        """
+        Override ``Config`` settings until the test is over
+        """
+        for name, value in settings.items():
+            patcher = mock.patch('gitreload.config.Config.{0}'.format(name), value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def make_tmpdir(self, **kwargs):
+        """
+        Path of a temporary directory removed when the test is over,
+        ``kwargs`` are passed on to ``tempfile.TemporaryDirectory``
+        """
+        tmpdir = tempfile.TemporaryDirectory(**kwargs)
+        self.addCleanup(tmpdir.cleanup)
+        return tmpdir.name
+
+
+class GitreloadTestBase(GitreloadTestCase):
     """
     Base class for common functionality needed across modules to be
     tested.
@@ -35,6 +62,6 @@ class GitreloadTestBase(unittest.TestCase):
         # asser that they are dead
         for worker in workers:
             self.assertFalse(worker.is_alive())
-        # Recreate queue to correct corruption from terminate()
+        # Recreate queue as terminated workers may still be waiting on it
         import gitreload.web
-        gitreload.web.queue = JoinableQueue()
+        gitreload.web.get_backend().queue = gitreload.web.make_queue()
@@ -0,0 +1,56 @@
+"""
+Tests for the admin command line client
+"""
+import io
+import json
+import unittest
+from contextlib import redirect_stdout
+from urllib.error import HTTPError
+
+import mock
+
+from gitreload.admin import main
+
+
+class TestAdmin(unittest.TestCase):
+    """
+    Make sure the client calls the admin endpoints
+    """
+    # pylint: disable=R0904
+
+    @mock.patch('gitreload.admin.urlopen')
+    def test_refresh(self, urlopen):
+        """
+        refresh posts the action and pattern with the admin token
+        """
+        urlopen.return_value.__enter__.return_value.read.return_value = \
+            b'{"batch_id": "abc", "total": 2, "done": 0, "pending": 2}'
+        output = io.StringIO()
+        with redirect_stdout(output):
+            exit_code = main(['--url', 'http://gr:5000/', '--token', 'sekrit',
+                              'refresh', '--pattern', 'course-*'])
+        self.assertEqual(exit_code, 0)
+        self.assertEqual(json.loads(output.getvalue())['batch_id'], 'abc')
+
+        request = urlopen.call_args[0][0]
+        self.assertEqual(request.full_url, 'http://gr:5000/refresh')
+        self.assertEqual(request.get_header('Authorization'), 'Bearer sekrit')
+        self.assertEqual(json.loads(request.data.decode('utf-8')),
+                         {'action': 'GET_LATEST', 'pattern': 'course-*'})
+
+    @mock.patch('gitreload.admin.urlopen')
+    def test_status_error(self, urlopen):
+        """
+        Errors from the server are shown and fail the command
+        """
+        urlopen.side_effect = HTTPError(
+            'http://localhost:5000/refresh/abc', 403, 'Forbidden', {},
+            io.BytesIO(b'{"msg": "Not authorized"}')
+        )
+        output = io.StringIO()
+        with redirect_stdout(output):
+            exit_code = main(['status', 'abc'])
+        self.assertEqual(exit_code, 1)
+        self.assertEqual(json.loads(output.getvalue()), {'msg': 'Not authorized'})
+        self.assertEqual(urlopen.call_args[0][0].full_url,
+                         'http://localhost:5000/refresh/abc')
@@ -0,0 +1,134 @@
+"""
+Tests for the ASGI webhook receiver
+"""
+import asyncio
+import json
+import os
+import threading
+
+import mock
+from git import Repo
+
+import gitreload.web
+from gitreload.asgi import app
+from gitreload.tests.base import GitreloadTestBase
+
+
+class TestAsgiApplication(GitreloadTestBase):
+    """
+    Exercise the ASGI receiver the way a server would call it
+    """
+
+    def setUp(self):
+        """
+        Create a checkout to push to
+        """
+        super().setUp()
+        self.tmpdir = self.make_tmpdir()
+        repo = Repo.init(os.path.join(self.tmpdir, 'test'), bare=False)
+        repo.create_remote('origin', 'http://example.com/test/test.git')
+        self.patch_config(REPODIR=self.tmpdir)
+
+    @classmethod
+    def _call(cls, method, path, body=b'', headers=()):
+        """
+        Send a request through the ASGI app, with the body split in two
+        chunks, and return the status and whole body of the response.
+        """
+        messages = [
+            {'type': 'http.request', 'body': body[:5], 'more_body': True},
+            {'type': 'http.request', 'body': body[5:], 'more_body': False},
+        ]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message)
+
+        path, _, query = path.partition('?')
+        scope = {
+            'type': 'http',
+            'method': method,
+            'path': path,
+            'query_string': query.encode(),
+            'headers': [(name.encode(), value.encode()) for name, value in headers],
+        }
+        asyncio.get_event_loop().run_until_complete(app(scope, receive, send))
+        return sent[0]['status'], b''.join(message['body'] for message in sent[1:])
+
+    def test_push(self):
+        """
+        A push to the checked out branch is queued, others are not
+        """
+        payload = json.dumps({
+            'ref': 'refs/heads/master',
+            'repository': {'name': 'test', 'owner': {'name': 'testuser'}},
+        }).encode('utf-8')
+        headers = [('X-Github-Event', 'push'), ('Content-Type', 'application/json')]
+        status, body = self._call('POST', '/update', payload, headers)
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body)['msg'],
+                         'Added git update task to queue. Queue size was 1')
+        action = gitreload.web.queue.get(timeout=1)
+        self.assertEqual(
+            (action.repo_name, action.repo_url, action.action_text),
+            ('test', 'http://example.com/test/test.git', 'GET_LATEST')
+        )
+
+        status, body = self._call('GET', '/queue')
+        self.assertEqual(json.loads(body)['queue_length'], 1)
+        status, body = self._call('GET', '/queue?state=running&format=ndjson')
+        self.assertEqual(json.loads(body.splitlines()[0])['repo_name'], 'test')
+        etag = '"{0}"'.format(gitreload.web.queue_etag({'state': 'running'}))
+        status, body = self._call('GET', '/queue?state=running', headers=[('If-None-Match', etag)])
+        self.assertEqual((status, body), (304, b''))
+        gitreload.web.queued_jobs.pop()
+        gitreload.web.queue.task_done(action)
+
+        status, body = self._call(
+            'POST', '/', payload.replace(b'master', b'feature'), headers
+        )
+        self.assertEqual(json.loads(body)['msg'],
+                         "Branch pushed doesn't match local branch, ignoring")
+
+    def test_errors(self):
+        """
+        Other events, methods, paths and oversized bodies are turned away
+        """
+        status, body = self._call('POST', '/', headers=[('X-Github-Event', 'ping')])
+        self.assertEqual((status, json.loads(body)['msg']), (200, 'pong'))
+        self.assertEqual(self._call('GET', '/')[0], 405)
+        self.assertEqual(self._call('POST', '/queue')[0], 405)
+        self.assertEqual(self._call('GET', '/nope')[0], 404)
+        self.assertEqual(self._call('GET', '/healthz')[0], 200)
+        with mock.patch('gitreload.config.Config.MAX_PAYLOAD_BYTES', 8):
+            status = self._call('POST', '/', b'x' * 10, [('X-Github-Event', 'push')])[0]
+        self.assertEqual(status, 413)
+
+    def test_probes_off_loop(self):
+        """
+        Probes are answered in the thread pool, not on the event loop
+        """
+        for path, handler in (('/healthz', 'liveness_response'), ('/readyz', 'readiness_response')):
+            with mock.patch('gitreload.web.{0}'.format(handler),
+                            side_effect=lambda: threading.current_thread().name):
+                status, body = self._call('GET', path)
+            self.assertEqual(status, 200)
+            self.assertTrue(body.startswith(b'gitreload-asgi'))
+
+    def test_stream_off_loop(self):
+        """
+        Streamed bodies are produced in the thread pool, not on the
+        event loop
+        """
+        def rows():
+            """Name the thread producing the row"""
+            yield threading.current_thread().name
+
+        with mock.patch('gitreload.web.queue_response',
+                        return_value=gitreload.web.Response(rows(), mimetype=gitreload.web.NDJSON)):
+            status, body = self._call('GET', '/queue?format=ndjson')
+        self.assertEqual(status, 200)
+        self.assertTrue(body.startswith(b'gitreload-asgi'))
@@ -0,0 +1,114 @@
+"""
+Tests for sharding repos over a cluster of nodes
+"""
+import json
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import mock
+
+from gitreload import cluster
+
+
+class RecordingHandler(BaseHTTPRequestHandler):
+    """
+    Stand in for a peer node, answering like a gitreload instance
+    """
+    requests = []
+
+    def do_POST(self):  # pylint: disable=C0103
+        """
+        Record the forwarded hook and accept it
+        """
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.requests.append((self.path, dict(self.headers), body))
+        self.send_response(202)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(b'{"msg": "merged"}')
+
+    def do_GET(self):  # pylint: disable=C0103
+        """
+        Report a queue with one job
+        """
+        self.send_response(200)
+        self.end_headers()
+        self.wfile.write(json.dumps({
+            'queue_length': 1, 'queue': [{'repo_name': 'other', 'path': self.path}]
+        }).encode('utf-8'))
+
+    def log_message(self, *args):  # pylint: disable=W0221
+        """
+        Keep the test output quiet
+        """
+
+
+class TestCluster(unittest.TestCase):
+    """
+    Make sure repos are spread with minimal movement and hooks reach
+    their owner
+    """
+
+    PEERS = ['http://node{0}:5000'.format(index) for index in range(3)]
+
+    def test_ring(self):
+        """
+        Every node gets a share, and adding a node only moves repos to
+        the new node.
+        """
+        keys = ['repo{0}'.format(index) for index in range(2000)]
+        ring = cluster.HashRing(self.PEERS, 64)
+        owners = {key: ring.owner(key) for key in keys}
+        for peer in self.PEERS:
+            self.assertGreater(list(owners.values()).count(peer), 400)
+
+        bigger = cluster.HashRing(self.PEERS + ['http://node3:5000'], 64)
+        moved = [key for key in keys if bigger.owner(key) != owners[key]]
+        self.assertTrue(all(bigger.owner(key) == 'http://node3:5000' for key in moved))
+        self.assertLess(len(moved), len(keys) * 0.4)
+        self.assertIsNone(cluster.HashRing([], 64).owner('repo'))
+
+    def test_owner(self):
+        """
+        Repos owned by this node, or by no cluster, are handled here
+        """
+        self.assertIsNone(cluster.owner('repo'))
+        with mock.patch('gitreload.config.Config.CLUSTER_PEERS', self.PEERS):
+            owners = set()
+            for self_url in self.PEERS:
+                with mock.patch('gitreload.config.Config.CLUSTER_SELF', self_url):
+                    owners.add(cluster.owner('repo'))
+        self.assertEqual(len(owners), 2)
+        self.assertIn(None, owners)
+
+    def test_forward(self):
+        """
+        Hooks are posted to the peer marked as forwarded, and peer
+        queues are collected.
+        """
+        server = HTTPServer(('127.0.0.1', 0), RecordingHandler)
+        self.addCleanup(server.server_close)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(server.shutdown)
+        peer = 'http://127.0.0.1:{0}'.format(server.server_port)
+
+        with mock.patch('gitreload.config.Config.CLUSTER_SELF', 'http://me:5000'):
+            status, headers, body = cluster.forward(
+                peer, '/update?force=1', b'{"a": 1}', {'X-Github-Event': 'push'}
+            )
+        self.assertEqual((status, headers['Content-Type'], body),
+                         (202, 'application/json', b'{"msg": "merged"}'))
+        path, sent_headers, sent_body = RecordingHandler.requests[-1]
+        self.assertEqual((path, sent_body), ('/update?force=1', b'{"a": 1}'))
+        self.assertEqual(sent_headers[cluster.FORWARDED_HEADER], 'http://me:5000')
+
+        with mock.patch('gitreload.config.Config.CLUSTER_PEERS',
+                        ['http://me:5000', peer, 'http://127.0.0.1:1']), \
+                mock.patch('gitreload.config.Config.CLUSTER_SELF', 'http://me:5000'):
+            queues = cluster.peer_queues()
+        self.assertEqual(queues[peer]['queue'][0]['path'], '/queue?local=1')
+        self.assertIsNone(queues['http://127.0.0.1:1'])
+        self.assertNotIn('http://me:5000', queues)
@@ -4,6 +4,8 @@ Unit tests to validate configuration loading
 # pylint: disable=import-outside-toplevel
 
 import logging
+import os
+import tempfile
 import unittest
 import mock
 
@@ -77,3 +79,68 @@ class TestLogConfiguration(unittest.TestCase):
         from gitreload.config import configure_logging
         log_level = configure_logging()
         self.assertEqual(logging.NOTSET, log_level)
+
+    def test_log_file_once(self):
+        """
+        Configuring logging again doesn't add another handler for the
+        log file, so lines aren't written to it twice.
+        """
+        from gitreload.config import configure_logging
+        root_logger = logging.getLogger()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            log_file = os.path.join(tmpdir, 'gitreload.log')
+            with mock.patch('gitreload.config.Config.LOG_FILE_PATH', log_file):
+                configure_logging()
+                configure_logging(logging.INFO)
+            handlers = [
+                handler for handler in root_logger.handlers
+                if getattr(handler, 'baseFilename', None) == log_file
+            ]
+            for handler in handlers:
+                root_logger.removeHandler(handler)
+                handler.close()
+        self.assertEqual(len(handlers), 1)
+
+
+class TestSettings(unittest.TestCase):
+    """
+    Make sure structured settings are read from the environment
+    """
+
+    def test_json_setting(self):
+        """
+        JSON settings are given inline or in a file, and ignored if
+        they are neither.
+        """
+        from gitreload.config import json_setting
+        with mock.patch.dict('os.environ', {'LINKED_REPOS': ''}):
+            self.assertEqual(json_setting('LINKED_REPOS', {}), {})
+        with mock.patch.dict('os.environ', {'LINKED_REPOS': '{"course": ["library"]}'}):
+            self.assertEqual(json_setting('LINKED_REPOS', {}), {'course': ['library']})
+        with tempfile.NamedTemporaryFile('w', suffix='.json') as setting_file:
+            setting_file.write('{"course": {"assets": "git@example.com:assets.git"}}')
+            setting_file.flush()
+            with mock.patch.dict('os.environ', {'ALSO_CLONE_REPOS': setting_file.name}):
+                self.assertEqual(
+                    json_setting('ALSO_CLONE_REPOS', {}),
+                    {'course': {'assets': 'git@example.com:assets.git'}}
+                )
+        for value in ('{"course": [', '/nonexistent.json'):
+            with mock.patch.dict('os.environ', {'LINKED_REPOS': value}):
+                self.assertEqual(json_setting('LINKED_REPOS', {}), {})
+
+    def test_malformed_settings(self):
+        """
+        Malformed JSON settings leave their default instead of breaking
+        the import of the configuration.
+        """
+        import subprocess
+        import sys
+
+        output = subprocess.check_output([
+            sys.executable, '-c',
+            'from gitreload.config import Config; '
+            'print(Config.DEBOUNCE_OVERRIDES, Config.CLUSTER_PEERS)'
+        ], env=dict(os.environ, DEBOUNCE_OVERRIDES='{"course":', CLUSTER_PEERS='["http://a"]'),
+            stderr=subprocess.DEVNULL)
+        self.assertEqual(output.strip(), b"{} ['http://a']")
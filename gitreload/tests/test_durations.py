@@ -0,0 +1,66 @@
+"""
+Tests for the job duration history
+"""
+import os
+
+import mock
+
+from gitreload.durations import DurationHistory
+from gitreload.processing import ActionCall
+from gitreload.tests.base import GitreloadTestCase
+
+
+class TestDurationHistory(GitreloadTestCase):
+    """
+    Validate duration averages and the timeouts derived from them
+    """
+    # pylint: disable=R0904
+
+    def setUp(self):
+        """
+        Create a scratch directory to hold the history
+        """
+        self.tmpdir = self.make_tmpdir()
+        self.history = DurationHistory(os.path.join(self.tmpdir, 'durations'), 0.5)
+        self.action_call = ActionCall(
+            'course', 'NOTREAL', ActionCall.ACTION_TYPES['COURSE_IMPORT']
+        )
+
+    def test_moving_average(self):
+        """
+        Durations are averaged per repo and action
+        """
+        self.assertIsNone(self.history.estimate(self.action_call))
+        self.history.record(self.action_call, 100)
+        self.assertEqual(self.history.estimate(self.action_call), 100)
+        self.history.record(self.action_call, 200)
+        self.assertEqual(self.history.estimate(self.action_call), 150)
+        self.assertIsNone(self.history.estimate(ActionCall(
+            'course', 'NOTREAL', ActionCall.ACTION_TYPES['GET_LATEST']
+        )))
+
+    def test_disabled(self):
+        """
+        Without a path nothing is recorded
+        """
+        history = DurationHistory('', 0.5)
+        history.record(self.action_call, 100)
+        self.assertIsNone(history.estimate(self.action_call))
+
+    @mock.patch('gitreload.config.Config.SUBPROCESS_TIMEOUT', 3600)
+    @mock.patch('gitreload.config.Config.ADAPTIVE_TIMEOUT_MIN', 600)
+    @mock.patch('gitreload.config.Config.ADAPTIVE_TIMEOUT_FACTOR', 3)
+    def test_timeout(self):
+        """
+        Timeouts scale with the expected duration between the floor
+        and the global timeout.
+        """
+        self.assertEqual(self.history.timeout(self.action_call), 3600)
+        self.history.record(self.action_call, 20)
+        self.assertEqual(self.history.timeout(self.action_call), 600)
+        self.history.record(self.action_call, 580)
+        self.assertEqual(self.history.timeout(self.action_call), 900)
+        self.history.record(self.action_call, 5000)
+        self.assertEqual(self.history.timeout(self.action_call), 3600)
+        with mock.patch('gitreload.config.Config.ADAPTIVE_TIMEOUT_FACTOR', 0):
+            self.assertEqual(self.history.timeout(self.action_call), 3600)
@@ -0,0 +1,79 @@
+"""
+Tests for the health checks behind the readiness probe
+"""
+import mock
+
+from gitreload.health import HealthMonitor, check_readiness
+from gitreload.processing import ActionCall
+from gitreload.scheduler import JobQueue
+from gitreload.tests.base import GitreloadTestCase
+
+
+class TestHealth(GitreloadTestCase):
+    """
+    Make sure readiness reflects the workers, queue and REPODIR
+    """
+
+    def setUp(self):
+        """
+        Monitor a backend with one live and one dead worker
+        """
+        self.patch_config(REPODIR=self.make_tmpdir(), READY_MIN_WORKERS=1, READY_MAX_JOB_AGE=60)
+        patcher = mock.patch('gitreload.scheduler.time.monotonic', return_value=1000.0)
+        self.monotonic = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.backend = mock.Mock(
+            workers=[mock.Mock(**{'is_alive.return_value': alive}) for alive in (True, False)],
+            queue=JobQueue(),
+        )
+        self.monitor = HealthMonitor(self.backend, 5)
+
+    def test_ready(self):
+        """
+        The backend is ready with enough live workers, a fresh queue
+        and a usable REPODIR.
+        """
+        self.assertEqual(self.monitor.readiness(), {'ready': False, 'reason': 'not checked yet'})
+        self.backend.queue.put(ActionCall('course', 'NOTREAL', 0))
+        self.monotonic.return_value = 1030.0
+        self.monitor.refresh()
+        readiness = self.monitor.readiness()
+        self.assertTrue(readiness['ready'])
+        self.assertEqual(readiness['checks']['workers'], {'ok': True, 'alive': 1, 'total': 2})
+        self.assertEqual(readiness['checks']['queue']['oldest_job_age'], 30.0)
+
+    def test_not_ready(self):
+        """
+        Dead workers, old jobs, a missing REPODIR, an unreachable queue
+        or stale results make the backend unready.
+        """
+        self.backend.queue.put(ActionCall('course', 'NOTREAL', 0))
+        self.monotonic.return_value = 1061.0
+        with mock.patch('gitreload.config.Config.READY_MIN_WORKERS', 2), \
+                mock.patch('gitreload.config.Config.REPODIR', '/nonexistent'):
+            self.monitor.refresh()
+        checks = self.monitor.readiness()['checks']
+        self.assertEqual([name for name, check in sorted(checks.items()) if not check['ok']],
+                         ['queue', 'repodir', 'workers'])
+
+        self.backend.queue = mock.Mock(**{'oldest_age.side_effect': EOFError('gone')})
+        self.monitor.refresh()
+        readiness = self.monitor.readiness()
+        self.assertFalse(readiness['ready'])
+        self.assertFalse(readiness['checks']['queue']['reachable'])
+
+        self.backend.queue = JobQueue()
+        self.monitor.refresh()
+        self.assertTrue(self.monitor.readiness()['ready'])
+        with mock.patch('gitreload.health.time.monotonic', return_value=self.monitor.results[0] + 16):
+            self.assertEqual(self.monitor.readiness()['reason'], 'checks are stale')
+
+    def test_on_demand(self):
+        """
+        Without a monitor the checks are run when readiness is asked
+        """
+        readiness = check_readiness(self.backend)
+        self.assertTrue(readiness['ready'])
+        self.assertEqual(readiness['checks']['workers']['alive'], 1)
+        with mock.patch('gitreload.config.Config.REPODIR', '/nonexistent'):
+            self.assertFalse(check_readiness(self.backend)['ready'])
@@ -0,0 +1,109 @@
+"""
+Tests for leases on checkouts shared between hosts
+"""
+import json
+import os
+import threading
+import time
+
+import mock
+from git import Repo
+
+from gitreload.lease import lease_path, leased, read_lease
+from gitreload.processing import ActionCall
+from gitreload.tests.base import GitreloadTestCase
+
+
+class TestLease(GitreloadTestCase):
+    """
+    Make sure only one host works on a checkout at a time
+    """
+
+    def setUp(self):
+        """
+        Create a checkout with two commits in a temporary REPODIR
+        """
+        tmpdir = self.make_tmpdir()
+        self.repo_dir = os.path.join(tmpdir, 'course')
+        repo = Repo.init(self.repo_dir)
+        self.old_sha = repo.index.commit('First Commit').hexsha
+        self.new_sha = repo.index.commit('Second Commit').hexsha
+        self.path = lease_path(self.repo_dir)
+        self.patch_config(REPODIR=tmpdir, LEASE_TTL=30, HOSTNAME='here')
+        patcher = mock.patch('gitreload.lease.POLL_INTERVAL', 0.05)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _action(self, sha, action_type=1):
+        """
+        Action on the checkout for ``sha``
+        """
+        return ActionCall('course', 'http://example.com/course', action_type, sha=sha)
+
+    def _other_lease(self, sha, action_type=1, expires=None):
+        """
+        Write the lease of another host
+        """
+        with open(self.path, 'w') as lease_file:
+            json.dump({'holder': 'there:1:1', 'action': action_type, 'sha': sha,
+                       'expires': expires or time.time() + 30}, lease_file)
+
+    def test_leased(self):
+        """
+        The lease records the holder and SHA while the job runs, and
+        nothing is leased when leases are off.
+        """
+        with leased(self._action(self.new_sha)) as run:
+            self.assertTrue(run)
+            lease = read_lease(self.path)
+            self.assertTrue(lease['holder'].startswith('here:{0}:'.format(os.getpid())))
+            self.assertEqual((lease['action'], lease['sha']), (1, self.new_sha))
+        self.assertFalse(os.path.exists(self.path))
+
+        with mock.patch('gitreload.config.Config.LEASE_TTL', 0):
+            with leased(self._action(self.new_sha)) as run:
+                self.assertTrue(run)
+                self.assertFalse(os.path.exists(self.path))
+
+    def test_covered(self):
+        """
+        Jobs already being done by another host for the same or a newer
+        commit are skipped, others wait for the lease.
+        """
+        self._other_lease(self.new_sha)
+        for sha in (self.old_sha, self.new_sha):
+            with leased(self._action(sha)) as run:
+                self.assertFalse(run)
+        self.assertEqual(read_lease(self.path)['holder'], 'there:1:1')
+
+        self._other_lease(self.old_sha)
+        release = threading.Timer(0.2, os.remove, (self.path,))
+        release.start()
+        started = time.monotonic()
+        with leased(self._action(self.new_sha)) as run:
+            self.assertTrue(run)
+            self.assertGreater(time.monotonic() - started, 0.15)
+        release.join()
+
+        self._other_lease(self.new_sha, action_type=0)
+        threading.Timer(0.1, os.remove, (self.path,)).start()
+        with leased(self._action(self.new_sha)) as run:
+            self.assertTrue(run)
+
+    def test_reclaim(self):
+        """
+        Expired leases of crashed holders are taken over, and live
+        leases are renewed.
+        """
+        self._other_lease(self.new_sha, expires=time.time() - 1)
+        with mock.patch('gitreload.config.Config.LEASE_TTL', 0.3):
+            with leased(self._action(self.new_sha)) as run:
+                self.assertTrue(run)
+                expires = read_lease(self.path)['expires']
+                time.sleep(0.25)
+                self.assertGreater(read_lease(self.path)['expires'], expires)
+        # Neither the stale lease nor temporary files are left behind
+        self.assertEqual(
+            [name for name in os.listdir(os.path.dirname(self.path))
+             if name.startswith(('gitreload.lease', 'tmp'))], []
+        )
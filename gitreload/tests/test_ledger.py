@@ -0,0 +1,80 @@
+"""
+Tests for the import ledger
+"""
+import os
+
+import mock
+
+from gitreload.ledger import ImportLedger
+from gitreload.tests.base import GitreloadTestCase
+
+
+class TestImportLedger(GitreloadTestCase):
+    """
+    Validate recording and lookup of imported trees
+    """
+    # pylint: disable=R0904
+
+    def setUp(self):
+        """
+        Create a scratch directory to hold the ledger
+        """
+        self.tmpdir = self.make_tmpdir()
+        self.path = os.path.join(self.tmpdir, 'ledger')
+
+    def test_record_and_contains(self):
+        """
+        Recorded trees are found per repo, and nothing else is.
+        """
+        ledger = ImportLedger(self.path, 10)
+        self.assertFalse(ledger.contains('course', 'abc'))
+        ledger.record('course', 'abc')
+        self.assertTrue(ledger.contains('course', 'abc'))
+        self.assertFalse(ledger.contains('other', 'abc'))
+        self.assertFalse(ledger.contains('course', None))
+
+    def test_revert(self):
+        """
+        Only the latest tree of a repo is skipped, going back to an
+        older one imports it again.
+        """
+        ledger = ImportLedger(self.path, 10)
+        ledger.record('course', 'one')
+        ledger.record('course', 'two')
+        self.assertFalse(ledger.contains('course', 'one'))
+        self.assertTrue(ledger.contains('course', 'two'))
+
+    def test_bounded_retention(self):
+        """
+        Only the most recently imported repos are kept, and importing
+        a repo again refreshes it.
+        """
+        ledger = ImportLedger(self.path, 2)
+        ledger.record('one', 'abc')
+        ledger.record('two', 'abc')
+        ledger.record('one', 'def')
+        ledger.record('three', 'abc')
+        self.assertTrue(ledger.contains('one', 'def'))
+        self.assertFalse(ledger.contains('two', 'abc'))
+        self.assertTrue(ledger.contains('three', 'abc'))
+        with open(self.path) as ledger_file:
+            self.assertEqual(len(ledger_file.readlines()), 2)
+
+    def test_disabled(self):
+        """
+        Without a path the ledger never matches and never writes.
+        """
+        ledger = ImportLedger('', 10)
+        ledger.record('course', 'abc')
+        self.assertFalse(ledger.contains('course', 'abc'))
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+    @mock.patch('gitreload.ledger.log')
+    def test_unreadable_ledger(self, mocked_log):
+        """
+        Ledger errors are logged and treated as a miss.
+        """
+        ledger = ImportLedger(os.path.join(self.tmpdir, 'nope', 'ledger'), 10)
+        ledger.record('course', 'abc')
+        self.assertFalse(ledger.contains('course', 'abc'))
+        self.assertEqual(mocked_log.exception.call_count, 2)
@@ -0,0 +1,92 @@
+"""
+Tests for background maintenance of checkouts
+"""
+import fcntl
+import os
+
+import mock
+from git import Repo
+
+from gitreload.maintenance import stale_checkouts, sweep
+from gitreload.processing import ActionCall, git_maintenance
+from gitreload.refs import last_maintained, maintenance_stamp
+from gitreload.tests.base import GitreloadTestCase
+
+
+class TestMaintenance(GitreloadTestCase):
+    """
+    Make sure stale checkouts get maintained, stalest first
+    """
+
+    def setUp(self):
+        """
+        Create a few checkouts in a temporary REPODIR
+        """
+        tmpdir = self.make_tmpdir()
+        self.repodir = os.path.join(tmpdir, 'repos')
+        source = Repo.init(os.path.join(tmpdir, 'source'))
+        source.index.commit('First Commit')
+        for name in ('course', 'grader', 'other'):
+            # Clone over file:// so the checkouts get packs like real clones
+            Repo.clone_from('file://{0}'.format(source.git_dir), os.path.join(self.repodir, name))
+        self.patch_config(MAINTENANCE_MIN_AGE=3600, REPODIR=self.repodir,
+                          RUNTIME_DIR=os.path.join(self.repodir, 'run'))
+
+    def _stamp(self, repo_name, mtime):
+        """
+        Mark a checkout as maintained at ``mtime``
+        """
+        path = maintenance_stamp(os.path.join(self.repodir, repo_name))
+        with open(path, 'w'):
+            pass
+        os.utime(path, (mtime, mtime))
+
+    def test_stale_checkouts(self):
+        """
+        Never maintained checkouts come first, then the stalest ones,
+        and recently maintained ones are left alone.
+        """
+        self._stamp('course', 1000)
+        self._stamp('grader', 5000)
+        self.assertEqual(stale_checkouts(now=8000), ['other', 'course'])
+
+        submit = mock.Mock()
+        with mock.patch('gitreload.maintenance.time.time', return_value=8000):
+            actions = sweep(submit)
+        self.assertEqual([action.repo_name for action in actions], ['other', 'course'])
+        self.assertEqual(actions[0].lane, ActionCall.LANES['MAINTENANCE'])
+        self.assertEqual(actions[0].action_text, 'MAINTENANCE')
+        self.assertEqual(submit.call_count, 2)
+
+    def test_git_maintenance(self):
+        """
+        Maintenance runs git maintenance in the checkout and records
+        when it did.
+        """
+        action = ActionCall('course', 'NOTREAL', ActionCall.ACTION_TYPES['MAINTENANCE'])
+        repo_dir = os.path.join(self.repodir, 'course')
+        self.assertIsNone(last_maintained(repo_dir))
+        git_maintenance(action)
+        self.assertIsNotNone(last_maintained(repo_dir))
+        self.assertTrue(os.path.isdir(
+            os.path.join(repo_dir, '.git', 'objects', 'info', 'commit-graphs')
+        ))
+
+    def test_git_maintenance_locked(self):
+        """
+        Maintenance holds the update lock of the checkout, keeping out
+        updates run outside of the checkout's jobs.
+        """
+        action = ActionCall('course', 'NOTREAL', ActionCall.ACTION_TYPES['MAINTENANCE'])
+        lock_path = os.path.join(self.repodir, 'course', '.git', 'gitreload-update.lock')
+
+        def try_lock(*_args, **_kwargs):
+            """Fail to take the update lock while maintenance runs"""
+            with open(lock_path, 'w') as lock_file:
+                with self.assertRaises(BlockingIOError):
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return ''
+
+        with mock.patch('gitreload.processing.run_command', side_effect=try_lock) as mocked:
+            git_maintenance(action)
+        self.assertTrue(mocked.called)
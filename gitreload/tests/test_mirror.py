@@ -0,0 +1,92 @@
+"""
+Tests for the local mirror tier
+"""
+import os
+
+from git import Repo
+
+from gitreload import metrics
+from gitreload.mirror import fetch_via_mirror, mirror_path
+from gitreload.processing import ActionCall, git_get_latest
+from gitreload.tests.base import GitreloadTestCase
+
+
+class TestMirror(GitreloadTestCase):
+    """
+    Make sure checkouts of one origin share a single mirror
+    """
+    # pylint: disable=R0904
+
+    def setUp(self):
+        """
+        Create a remote, a clone pushing to it and two checkouts
+        """
+        self.tmpdir = self.make_tmpdir()
+        self.repodir = os.path.join(self.tmpdir, 'repos')
+        self.mirror_dir = os.path.join(self.tmpdir, 'mirrors')
+        self.url = os.path.join(self.tmpdir, 'remote.git')
+        remote = Repo.init(self.url, bare=True)
+        self.author = remote.clone(os.path.join(self.tmpdir, 'author'))
+        self._push('First Commit')
+        self.checkouts = [
+            remote.clone(os.path.join(self.repodir, name)) for name in ('one', 'two')
+        ]
+        self.patch_config(REPODIR=self.repodir, MIRROR_DIR=self.mirror_dir)
+        metrics.drain()
+
+    def _push(self, message):
+        """
+        Push a new commit to the remote and return its SHA
+        """
+        commit = self.author.index.commit(message)
+        self.author.git.push('origin', 'HEAD')
+        return commit.hexsha
+
+    def test_mirror_path(self):
+        """
+        Mirrors are named after the repo and a hash of the URL
+        """
+        path = mirror_path('git@github.com:mitodl/course.git')
+        self.assertTrue(path.startswith(os.path.join(self.mirror_dir, 'course-')))
+        self.assertTrue(path.endswith('.git'))
+        self.assertNotEqual(path, mirror_path('git@github.com:other/course.git'))
+
+    def test_fetch_via_mirror(self):
+        """
+        The mirror is fetched once per push and checkouts fetch from it
+        and borrow its objects.
+        """
+        one, two = self.checkouts
+        fetch_via_mirror(one.working_tree_dir, self.url)
+        self.assertEqual(metrics.drain(), {'mirror_clones': 1, 'git_spawns': 2})
+        mirror = mirror_path(self.url)
+        reader = Repo(mirror).config_reader()
+        self.assertEqual(reader.get_value('gc', 'auto'), 0)
+        self.assertEqual(reader.get_value('gc', 'pruneExpire'), 'never')
+        with open(os.path.join(one.git_dir, 'objects', 'info', 'alternates')) as alternates:
+            self.assertEqual(alternates.read(), os.path.join(mirror, 'objects') + '\n')
+
+        sha = self._push('Second Commit')
+        fetch_via_mirror(one.working_tree_dir, self.url, sha)
+        fetch_via_mirror(two.working_tree_dir, self.url, sha)
+        counts = metrics.drain()
+        self.assertEqual(counts['mirror_fetches'], 1)
+        self.assertEqual(counts['mirror_fetches_skipped'], 1)
+        for checkout in self.checkouts:
+            self.assertEqual(checkout.remotes.origin.refs.master.commit.hexsha, sha)
+
+        # Linking again doesn't duplicate the alternate
+        fetch_via_mirror(one.working_tree_dir, self.url, sha)
+        with open(os.path.join(one.git_dir, 'objects', 'info', 'alternates')) as alternates:
+            self.assertEqual(len(alternates.readlines()), 1)
+
+    def test_git_get_latest(self):
+        """
+        Updates go through the mirror when it is configured
+        """
+        sha = self._push('Second Commit')
+        git_get_latest(ActionCall(
+            'one', self.url, ActionCall.ACTION_TYPES['GET_LATEST'], sha=sha
+        ))
+        self.assertEqual(self.checkouts[0].head.commit.hexsha, sha)
+        self.assertTrue(os.path.isdir(mirror_path(self.url)))
@@ -0,0 +1,69 @@
+"""
+Tests for the cheap webhook payload handling
+"""
+import json
+import unittest
+from urllib.parse import urlencode
+
+import mock
+
+from gitreload import payload
+
+
+class TestPayload(unittest.TestCase):
+    """
+    Make sure the repo and ref are found without decoding the payload
+    """
+
+    PAYLOAD = {
+        'ref': 'refs/heads/master',
+        'before': '0' * 40,
+        'commits': [{'id': 'abc', 'message': 'a "quoted" {message}', 'name': 'nope'}],
+        'repository': {
+            'id': 1,
+            'owner': {'name': 'testuser'},
+            'name': 'cöurse',
+            'html_url': 'https://github.com/testuser/course',
+            'topics': ['name', 'ref'],
+        },
+        'name': 'nope',
+    }
+
+    def test_peek(self):
+        """
+        Only the top level ref and the repository's own name match, in
+        any order.
+        """
+        text = json.dumps(self.PAYLOAD)
+        expected = ('cöurse', 'refs/heads/master', 'https://github.com/testuser/course')
+        self.assertEqual(payload.peek(text), expected)
+        reordered = json.dumps(dict(reversed(list(self.PAYLOAD.items()))))
+        self.assertEqual(payload.peek(reordered), expected)
+        self.assertEqual(payload.peek(text[:10]), (None, None, None))
+        self.assertEqual(payload.peek('what'), (None, None, None))
+
+    def test_peek_body(self):
+        """
+        Both json and form encoded bodies can be peeked into
+        """
+        text = json.dumps(self.PAYLOAD)
+        expected = ('cöurse', 'refs/heads/master', 'https://github.com/testuser/course')
+        self.assertEqual(payload.peek_body(text.encode('utf-8'), False), expected)
+        form = urlencode({'other': 'x', 'payload': text}).encode('ascii')
+        self.assertEqual(payload.peek_body(form, True), expected)
+        self.assertEqual(payload.peek_body(b'other=x', True), (None, None, None))
+
+    def test_loads(self):
+        """
+        The stdlib decoder is used when orjson is missing or turned off
+        """
+        with mock.patch('gitreload.payload.orjson', None):
+            self.assertEqual(payload.loads('{"a": 1}'), {'a': 1})
+        fake = mock.Mock()
+        with mock.patch('gitreload.payload.orjson', fake):
+            payload.loads('{}')
+            self.assertTrue(fake.loads.called)
+            fake.reset_mock()
+            with mock.patch('gitreload.config.Config.JSON_DECODER', 'json'):
+                self.assertEqual(payload.loads('{}'), {})
+            self.assertFalse(fake.loads.called)
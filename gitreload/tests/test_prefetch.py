@@ -0,0 +1,85 @@
+"""
+Tests for prefetching pushes
+"""
+import os
+
+import mock
+from git import Repo
+
+from gitreload import metrics
+from gitreload.prefetch import Prefetcher, prefetch
+from gitreload.processing import ActionCall
+from gitreload.tests.base import GitreloadTestCase
+
+
+class TestPrefetch(GitreloadTestCase):
+    """
+    Make sure pushes are fetched ahead of their jobs
+    """
+
+    def setUp(self):
+        """
+        Create a remote with a checkout in REPODIR
+        """
+        tmpdir = self.make_tmpdir()
+        repodir = os.path.join(tmpdir, 'repos')
+        self.url = os.path.join(tmpdir, 'remote.git')
+        self.author = Repo.init(self.url, bare=True).clone(os.path.join(tmpdir, 'author'))
+        self.author.index.commit('First Commit')
+        self.author.git.push('origin', 'HEAD')
+        self.checkout = Repo.clone_from(self.url, os.path.join(repodir, 'course'))
+        self.patch_config(REPODIR=repodir)
+        metrics.drain()
+
+    def _action(self, repo_name='course', **kwargs):
+        """
+        Import action for ``repo_name``
+        """
+        return ActionCall(repo_name, self.url, ActionCall.ACTION_TYPES['COURSE_IMPORT'], **kwargs)
+
+    def test_prefetch(self):
+        """
+        New pushes are fetched into the checkout without touching its
+        working tree, pushes already fetched and missing checkouts are
+        skipped.
+        """
+        head = self.checkout.head.commit.hexsha
+        sha = self.author.index.commit('Second Commit').hexsha
+        self.author.git.push('origin', 'HEAD')
+
+        self.assertTrue(prefetch(self._action(sha=sha)))
+        self.assertEqual(self.checkout.commit('origin/master').hexsha, sha)
+        self.assertEqual(self.checkout.head.commit.hexsha, head)
+        self.assertFalse(prefetch(self._action(sha=sha)))
+        self.assertFalse(prefetch(self._action('missing', sha=sha)))
+        self.assertEqual(
+            metrics.drain(), {'git_spawns': 1, 'prefetches': 1, 'prefetches_skipped': 1}
+        )
+
+    @mock.patch('gitreload.prefetch.log')
+    def test_prefetcher(self, mocked_log):
+        """
+        Holds are released after prefetching, also when it fails, and
+        pushes waiting for a thread are fetched together.
+        """
+        queue = mock.Mock()
+        prefetcher = Prefetcher(queue, 1)
+        self.addCleanup(prefetcher.stop)
+        action = self._action()
+        with mock.patch('gitreload.prefetch.prefetch', side_effect=OSError) as mocked_prefetch:
+            prefetcher.submit(action).result()
+        mocked_prefetch.assert_called_once_with(action)
+        queue.release.assert_called_once_with('course')
+        self.assertTrue(mocked_log.exception.called)
+        self.assertEqual(metrics.drain(), {'prefetch_failures': 1})
+
+        queue.reset_mock()
+        newer = self._action(sha='new')
+        with mock.patch('gitreload.prefetch.prefetch') as mocked_prefetch:
+            # As if a prefetch of an older push was waiting for a thread
+            prefetcher._waiting['course'] = action  # pylint: disable=W0212
+            self.assertIsNone(prefetcher.submit(newer))
+            queue.release.assert_called_once_with('course')
+            prefetcher._run('course')  # pylint: disable=W0212
+        mocked_prefetch.assert_called_once_with(newer)
+        self.assertEqual(queue.release.call_count, 2)
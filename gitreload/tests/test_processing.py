@@ -5,10 +5,13 @@ Tests related to the processing module
 import os
 import shutil
 import subprocess
+import threading
+import time
 import mock
 
 from git import Repo
 
+from gitreload.processing import close_repos
 from gitreload.tests.base import GitreloadTestBase, TEST_ROOT
 
 
@@ -36,6 +39,8 @@ class TestProcessing(GitreloadTestBase):
 
         repo = Repo.init(bare_repo_dir, bare=True)
         cloned_repo = repo.clone(repo_dir)
+        # Cached Repos of the checkout go before the checkout itself
+        self.addCleanup(close_repos)
 
         return cloned_repo
 
@@ -84,17 +89,23 @@ class TestProcessing(GitreloadTestBase):
                     'ALSO_CLONE_REPOS': {},
                     'NUM_THREADS': 1,
                     'SUBPROCESS_TIMEOUT': 59,
+                    'LMS_CFG': '/edx/etc/lms.yml',
+                    'REVISION_CFG': '/edx/etc/revisions.yml',
+                    'IMPORT_LEDGER_PATH': '',
+                    'DURATIONS_PATH': '',
+                    'MIRROR_DIR': '',
                 }
             )
-            with mock.patch('subprocess.check_output') as check_output:
-                check_output.side_effect = subprocess.CalledProcessError(
+            with mock.patch('gitreload.processing.run_command') as run_command:
+                run_command.side_effect = subprocess.CalledProcessError(
                     10, 'test_command', output='Test output'
                 )
-                import_repo(ActionCall(
+                action_call = ActionCall(
                     'NOTREAL', 'NOTREAL',
                     ActionCall.ACTION_TYPES['COURSE_IMPORT']
-                ))
-                check_output.assert_called_with(
+                )
+                import_repo(action_call)
+                run_command.assert_called_with(
                     ['/edx/app/edxapp/venvs/edxapp/bin/python',
                      'manage.py',
                      'lms',
@@ -103,10 +114,15 @@ class TestProcessing(GitreloadTestBase):
                      'NOTREAL',
                      '--directory_path',
                      '/mnt/data/repos/NOTREAL'],
+                    action_call,
                     cwd='/edx/app/edxapp/edx-platform',
+                    env=mock.ANY,
                     stderr=-2,
                     timeout=59,
                 )
+                env = run_command.call_args[1]['env']
+                self.assertEqual(env['SERVICE_VARIANT'], 'lms')
+                self.assertEqual(env['LMS_CFG'], '/edx/etc/lms.yml')
 
         mocked_logging.exception.assert_called_with(
             'Import command failed with: %s',
@@ -125,8 +141,8 @@ class TestProcessing(GitreloadTestBase):
 
         # Have mock get called on import and check parameters and have
         # return raise the right Exception
-        with mock.patch('subprocess.check_output') as check_output:
-            check_output.return_value = "Test Success"
+        with mock.patch('gitreload.processing.run_command') as run_command:
+            run_command.return_value = "Test Success"
             import_repo(ActionCall(
                 'NOTREAL', 'NOTREAL',
                 ActionCall.ACTION_TYPES['COURSE_IMPORT']
@@ -137,6 +153,40 @@ class TestProcessing(GitreloadTestBase):
             'Test Success'
         )
 
+    @mock.patch('gitreload.processing.log')
+    def test_import_ledger(self, mocked_logging):
+        """
+        Make sure an import of an already imported tree is skipped
+        unless forced, and that successful imports are recorded.
+        """
+        from gitreload.processing import import_repo, ActionCall
+
+        ledger_path = os.path.join(TEST_ROOT, 'test_import_ledger')
+        self.addCleanup(os.remove, ledger_path)
+        self.addCleanup(os.remove, '{0}.lock'.format(ledger_path))
+
+        action_call = ActionCall(
+            'NOTREAL', 'NOTREAL',
+            ActionCall.ACTION_TYPES['COURSE_IMPORT'],
+            tree_sha='abc123'
+        )
+        with mock.patch('gitreload.config.Config.IMPORT_LEDGER_PATH', ledger_path):
+            with mock.patch('gitreload.processing.run_command') as run_command:
+                run_command.return_value = 'Test Success'
+                import_repo(action_call)
+                self.assertEqual(run_command.call_count, 1)
+
+                import_repo(action_call)
+                self.assertEqual(run_command.call_count, 1)
+                mocked_logging.info.assert_called_with(
+                    'Tree %s of course repo %s was already imported, skipping',
+                    'abc123', 'NOTREAL'
+                )
+
+                action_call.kwargs['force'] = True
+                import_repo(action_call)
+                self.assertEqual(run_command.call_count, 2)
+
     @mock.patch('gitreload.processing.log')
     def test_import_timeout(self, mocked_logging):
         """
@@ -147,8 +197,8 @@ class TestProcessing(GitreloadTestBase):
         from gitreload.processing import import_repo, ActionCall
 
         # Call with bad edx-platform path to prevent actual execution
-        with mock.patch('subprocess.check_output') as check_output:
-            check_output.side_effect = subprocess.TimeoutExpired(cmd='ls', output='foooo', timeout=39)
+        with mock.patch('gitreload.processing.run_command') as run_command:
+            run_command.side_effect = subprocess.TimeoutExpired(cmd='ls', output='foooo', timeout=39)
             import_repo(ActionCall(
                 'NOTREAL', 'NOTREAL',
                 ActionCall.ACTION_TYPES['COURSE_IMPORT']
@@ -156,6 +206,99 @@ class TestProcessing(GitreloadTestBase):
         mocked_logging.exception.assert_called_with(
             'Import command timed out after %s seconds with: %s', 39, 'foooo')
 
+    def test_run_command(self):
+        """
+        Make sure run_command behaves like check_output
+        """
+        from gitreload.processing import run_command, ActionCall
+
+        action_call = ActionCall(
+            'NOTREAL', 'NOTREAL', ActionCall.ACTION_TYPES['COURSE_IMPORT']
+        )
+        runtime_dir = self.make_tmpdir()
+        with mock.patch('gitreload.config.Config.RUNTIME_DIR', runtime_dir):
+            self.assertEqual(run_command(['echo', 'hi'], action_call), b'hi\n')
+            with self.assertRaises(subprocess.CalledProcessError):
+                run_command(['false'], action_call)
+            with self.assertRaises(subprocess.TimeoutExpired):
+                run_command(['sleep', '5'], action_call, timeout=0.2)
+        self.assertEqual(os.listdir(runtime_dir), [])
+
+    @mock.patch('gitreload.processing.log')
+    def test_supersede(self, mocked_logging):
+        """
+        Make sure a newer push terminates the whole process group of a
+        running command, but only up to the configured number of times
+        in a row.
+        """
+        from gitreload.processing import (
+            run_command, supersede, ActionCall, SupersededError
+        )
+
+        action_call = ActionCall(
+            'NOTREAL', 'NOTREAL', ActionCall.ACTION_TYPES['COURSE_IMPORT']
+        )
+        runtime_dir = self.make_tmpdir()
+        pid_path = os.path.join(runtime_dir, 'NOTREAL.pid')
+
+        def run_sleep(results):
+            """Run a command that spawns its own child and record the result"""
+            try:
+                run_command(['sh', '-c', 'sleep 30; echo done'], action_call)
+            except (SupersededError, subprocess.CalledProcessError) as exc:
+                results.append(exc)
+
+        with mock.patch('gitreload.config.Config.RUNTIME_DIR', runtime_dir), \
+                mock.patch('gitreload.config.Config.SUPERSEDE_MAX_CANCELS', 1):
+            self.assertFalse(supersede(action_call))
+            results = []
+            runner = threading.Thread(target=run_sleep, args=(results,))
+            runner.start()
+            while not os.path.isfile(pid_path):
+                time.sleep(0.01)
+            self.assertTrue(supersede(action_call))
+            runner.join(5)
+            self.assertFalse(runner.is_alive())
+            self.assertIsInstance(results[0], SupersededError)
+
+            runner = threading.Thread(target=run_sleep, args=(results,))
+            runner.start()
+            while not os.path.isfile(pid_path):
+                time.sleep(0.01)
+            self.assertFalse(supersede(action_call))
+            mocked_logging.warning.assert_called_with(
+                'Not superseding running %s of %s, already superseded '
+                '%s times in a row', 'COURSE_IMPORT', 'NOTREAL', 1
+            )
+            with open(pid_path) as pid_file:
+                os.killpg(int(pid_file.read().split()[0]), 9)
+            runner.join(5)
+            self.assertIsInstance(results[1], subprocess.CalledProcessError)
+
+    @mock.patch('gitreload.processing.log')
+    def test_supersede_same_sha(self, mocked_logging):
+        """
+        A redelivered push for the commit already being imported leaves
+        the running command alone.
+        """
+        from gitreload.processing import supersede, ActionCall
+
+        runtime_dir = self.make_tmpdir()
+        action_call = ActionCall(
+            'NOTREAL', 'NOTREAL', ActionCall.ACTION_TYPES['COURSE_IMPORT'], sha='abc123'
+        )
+        with open(os.path.join(runtime_dir, 'NOTREAL.pid'), 'w') as pid_file:
+            pid_file.write('999999 {0} abc123'.format(action_call.action_type))
+        with mock.patch('gitreload.config.Config.RUNTIME_DIR', runtime_dir), \
+                mock.patch('gitreload.processing.os.killpg') as mocked_killpg:
+            self.assertFalse(supersede(action_call))
+        self.assertFalse(mocked_killpg.called)
+        self.assertFalse(os.path.exists(os.path.join(runtime_dir, 'NOTREAL.superseded')))
+        mocked_logging.info.assert_called_with(
+            'Not superseding running %s of %s, it is for the same commit %s',
+            'COURSE_IMPORT', 'NOTREAL', 'abc123'
+        )
+
     def test_worker_count_and_stop(self):
         """
         Make sure the number of workers started is properly configurable.
@@ -227,6 +370,102 @@ class TestProcessing(GitreloadTestBase):
         )
         self._stop_workers(workers)
 
+    def test_thread_workers(self):
+        """
+        Thread workers work an in process queue the same way
+        """
+        from gitreload.processing import ActionCall, GitActionThread
+        from gitreload.scheduler import JobQueue
+
+        queue = JobQueue()
+        queued_jobs = []
+        action_call = ActionCall(
+            'NOTREAL', 'NOTREAL',
+            ActionCall.ACTION_TYPES['GET_LATEST']
+        )
+        waiting = ActionCall('OTHER', 'NOTREAL', ActionCall.ACTION_TYPES['GET_LATEST'])
+        queued_jobs.extend([action_call, waiting])
+        queue.put(action_call)
+        queue.put(waiting, debounce=60)
+        done = threading.Event()
+        commands = (None, mock.Mock(side_effect=lambda *args: done.set()))
+        with mock.patch.object(GitActionThread, 'ACTION_COMMANDS', commands):
+            worker = GitActionThread(queue, 0, queued_jobs)
+            self.assertTrue(worker.daemon)
+            self.assertEqual(worker.name, 'gitreload-worker-0')
+            worker.start()
+            self.assertTrue(done.wait(5))
+        commands[1].assert_called_with(action_call)
+        # The finished job's entry goes, not the last one
+        deadline = time.monotonic() + 5
+        while len(queued_jobs) > 1 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(queued_jobs, [waiting])
+
+    def test_worker_durations(self):
+        """
+        Only the durations of jobs that ran to completion are recorded,
+        not those of skipped or failed ones.
+        """
+        from gitreload.processing import ActionCall, GitActionThread
+        from gitreload.scheduler import JobQueue
+
+        queue = JobQueue()
+        queued_jobs = []
+        actions = [
+            ActionCall(repo_name, 'NOTREAL', ActionCall.ACTION_TYPES['GET_LATEST'])
+            for repo_name in ('skipped', 'done')
+        ]
+        for action_call in actions:
+            queued_jobs.append(action_call)
+            queue.put(action_call)
+        done = threading.Event()
+        history = mock.Mock()
+        history.record.side_effect = lambda *args: done.set()
+        commands = (None, lambda action: action.repo_name == 'done')
+        with mock.patch.object(GitActionThread, 'ACTION_COMMANDS', commands), \
+                mock.patch('gitreload.processing.DurationHistory.from_config',
+                           return_value=history):
+            GitActionThread(queue, 0, queued_jobs).start()
+            self.assertTrue(done.wait(5))
+        history.record.assert_called_once_with(actions[1], mock.ANY)
+
+    def test_worker_retry(self):
+        """
+        Jobs failing on transient errors are queued again to run after
+        a backoff delay.
+        """
+        from git import GitCommandError
+        from gitreload.processing import ActionCall, GitActionThread
+        from gitreload.scheduler import JobQueue
+
+        queue = JobQueue()
+        queued_jobs = []
+        action_call = ActionCall('NOTREAL', 'NOTREAL', ActionCall.ACTION_TYPES['GET_LATEST'])
+        queued_jobs.append(action_call)
+        queue.put(action_call)
+        done = threading.Event()
+        calls = []
+        listed = []
+
+        def command(action):
+            """Fail with a server error the first time"""
+            calls.append((time.monotonic(), action.kwargs.get('attempt')))
+            listed.append([item.kwargs.get('attempt') for item in queued_jobs])
+            if len(calls) == 1:
+                raise GitCommandError(['git', 'fetch'], 128, b'RPC failed; HTTP 503')
+            done.set()
+
+        commands = (None, command)
+        with mock.patch.object(GitActionThread, 'ACTION_COMMANDS', commands), \
+                mock.patch('gitreload.config.Config.RETRY_BASE_DELAY', 0.2):
+            GitActionThread(queue, 0, queued_jobs).start()
+            self.assertTrue(done.wait(5))
+        self.assertEqual([attempt for _, attempt in calls], [None, 2])
+        # The retry is listed in place of the failed job while it runs
+        self.assertEqual(listed, [[None], [2]])
+        self.assertGreaterEqual(calls[1][0] - calls[0][0], 0.1)
+
     def test_invalid_action_call(self):
         """
         Test invalid setup to action call
@@ -298,3 +537,137 @@ class TestProcessing(GitreloadTestBase):
             'Updated to latest revision of repo %s. Original SHA: %s. Head SHA: %s',
             repo_name, orig_head, repo.head.commit.tree.hexsha
         )
+
+    def test_git_spawns(self):
+        """
+        Updates reuse the cached Repo, count the git processes they
+        start and skip the fetch when the remote branch already is at
+        the pushed SHA.
+        """
+        from gitreload import metrics
+        from gitreload.processing import git_get_latest, ActionCall, _repos
+        repo_name = 'spawns'
+        repo = self.make_bare_repo(repo_name)
+        test_file = os.path.join(repo.working_tree_dir, 'test.txt')
+        open(test_file, 'a').close()
+        repo.index.add([test_file])
+        sha = repo.index.commit('First Commit').hexsha
+        repo.git.push('origin', 'master')
+        repo.remotes.origin.fetch()
+        repo_dir = repo.working_tree_dir
+
+        metrics.drain()
+        with mock.patch('gitreload.config.Config.REPODIR', TEST_ROOT):
+            git_get_latest(ActionCall(
+                repo_name, repo.remotes.origin.url, ActionCall.ACTION_TYPES['GET_LATEST']
+            ))
+            cached = _repos[repo_dir][1]
+            first = metrics.drain()
+            git_get_latest(ActionCall(
+                repo_name, repo.remotes.origin.url, ActionCall.ACTION_TYPES['GET_LATEST'],
+                sha=sha
+            ))
+            second = metrics.drain()
+        self.assertIs(_repos[repo_dir][1], cached)
+        # fetch, reset, clean and the two persistent cat-files, then
+        # only reset and clean
+        self.assertEqual(first['git_spawns'], 5)
+        self.assertEqual(second, {'git_spawns': 2, 'fetches_skipped': 1})
+
+        with mock.patch('gitreload.config.Config.REPO_CACHE_SIZE', 0), \
+                mock.patch('gitreload.config.Config.REPODIR', TEST_ROOT):
+            git_get_latest(ActionCall(
+                repo_name, repo.remotes.origin.url, ActionCall.ACTION_TYPES['GET_LATEST']
+            ))
+        self.assertNotIn(repo_dir, _repos)
+
+    def test_sparse_checkout(self):
+        """
+        Updates of a sparse checkout are limited to its directories,
+        and removing the repo from the config restores it in full.
+        """
+        from gitreload.processing import git_get_latest, ActionCall
+        repo_name = 'sparse'
+        repo = self.make_bare_repo(repo_name)
+        for path in ('a/one.txt', 'b/two.txt'):
+            os.makedirs(os.path.join(repo.working_tree_dir, os.path.dirname(path)))
+            open(os.path.join(repo.working_tree_dir, path), 'a').close()
+            repo.index.add([path])
+        repo.index.commit('First Commit')
+        repo.git.push('origin', 'master')
+        for path in ('a/junk.txt', 'junk.txt'):
+            open(os.path.join(repo.working_tree_dir, path), 'a').close()
+
+        action_call = ActionCall(
+            repo_name, repo.remotes.origin.url, ActionCall.ACTION_TYPES['GET_LATEST']
+        )
+
+        def exists(path):
+            """Whether ``path`` is in the working tree"""
+            return os.path.exists(os.path.join(repo.working_tree_dir, path))
+
+        with mock.patch('gitreload.config.Config.REPODIR', TEST_ROOT), \
+                mock.patch('gitreload.config.Config.SPARSE_CHECKOUTS', {repo_name: ['/a/']}):
+            git_get_latest(action_call)
+            self.assertTrue(exists('a/one.txt'))
+            self.assertFalse(exists('b'))
+            self.assertFalse(exists('a/junk.txt'))
+            # Outside of the sparse directories nothing is cleaned
+            self.assertTrue(exists('junk.txt'))
+            with mock.patch('git.cmd.Git.sparse_checkout', create=True) as sparse_checkout:
+                git_get_latest(action_call)
+            self.assertFalse(sparse_checkout.called)
+
+        with mock.patch('gitreload.config.Config.REPODIR', TEST_ROOT):
+            git_get_latest(action_call)
+        self.assertTrue(exists('b/two.txt'))
+        self.assertFalse(exists('junk.txt'))
+
+    @mock.patch('gitreload.processing.log')
+    def test_dependencies(self, mocked_log):
+        """
+        Linked repos are updated and missing ones to clone are cloned
+        before an import, which doesn't run if any of them fails.
+        """
+        from git import GitCommandError
+        from gitreload.processing import (
+            DependencyError, ActionCall, import_repo, update_dependencies
+        )
+        repos = {}
+        for repo_name in ('library', 'assets'):
+            repo = repos[repo_name] = self.make_bare_repo(repo_name)
+            for index in range(2):
+                repo.index.commit('Commit {0}'.format(index))
+            repo.git.push('origin', 'master')
+        latest = repos['library'].head.commit.hexsha
+        repos['library'].head.reset(index=True, commit='HEAD~1', working_tree=True)
+        clone_dir = os.path.join(TEST_ROOT, 'assets-clone')
+        self.addCleanup(shutil.rmtree, clone_dir, True)
+
+        action_call = ActionCall('course', 'NOTREAL', ActionCall.ACTION_TYPES['COURSE_IMPORT'])
+        with mock.patch('gitreload.config.Config.REPODIR', TEST_ROOT), \
+                mock.patch('gitreload.config.Config.LINKED_REPOS',
+                           {'course': ['library'], 'other': ['missing']}), \
+                mock.patch('gitreload.config.Config.ALSO_CLONE_REPOS',
+                           {'course': {'assets-clone': repos['assets'].remotes.origin.url}}):
+            update_dependencies(action_call)
+            self.assertEqual(repos['library'].head.commit.hexsha, latest)
+            self.assertEqual(Repo(clone_dir).head.commit.hexsha,
+                             repos['assets'].head.commit.hexsha)
+
+            with self.assertRaisesRegex(DependencyError, 'Unable to update missing'):
+                update_dependencies(ActionCall('other', 'NOTREAL', 0))
+            with mock.patch('gitreload.processing.run_command') as run_command:
+                import_repo(ActionCall('other', 'NOTREAL', 0))
+            self.assertFalse(run_command.called)
+            mocked_log.error.assert_called_with(
+                'Not importing course repo %s: %s', 'other', mock.ANY
+            )
+
+            # Transient failures are left to the retries instead
+            with mock.patch('gitreload.processing.update_dependency', side_effect=GitCommandError(
+                    ['git', 'fetch'], 128, b'Could not resolve host: github.com'
+            )), mock.patch('gitreload.processing.run_command') as run_command:
+                with self.assertRaises(GitCommandError):
+                    import_repo(action_call)
+            self.assertFalse(run_command.called)
@@ -0,0 +1,72 @@
+"""
+Tests for reconciling checkouts with their remotes
+"""
+import os
+
+import mock
+from git import Repo
+
+from gitreload.processing import ActionCall
+from gitreload.reconcile import sweep
+from gitreload.scheduler import QueueFullError
+from gitreload.tests.base import GitreloadTestCase
+
+
+class TestReconcile(GitreloadTestCase):
+    """
+    Make sure drifted checkouts, and only those, get queued
+    """
+    # pylint: disable=R0904
+
+    def setUp(self):
+        """
+        Create a remote with a clone pushing to it and two checkouts
+        """
+        self.tmpdir = self.make_tmpdir()
+        self.repodir = os.path.join(self.tmpdir, 'repos')
+        os.mkdir(self.repodir)
+        remote = Repo.init(os.path.join(self.tmpdir, 'remote.git'), bare=True)
+        self.author = remote.clone(os.path.join(self.tmpdir, 'author'))
+        self._push('First Commit')
+        for name in ('course', 'grader'):
+            remote.clone(os.path.join(self.repodir, name))
+        self.patch_config(REPODIR=self.repodir)
+
+    def _push(self, message):
+        """
+        Push a new commit to the remote
+        """
+        self.author.index.commit(message)
+        self.author.git.push('origin', 'HEAD')
+
+    def test_sweep(self):
+        """
+        Only checkouts behind their remote are submitted, with their
+        configured action at low priority.
+        """
+        submit = mock.Mock()
+        self.assertEqual(sweep(submit), [])
+
+        self._push('Second Commit')
+        with mock.patch('gitreload.config.Config.RECONCILE_ACTIONS',
+                        {'course': 'COURSE_IMPORT'}):
+            actions = sweep(submit)
+        self.assertEqual(
+            [(action.repo_name, action.action_text) for action in actions],
+            [('course', 'COURSE_IMPORT'), ('grader', 'GET_LATEST')]
+        )
+        self.assertEqual(actions[0].priority, ActionCall.PRIORITIES['LOW'])
+        self.assertTrue(actions[0].repo_url.endswith('remote.git'))
+        self.assertEqual(submit.call_count, 2)
+
+    @mock.patch('gitreload.reconcile.log')
+    def test_sweep_queue_full(self, mocked_log):
+        """
+        A full queue doesn't stop the sweep
+        """
+        self._push('Second Commit')
+        submit = mock.Mock(side_effect=QueueFullError(60))
+        self.assertEqual(len(sweep(submit)), 2)
+        mocked_log.warning.assert_called_with(
+            'Queue full, reconciliation of %s skipped', 'grader'
+        )
@@ -0,0 +1,100 @@
+"""
+Tests for reading checkout state from disk
+"""
+import os
+
+import mock
+from git import Repo
+
+from gitreload.refs import (
+    CheckoutIndex, list_checkouts, normalize_url, origin_url, read_head, resolve_ref
+)
+from gitreload.tests.base import GitreloadTestCase
+
+
+class TestRefs(GitreloadTestCase):
+    """
+    Make sure refs are read the same way git resolves them
+    """
+    # pylint: disable=R0904
+
+    def setUp(self):
+        """
+        Create a checkout with a commit
+        """
+        self.tmpdir = self.make_tmpdir()
+        self.repo_dir = os.path.join(self.tmpdir, 'course')
+        self.repo = Repo.init(self.repo_dir)
+        self.repo.create_remote('origin', 'git@example.com:test/course.git')
+        self.repo.index.commit('First Commit')
+
+    def test_read_head(self):
+        """
+        Read loose, packed and detached heads
+        """
+        sha = self.repo.head.commit.hexsha
+        branch = self.repo.active_branch.path
+        self.assertEqual(read_head(self.repo_dir), (branch, sha))
+
+        self.repo.git.pack_refs('--all')
+        self.assertFalse(os.path.exists(os.path.join(self.repo_dir, '.git', branch)))
+        self.assertEqual(read_head(self.repo_dir), (branch, sha))
+        self.assertIsNone(resolve_ref(self.repo_dir, 'refs/heads/nope'))
+
+        self.repo.git.checkout(sha)
+        self.assertEqual(read_head(self.repo_dir), (None, sha))
+
+    def test_list_checkouts(self):
+        """
+        Only git checkouts are listed
+        """
+        os.mkdir(os.path.join(self.tmpdir, 'not_a_repo'))
+        open(os.path.join(self.tmpdir, 'file'), 'w').close()
+        self.assertEqual(list_checkouts(self.tmpdir), ['course'])
+        self.assertEqual(list_checkouts(os.path.join(self.tmpdir, 'nope')), [])
+
+    def test_origin_url(self):
+        """
+        The origin URL comes from the git config
+        """
+        self.assertEqual(origin_url(self.repo_dir), 'git@example.com:test/course.git')
+        self.assertIsNone(origin_url(self.tmpdir))
+
+    def test_normalize_url(self):
+        """
+        The various URLs of a repository normalize to the same string
+        """
+        for url in ('https://github.com/Test/Course',
+                    'https://user@github.com/test/course.git/',
+                    'git@github.com:test/course.git',
+                    'ssh://git@github.com:22/test/course'):
+            self.assertEqual(normalize_url(url), 'github.com/test/course')
+        self.assertEqual(normalize_url('file:///srv/course.git'), '/srv/course')
+
+    def test_checkout_index(self):
+        """
+        Checkouts are found by origin URL and branch, and the index
+        follows added checkouts and branch switches.
+        """
+        index = CheckoutIndex(60)
+        url = 'https://example.com/test/course'
+        self.assertEqual(index.lookup(self.tmpdir, url, 'refs/heads/master'),
+                         [('course', 'git@example.com:test/course.git')])
+        self.assertEqual(index.lookup(self.tmpdir, url, 'refs/heads/devel'), [])
+        self.assertEqual(index.lookup('/not/a/dir', url, 'refs/heads/master'), [])
+
+        devel = self.repo.clone(os.path.join(self.tmpdir, 'course-devel'))
+        devel.git.checkout('-b', 'devel')
+        devel.remotes.origin.set_url('git@example.com:test/course.git')
+        self.assertEqual(index.lookup(self.tmpdir, url, 'refs/heads/devel'),
+                         [('course-devel', 'git@example.com:test/course.git')])
+
+        # Switching away from an indexed branch is noticed right away
+        devel.git.checkout('-b', 'other')
+        self.assertEqual(index.lookup(self.tmpdir, url, 'refs/heads/devel'), [])
+
+        # Switching to a branch is noticed once the index expires
+        devel.git.checkout('devel')
+        self.assertEqual(index.lookup(self.tmpdir, url, 'refs/heads/devel'), [])
+        with mock.patch('gitreload.refs.time.monotonic', return_value=10 ** 9):
+            self.assertEqual(len(index.lookup(self.tmpdir, url, 'refs/heads/devel')), 1)
@@ -0,0 +1,133 @@
+"""
+Tests for the resource classes of job subprocesses
+"""
+import os
+import sys
+
+import mock
+from git import Repo
+
+from gitreload import lease, mirror, reconcile
+from gitreload.processing import ActionCall, run_command
+from gitreload.resources import (
+    check_classes, class_name, cgroup_procs, command_prefix, job_prefix, open_repo
+)
+from gitreload.tests.base import GitreloadTestCase
+
+PRINT_NICE = [sys.executable, '-c', 'import os; print(os.getpriority(os.PRIO_PROCESS, 0))']
+
+
+class TestResources(GitreloadTestCase):
+    """
+    Make sure job subprocesses get the limits of their class
+    """
+
+    def setUp(self):
+        """
+        Configure a background class for imports
+        """
+        self.tmpdir = self.make_tmpdir()
+        self.nice = os.getpriority(os.PRIO_PROCESS, 0)
+        classes = {
+            'background': {'nice': self.nice + 10, 'ionice': 'idle'},
+            'limited': {'nice': self.nice + 5, 'cpu_max': '50000 100000', 'memory_max': '1G'},
+        }
+        self.patch_config(
+            RESOURCE_CLASSES=classes,
+            JOB_RESOURCE_CLASSES={'COURSE_IMPORT': 'background', 'grader': 'limited'},
+            CGROUP_PARENT=self.tmpdir,
+            RUNTIME_DIR=os.path.join(self.tmpdir, 'run'),
+        )
+        patcher = mock.patch.dict('gitreload.resources._cgroups', clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.course_import = ActionCall('course', 'NOTREAL', ActionCall.ACTION_TYPES['COURSE_IMPORT'])
+
+    def test_class_name(self):
+        """
+        Classes are picked by repo, then action type, then lane.
+        """
+        self.assertEqual(class_name(self.course_import), 'background')
+        self.assertEqual(class_name(ActionCall('grader', 'NOTREAL', 0)), 'limited')
+        self.assertIsNone(class_name(ActionCall('course', 'NOTREAL', 1)))
+        self.assertEqual(command_prefix(ActionCall('course', 'NOTREAL', 1)), [])
+        self.assertEqual(command_prefix(self.course_import),
+                         ['nice', '-n', '10', 'ionice', '-c', '3'])
+
+    def test_command_prefix(self):
+        """
+        Subprocesses get the niceness and I/O class of the job.
+        """
+        self.assertEqual(run_command(PRINT_NICE, self.course_import).strip(),
+                         str(self.nice + 10).encode())
+        output = run_command(['ionice'], self.course_import)
+        self.assertEqual(output.strip(), b'idle')
+
+        # Git commands of a job's repo get the limits too
+        repo = Repo.init(os.path.join(self.tmpdir, 'course'))
+        self.assertEqual(open_repo(repo.working_tree_dir, self.course_import).git.execute(
+            PRINT_NICE
+        ), str(self.nice + 10))
+        self.assertEqual(open_repo(repo.working_tree_dir, ActionCall('course', 'NOTREAL', 1))
+                         .git.execute(PRINT_NICE), str(self.nice))
+
+    def test_cgroup(self):
+        """
+        Classes with CPU or memory limits get a cgroup the subprocesses
+        are moved to.
+        """
+        grader = ActionCall('grader', 'NOTREAL', 1)
+        procs = cgroup_procs('limited', {'cpu_max': '50000 100000', 'memory_max': '1G'})
+        self.assertEqual(procs, os.path.join(self.tmpdir, 'gitreload-limited', 'cgroup.procs'))
+        with open(os.path.join(self.tmpdir, 'gitreload-limited', 'cpu.max')) as cpu_file:
+            self.assertEqual(cpu_file.read(), '50000 100000')
+
+        run_command(['true'], grader)
+        with open(procs) as procs_file:
+            pid = int(procs_file.read())
+        self.assertNotEqual(pid, os.getpid())
+
+        repo = Repo.init(os.path.join(self.tmpdir, 'grader'))
+        open_repo(repo.working_tree_dir, grader).git.execute(['git', 'status'])
+        with open(procs) as procs_file:
+            self.assertEqual(procs_file.read(), '0\n')
+
+        self.assertIsNone(cgroup_procs('background', {'nice': 10}))
+        with mock.patch('gitreload.config.Config.CGROUP_PARENT', '/proc/none'), \
+                mock.patch.dict('gitreload.resources._cgroups', clear=True):
+            self.assertIsNone(cgroup_procs('limited', {'memory_max': '1G'}))
+
+    def test_other_commands(self):
+        """
+        git commands not run through run_command or a job's Repo, like
+        mirror fetches, get the limits of the job they are run for.
+        """
+        grader = ActionCall('grader', 'NOTREAL', 1)
+        procs = os.path.join(self.tmpdir, 'gitreload-limited', 'cgroup.procs')
+        self.assertEqual(job_prefix(grader)[:3], ['nice', '-n', '5'])
+        self.assertEqual(job_prefix(grader)[3:], ['sh', '-c', mock.ANY, procs])
+        for module, call in (
+                ('mirror', lambda: mirror.git(['fetch'], 'NOTREAL', grader)),
+                ('reconcile', lambda: reconcile.remote_sha(self.tmpdir, 'master', grader)),
+                ('lease', lambda: lease.is_ancestor(self.tmpdir, 'abc', 'def', grader)),
+        ):
+            with mock.patch('gitreload.{0}.subprocess'.format(module)) as subprocess:
+                call()
+            spawn = subprocess.check_output if module != 'lease' else subprocess.run
+            self.assertEqual(spawn.call_args[0][0][:len(job_prefix(grader))], job_prefix(grader))
+
+    def test_check_classes(self):
+        """
+        Invalid classes are reported at startup rather than by jobs.
+        """
+        check_classes()
+        for classes, job_classes in (
+                ({'background': {'ionice': 'lazy'}}, {}),
+                ({'background': {'ionice': 'best-effort:high'}}, {}),
+                ({'background': {'nice': '10'}}, {}),
+                ({}, {'COURSE_IMPORT': 'background'}),
+        ):
+            with mock.patch('gitreload.config.Config.RESOURCE_CLASSES', classes), \
+                    mock.patch('gitreload.config.Config.JOB_RESOURCE_CLASSES', job_classes):
+                with self.assertRaises(ValueError):
+                    check_classes()
@@ -0,0 +1,66 @@
+"""
+Tests for retrying jobs that failed on transient errors
+"""
+import subprocess
+import unittest
+
+import mock
+from git import GitCommandError
+
+from gitreload.processing import ActionCall
+from gitreload.retry import RetryPolicy, is_transient, policy_for, retry_delay
+
+
+class TestRetry(unittest.TestCase):
+    """
+    Make sure only transient failures are retried, with backoff
+    """
+
+    def test_is_transient(self):
+        """
+        Server and connection errors are transient, others aren't.
+        """
+        self.assertTrue(is_transient(GitCommandError(
+            ['git', 'fetch'], 128,
+            b"fatal: unable to access 'https://github.com/org/course/': "
+            b"The requested URL returned error: 502"
+        )))
+        self.assertTrue(is_transient(subprocess.CalledProcessError(
+            1, 'manage.py', output=b'OperationalError: (2006, MySQL server has gone away)'
+        )))
+        self.assertFalse(is_transient(GitCommandError(
+            ['git', 'fetch'], 128, b'ERROR: Repository not found.'
+        )))
+        self.assertFalse(is_transient(subprocess.CalledProcessError(1, 'manage.py', output=None)))
+        self.assertFalse(is_transient(OSError('Connection refused')))
+
+    def test_backoff(self):
+        """
+        Delays double up to the maximum, with jitter in their upper half.
+        """
+        policy = RetryPolicy(5, 10, 60)
+        with mock.patch('gitreload.retry.random.uniform', side_effect=lambda low, high: high):
+            self.assertEqual([policy.delay(attempt) for attempt in range(1, 6)],
+                             [10, 20, 40, 60, 60])
+        for attempt in range(1, 6):
+            self.assertGreaterEqual(policy.delay(attempt), min(60, 10 * 2 ** (attempt - 1)) / 2)
+
+    def test_retry_delay(self):
+        """
+        Policies are overridden per action type and stop retrying
+        after the last attempt.
+        """
+        error = GitCommandError(['git', 'fetch'], 128, b'fatal: early EOF')
+        with mock.patch('gitreload.config.Config.RETRY_MAX_ATTEMPTS', 3), \
+                mock.patch('gitreload.config.Config.RETRY_POLICIES',
+                           {'COURSE_IMPORT': {'max_attempts': 1}}):
+            update = ActionCall('course', 'NOTREAL', ActionCall.ACTION_TYPES['GET_LATEST'])
+            self.assertEqual(policy_for(update).max_attempts, 3)
+            self.assertIsNotNone(retry_delay(update, error))
+            update.kwargs['attempt'] = 3
+            self.assertIsNone(retry_delay(update, error))
+            self.assertIsNone(retry_delay(
+                ActionCall('course', 'NOTREAL', ActionCall.ACTION_TYPES['COURSE_IMPORT']), error
+            ))
+            update.kwargs['attempt'] = 1
+            self.assertIsNone(retry_delay(update, OSError()))
@@ -0,0 +1,283 @@
+"""
+Tests for the job queue
+"""
+import unittest
+from queue import Empty
+
+import mock
+
+from gitreload.processing import ActionCall
+from gitreload.scheduler import JobQueue, QueueFullError, ShortestJobFirst
+
+
+class TestJobQueue(unittest.TestCase):
+    """
+    Validate coalescing and debouncing of queued jobs
+    """
+    # pylint: disable=R0904
+
+    def setUp(self):
+        """
+        Control the clock used by the queue
+        """
+        patcher = mock.patch('gitreload.scheduler.time.monotonic')
+        self.monotonic = patcher.start()
+        self.monotonic.return_value = 100.0
+        self.addCleanup(patcher.stop)
+        self.queue = JobQueue()
+
+    @classmethod
+    def _action(cls, repo_name='course', action='COURSE_IMPORT', **kwargs):
+        """
+        Build an action call for the queue
+        """
+        return ActionCall(
+            repo_name, 'http://example.com/{0}.git'.format(repo_name),
+            ActionCall.ACTION_TYPES[action], **kwargs
+        )
+
+    def test_fifo(self):
+        """
+        Without debouncing jobs come out in the order they went in
+        """
+        self.assertEqual(self.queue.put(self._action('one')), (JobQueue.QUEUED, []))
+        self.assertEqual(self.queue.put(self._action('two')), (JobQueue.QUEUED, []))
+        self.assertEqual(self.queue.qsize(), 2)
+        self.assertEqual(self.queue.get().repo_name, 'one')
+        self.assertEqual(self.queue.get().repo_name, 'two')
+        with self.assertRaises(Empty):
+            self.queue.get(block=False)
+
+    def test_merge(self):
+        """
+        A waiting job for the same repo and action is merged and keeps
+        the newest arguments, other actions are not merged.
+        """
+        self.queue.put(self._action(tree_sha='old'), 10)
+        self.assertEqual(
+            self.queue.put(self._action(tree_sha='new'), 10), (JobQueue.MERGED, [])
+        )
+        self.assertEqual(
+            self.queue.put(self._action(action='GET_LATEST'), 10), (JobQueue.QUEUED, [])
+        )
+        self.assertEqual(self.queue.qsize(), 2)
+        self.monotonic.return_value = 110.0
+        self.assertEqual(self.queue.get(block=False).kwargs, {'tree_sha': 'new'})
+
+    def test_debounce(self):
+        """
+        Jobs only become runnable after the quiet period, and every new
+        push restarts it up to the maximum delay.
+        """
+        self.queue.put(self._action(), 10, 25)
+        self.monotonic.return_value = 109.0
+        with self.assertRaises(Empty):
+            self.queue.get(block=False)
+
+        self.queue.put(self._action(), 10, 25)
+        self.monotonic.return_value = 118.0
+        with self.assertRaises(Empty):
+            self.queue.get(block=False)
+
+        self.queue.put(self._action(), 10, 25)
+        self.monotonic.return_value = 125.0
+        self.assertEqual(self.queue.get(block=False).repo_name, 'course')
+
+    def test_get_timeout(self):
+        """
+        A blocking get gives up after its timeout
+        """
+        self.monotonic.side_effect = [100.0, 100.0, 101.0]
+        with self.assertRaises(Empty):
+            self.queue.get(timeout=1)
+
+    def test_task_done(self):
+        """
+        task_done can't be called more often than jobs were queued
+        """
+        self.queue.put(self._action())
+        self.queue.get()
+        self.queue.task_done()
+        with self.assertRaises(ValueError):
+            self.queue.task_done()
+
+    def test_depth_limits(self):
+        """
+        A full queue sheds its newest lowest priority job for a more
+        important one and refuses jobs it has no room for.
+        """
+        low = ActionCall.PRIORITIES['LOW']
+        self.queue = JobQueue(max_depth=3, max_repo_depth=2, retry_after=42)
+        self.queue.put(self._action('one', priority=low))
+        self.queue.put(self._action('two', priority=low))
+        self.queue.put(self._action('three'))
+
+        with self.assertRaises(QueueFullError) as context:
+            self.queue.put(self._action('four', priority=low))
+        self.assertEqual(context.exception.retry_after, 42)
+
+        status, shed = self.queue.put(self._action('four'))
+        self.assertEqual(status, JobQueue.QUEUED)
+        self.assertEqual([action.repo_name for action in shed], ['two'])
+        self.assertEqual(self.queue.qsize(), 3)
+
+        # Merging into a waiting job always works
+        self.assertEqual(self.queue.put(self._action('four'))[0], JobQueue.MERGED)
+
+        # Per repo limits only shed jobs of the same repo
+        self.queue = JobQueue(max_repo_depth=1)
+        self.queue.put(self._action('one', priority=low))
+        self.queue.put(self._action('two', action='GET_LATEST'))
+        with self.assertRaises(QueueFullError):
+            self.queue.put(self._action('two'))
+        status, shed = self.queue.put(self._action('one', action='GET_LATEST'))
+        self.assertEqual([action.repo_name for action in shed], ['one'])
+
+    def test_shortest_job_first(self):
+        """
+        The policy runs short jobs first but ages waiting jobs so long
+        ones eventually go.
+        """
+        self.queue = JobQueue(policy=ShortestJobFirst(1, 60))
+        self.queue.put(self._action('long'), expected=600)
+        self.queue.put(self._action('unknown'))
+        self.queue.put(self._action('short'), expected=20)
+        self.assertEqual(self.queue.get().repo_name, 'short')
+        self.assertEqual(self.queue.get().repo_name, 'unknown')
+
+        self.monotonic.return_value = 700.0
+        self.queue.put(self._action('short'), expected=20)
+        self.assertEqual(self.queue.get().repo_name, 'long')
+
+    def test_lanes_and_batches(self):
+        """
+        Lane limits cap running jobs of a lane, bulk jobs don't count
+        toward the depth limits or displace more important jobs, and
+        batch progress follows completed jobs.
+        """
+        bulk = {
+            'lane': ActionCall.LANES['BULK'],
+            'priority': ActionCall.PRIORITIES['LOW'],
+            'batch': 'abc',
+        }
+        self.queue = JobQueue(max_depth=1)
+        self.queue.set_lane_limit(ActionCall.LANES['BULK'], 1)
+        self.queue.put(self._action('one', **bulk))
+        self.queue.put(self._action('two', **bulk))
+        self.queue.put(self._action('three'))
+        self.assertEqual(self.queue.put(self._action('three', **bulk))[0], JobQueue.MERGED)
+        self.assertEqual(self.queue.batch_progress('abc'),
+                         {'total': 3, 'done': 0, 'pending': 3})
+        self.assertIsNone(self.queue.batch_progress('nope'))
+
+        first = self.queue.get(block=False)
+        self.assertEqual(first.repo_name, 'one')
+        merged = self.queue.get(block=False)
+        self.assertEqual((merged.repo_name, merged.lane), ('three', 'webhook'))
+        with self.assertRaises(Empty):
+            self.queue.get(block=False)
+
+        self.queue.task_done(first)
+        self.queue.task_done(merged)
+        self.assertEqual(self.queue.batch_progress('abc'),
+                         {'total': 3, 'done': 2, 'pending': 1})
+        self.assertEqual(self.queue.get(block=False).repo_name, 'two')
+
+    def test_batch_retries_and_eviction(self):
+        """
+        A retried batch job counts once toward its batch, and only the
+        most recently finished batches are kept.
+        """
+        failed = self._action('one', batch='abc')
+        self.queue.put(failed)
+        self.assertIs(self.queue.get(block=False), failed)
+        retried = self._action('one', batch='abc', attempt=2)
+        self.assertEqual(self.queue.retry(retried, 0), JobQueue.QUEUED)
+        self.queue.task_done(failed)
+        self.assertEqual(self.queue.batch_progress('abc'),
+                         {'total': 1, 'done': 0, 'pending': 1})
+        self.assertIs(self.queue.get(block=False), retried)
+        self.queue.task_done(retried)
+        self.assertEqual(self.queue.batch_progress('abc'),
+                         {'total': 1, 'done': 1, 'pending': 0})
+
+        with mock.patch.object(JobQueue, 'KEEP_FINISHED_BATCHES', 2):
+            for batch_id in ('def', 'ghi'):
+                self.queue.put(self._action(batch_id, batch=batch_id))
+                self.queue.task_done(self.queue.get(block=False))
+        self.assertIsNone(self.queue.batch_progress('abc'))
+        self.assertEqual(self.queue.batch_progress('ghi')['done'], 1)
+
+    def test_exclusive_repos(self):
+        """
+        Only one job per repo runs at a time, and idle only lanes wait
+        until no other job is waiting or running.
+        """
+        maintenance = {
+            'lane': ActionCall.LANES['MAINTENANCE'],
+            'priority': ActionCall.PRIORITIES['LOW'],
+        }
+        self.queue.set_lane_limit(ActionCall.LANES['MAINTENANCE'], 1, idle_only=True)
+        self.queue.put(self._action('one', 'MAINTENANCE', **maintenance))
+        self.queue.put(self._action('two', 'MAINTENANCE', **maintenance))
+        self.queue.put(self._action('one'))
+        self.queue.put(self._action('one', 'GET_LATEST'))
+
+        first = self.queue.get(block=False)
+        self.assertEqual(first.action_text, 'COURSE_IMPORT')
+        # Busy repo and busy queue hold everything else back
+        with self.assertRaises(Empty):
+            self.queue.get(block=False)
+        self.queue.task_done(first)
+        second = self.queue.get(block=False)
+        self.assertEqual(second.action_text, 'GET_LATEST')
+        with self.assertRaises(Empty):
+            self.queue.get(block=False)
+        self.queue.task_done(second)
+
+        third = self.queue.get(block=False)
+        self.assertEqual((third.repo_name, third.action_text), ('one', 'MAINTENANCE'))
+        # Lane limit of one
+        with self.assertRaises(Empty):
+            self.queue.get(block=False)
+        self.queue.task_done(third)
+        self.assertEqual(self.queue.get(block=False).repo_name, 'two')
+
+    def test_hold(self):
+        """
+        Jobs of a held repo wait until every hold is released, jobs of
+        other repos go ahead.
+        """
+        self.queue.hold('course')
+        self.queue.hold('course')
+        self.queue.put(self._action())
+        self.queue.put(self._action('other'))
+        self.assertEqual(self.queue.get(block=False).repo_name, 'other')
+        self.queue.release('course')
+        with self.assertRaises(Empty):
+            self.queue.get(block=False)
+        self.queue.release('course')
+        self.assertEqual(self.queue.get(block=False).repo_name, 'course')
+
+    def test_retry(self):
+        """
+        Retries wait out their delay, give way to waiting jobs for the
+        same repo and action, and never shed other jobs.
+        """
+        retried = self._action(attempt=2)
+        self.assertEqual(self.queue.retry(retried, 30), JobQueue.QUEUED)
+        with self.assertRaises(Empty):
+            self.queue.get(block=False)
+        fresh = self._action(sha='new')
+        self.assertEqual(self.queue.put(fresh)[0], JobQueue.MERGED)
+        self.monotonic.return_value = 130.0
+        self.assertIs(self.queue.get(block=False), fresh)
+
+        self.queue.put(self._action('other'))
+        self.assertEqual(self.queue.retry(self._action('other', attempt=2), 30), JobQueue.MERGED)
+
+        self.queue = JobQueue(max_depth=1)
+        self.queue.put(self._action('one', priority=ActionCall.PRIORITIES['LOW']))
+        with self.assertRaises(QueueFullError):
+            self.queue.retry(self._action('two', attempt=2), 30)
+        self.assertEqual(self.queue.qsize(), 1)
@@ -0,0 +1,100 @@
+"""
+Tests for ssh connection multiplexing
+"""
+import os
+import socket
+
+import mock
+
+from gitreload import metrics
+from gitreload.ssh import (
+    cleanup_stale_sockets, git_environment, socket_path, ssh_command
+)
+from gitreload.tests.base import GitreloadTestCase
+
+
+class TestSSH(GitreloadTestCase):
+    """
+    Validate control socket handling and reuse accounting
+    """
+    # pylint: disable=R0904
+
+    def setUp(self):
+        """
+        Use a scratch runtime directory with multiplexing turned on
+        """
+        # Short enough a path for control sockets
+        self.tmpdir = self.make_tmpdir(dir='/tmp')
+        self.patch_config(RUNTIME_DIR=self.tmpdir, SSH_CONTROL_PERSIST=300,
+                          SSH_OPTIONS='-o BatchMode=yes')
+        metrics.drain()
+
+    def _listen(self, url):
+        """
+        Stand in for an ssh master listening on the control socket of
+        ``url``
+        """
+        os.makedirs(os.path.join(self.tmpdir, 'ssh'), exist_ok=True)
+        master = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        master.bind(socket_path(url))
+        master.listen(1)
+        self.addCleanup(master.close)
+        return master
+
+    def test_ssh_command(self):
+        """
+        The ssh command enables a shared master connection
+        """
+        with mock.patch.dict(os.environ, {'GIT_SSH_COMMAND': 'ssh -i key'}):
+            self.assertEqual(ssh_command(), (
+                'ssh -i key -o ControlMaster=auto '
+                '-o ControlPath={0}/ssh/%r@%h:%p '
+                '-o ControlPersist=300 -o BatchMode=yes'
+            ).format(self.tmpdir))
+
+    def test_socket_path(self):
+        """
+        Control sockets are named after user, host and port
+        """
+        ssh_dir = os.path.join(self.tmpdir, 'ssh')
+        self.assertEqual(socket_path('git@github.com:mitodl/gitreload.git'),
+                         os.path.join(ssh_dir, 'git@github.com:22'))
+        self.assertEqual(socket_path('ssh://git@example.com:2222/course.git'),
+                         os.path.join(ssh_dir, 'git@example.com:2222'))
+        self.assertIsNone(socket_path('https://github.com/mitodl/gitreload.git'))
+        self.assertIsNone(socket_path('file:///tmp/course.git'))
+        self.assertIsNone(socket_path('/tmp/course.git'))
+
+    def test_reuse_metrics(self):
+        """
+        Count new, reused and stale connections
+        """
+        url = 'git@github.com:mitodl/gitreload.git'
+        env = git_environment(url)
+        self.assertEqual(env, {'GIT_SSH_COMMAND': ssh_command()})
+        self.assertEqual(metrics.drain(), {'ssh_connections_new': 1})
+
+        master = self._listen(url)
+        git_environment(url)
+        self.assertEqual(metrics.drain(), {'ssh_connections_reused': 1})
+
+        master.close()
+        git_environment(url)
+        self.assertEqual(metrics.drain(), {
+            'ssh_connections_new': 1, 'ssh_stale_sockets_removed': 1
+        })
+        self.assertFalse(os.path.exists(socket_path(url)))
+
+        with mock.patch('gitreload.config.Config.SSH_CONTROL_PERSIST', 0):
+            self.assertEqual(git_environment(url), {})
+
+    def test_cleanup_stale_sockets(self):
+        """
+        Only sockets without a listening master are removed
+        """
+        self.assertEqual(cleanup_stale_sockets(), 0)
+        self._listen('git@github.com:live.git')
+        self._listen('git@example.com:stale.git').close()
+        self.assertEqual(cleanup_stale_sockets(), 1)
+        self.assertEqual(os.listdir(os.path.join(self.tmpdir, 'ssh')),
+                         ['git@github.com:22'])
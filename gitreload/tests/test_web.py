@@ -6,11 +6,14 @@ import json
 import os
 import shutil
 import tempfile
+from queue import Empty
 
 import mock
 from git import Repo
 
+import gitreload.cluster
 import gitreload.web
+from gitreload.scheduler import QueueFullError
 from gitreload.tests.base import GitreloadTestBase
 
 
@@ -66,6 +69,40 @@ class TestWebApplication(GitreloadTestBase):
         repo.create_remote('origin', 'http://example.com/test/test.git')
         return repo
 
+    def test_lazy_startup(self):
+        """
+        Importing the app starts no processes, the backend is started
+        on first use.
+        """
+        import subprocess
+        import sys
+
+        output = subprocess.check_output([
+            sys.executable, '-c',
+            'import multiprocessing, gitreload.web; '
+            'print(len(multiprocessing.active_children()))'
+        ])
+        self.assertEqual(output.strip(), b'0')
+        self.assertIs(gitreload.web.get_backend(), gitreload.web.get_backend())
+        self.assertIs(gitreload.web.queued_jobs, gitreload.web.get_backend().queued_jobs)
+        with self.assertRaises(AttributeError):
+            gitreload.web.not_an_attribute  # pylint: disable=W0104
+
+    def test_sweeps_once(self):
+        """
+        Only one process at a time runs the background sweeps, and
+        only if there are any configured.
+        """
+        self.patch_config(RUNTIME_DIR=self.make_tmpdir(), RECONCILE_INTERVAL=0,
+                          MAINTENANCE_INTERVAL=0)
+        self.assertIsNone(gitreload.web.claim_sweeps())
+        self.patch_config(RECONCILE_INTERVAL=60)
+        lock_file = gitreload.web.claim_sweeps()
+        self.assertIsNotNone(lock_file)
+        self.assertIsNone(gitreload.web.claim_sweeps())
+        lock_file.close()
+        gitreload.web.claim_sweeps().close()
+
     def test_json_response(self):
         """
         Make sure we are getting the json we expect
@@ -100,11 +137,183 @@ class TestWebApplication(GitreloadTestBase):
             [{
                 'repo_name': 'testing',
                 'repo_url': 'http://example.com/testing.git',
-                'action': 'COURSE_IMPORT'
+                'action': 'COURSE_IMPORT',
+                'state': 'waiting',
             }])
         # Clean up queue
         queued_jobs.pop()
 
+    def test_queue_query(self):
+        """
+        The queue can be filtered, paged, counted and streamed, and
+        polls of an unchanged queue get a 304.
+        """
+        from gitreload.processing import ActionCall
+        for repo_name, action in (('course1', 'COURSE_IMPORT'), ('course2', 'COURSE_IMPORT'),
+                                  ('grader', 'GET_LATEST')):
+            gitreload.web.submit(ActionCall(
+                repo_name, 'http://example.com/{0}.git'.format(repo_name),
+                ActionCall.ACTION_TYPES[action]
+            ))
+        running = gitreload.web.queue.get(timeout=1)
+
+        def get(query, **headers):
+            """Get the queue with ``query``"""
+            return self.client.get('{0}?{1}'.format(self.QUEUE_URL, query), headers=headers)
+
+        def names(query):
+            """Repos of the jobs listed for ``query``"""
+            return [job['repo_name'] for job in json.loads(get(query).data)['queue']]
+
+        self.assertEqual(names('repo=course*'), ['course1', 'course2'])
+        self.assertEqual(names('action=GET_LATEST'), ['grader'])
+        self.assertEqual(names('state=running'), [running.repo_name])
+        page = json.loads(get('limit=2&offset=1').data)
+        self.assertEqual(
+            (page['queue_length'], page['matched'], page['offset'], page['next_offset']),
+            (3, 3, 1, None)
+        )
+        self.assertEqual(json.loads(get('limit=1').data)['next_offset'], 1)
+        self.assertEqual(get('limit=x').status_code, 400)
+        counts = json.loads(get('counts=1&repo=course*').data)
+        self.assertNotIn('queue', counts)
+        self.assertEqual(counts['counts'], {
+            'state': {'running': 1, 'waiting': 1}, 'action': {'COURSE_IMPORT': 2}
+        })
+        self.assertEqual((counts['queue_length'], counts['matched']), (3, 2))
+
+        response = get('format=ndjson')
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        self.assertTrue(response.is_streamed)
+        self.assertEqual(
+            [json.loads(line)['repo_name'] for line in response.data.splitlines()],
+            ['course1', 'course2', 'grader']
+        )
+        self.assertEqual(
+            [json.loads(line)['repo_name'] for line in get('format=ndjson&offset=1&limit=1').data.splitlines()],
+            ['course2']
+        )
+
+        etag = get('repo=course*').headers['ETag']
+        self.assertEqual(get('repo=course*', **{'If-None-Match': etag}).status_code, 304)
+        gitreload.web.queued_jobs.remove(running)
+        gitreload.web.queue.task_done(running)
+        response = get('repo=course*', **{'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+        # The finished job is gone and the others are still waiting
+        self.assertEqual(names('state=waiting'), ['course2', 'grader'])
+
+        first = gitreload.web.queue.get(timeout=1)
+        second = gitreload.web.queue.get(timeout=1)
+        self.assertEqual([first.repo_name, second.repo_name], ['course2', 'grader'])
+        self.assertEqual(names('state=running'), ['course2', 'grader'])
+        # Jobs finishing out of order leave the right jobs listed
+        gitreload.web.queued_jobs.remove(second)
+        gitreload.web.queue.task_done(second)
+        self.assertEqual(names(''), ['course2'])
+        gitreload.web.queued_jobs.remove(first)
+        gitreload.web.queue.task_done(first)
+        self.assertEqual(names(''), [])
+
+    def test_probes(self):
+        """
+        The liveness probe always answers, and the readiness probe
+        reports the last health checks of the backend without starting
+        it.
+        """
+        response = self.client.get('/healthz')
+        self.assertEqual((response.status_code, json.loads(response.data)), (200, {'status': 'ok'}))
+
+        with mock.patch('gitreload.web._backend', None), \
+                mock.patch('gitreload.web.get_backend') as get_backend:
+            response = self.client.get('/readyz')
+        self.assertFalse(get_backend.called)
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(json.loads(response.data)['reason'], 'backend not started')
+
+        health = gitreload.web.get_backend().health
+        with mock.patch('gitreload.config.Config.REPODIR', self.tmpdir):
+            # The workers were stopped for the tests
+            health.refresh()
+            response = self.client.get('/readyz')
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(json.loads(response.data)['checks']['workers']['alive'], 0)
+            with mock.patch('gitreload.config.Config.READY_MIN_WORKERS', 0):
+                health.refresh()
+            with mock.patch('gitreload.health.check_repodir') as check_repodir:
+                response = self.client.get('/readyz')
+            self.assertFalse(check_repodir.called)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(json.loads(response.data)['ready'])
+
+        # Without a refresh interval there is no monitor, and the
+        # checks run on each probe
+        backend = gitreload.web.get_backend()
+        self.assertIsNone(gitreload.web.start_health_monitor(backend, 0))
+        with mock.patch.object(backend, 'health', None), \
+                mock.patch('gitreload.config.Config.REPODIR', self.tmpdir), \
+                mock.patch('gitreload.config.Config.READY_MIN_WORKERS', 0):
+            response = self.client.get('/readyz')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data)['checks']['workers']['alive'], 0)
+
+    def test_metrics(self):
+        """
+        Make sure counters from this process and the workers are
+        reported together
+        """
+        from gitreload import metrics
+
+        metrics.drain()
+        gitreload.web.queue.add_metrics({'ssh_connections_new': 2})
+        metrics.incr('ssh_connections_new')
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data), {'ssh_connections_new': 3})
+
+    def test_refresh_all(self):
+        """
+        Make sure the bulk refresh endpoint requires the admin token and
+        queues a batch for the matching checkouts that have an origin.
+        """
+        for repo_name in ('course-a', 'course-b', 'grader'):
+            self._make_repo(repo_name)
+        Repo.init(os.path.join(self.tmpdir, 'course-local'))
+        headers = {'Authorization': 'Bearer sekrit'}
+
+        self.assertEqual(self.client.post('/refresh').status_code, 403)
+        with mock.patch('gitreload.config.Config.ADMIN_TOKEN', 'sekrit'), \
+                mock.patch('gitreload.config.Config.REPODIR', self.tmpdir):
+            self.assertEqual(self.client.post('/refresh').status_code, 403)
+            response = self.client.post('/refresh', json={'action': 'NOPE'}, headers=headers)
+            self.assertEqual(response.status_code, 400)
+
+            response = self.client.post(
+                '/refresh', json={'pattern': 'course-*'}, headers=headers
+            )
+            self.assertEqual(response.status_code, 200)
+            status = json.loads(response.data)
+            self.assertEqual(
+                (status['total'], status['done'], status['pending']), (2, 0, 2)
+            )
+            self.assertEqual(status['skipped'], ['course-local'])
+            self.assertEqual(len(gitreload.web.queued_jobs), 2)
+
+            for _ in range(2):
+                action = gitreload.web.queue.get(timeout=1)
+                self.assertEqual(action.lane, 'bulk')
+                self.assertEqual(action.repo_url, 'http://example.com/test/test.git')
+                gitreload.web.queued_jobs.pop()
+                gitreload.web.queue.task_done(action)
+
+            response = self.client.get(
+                '/refresh/{0}'.format(status['batch_id']), headers=headers
+            )
+            self.assertEqual(json.loads(response.data)['done'], 2)
+            response = self.client.get('/refresh/nope', headers=headers)
+            self.assertEqual(response.status_code, 404)
+
     def test_hook_only_post(self):
         """
         Test various methods to make sure we only respond on POST
@@ -232,6 +441,219 @@ class TestWebApplication(GitreloadTestBase):
         self.assertEqual(self.get_json_msg(response.data),
                          "Branch pushed doesn't match local branch, ignoring")
 
+    def test_early_rejection(self):
+        """
+        Pushes to other branches are turned away without decoding the
+        payload, and oversized payloads are refused.
+        """
+        from gitreload import metrics
+
+        self._make_repo('test')
+        metrics.drain()
+        with mock.patch('gitreload.config.Config.REPODIR', self.tmpdir), \
+                mock.patch('gitreload.web.loads') as mocked_loads:
+            response = self.client.post(
+                self.HOOK_COURSE_URL,
+                data=self._make_payload('test', 'feature_branch'),
+                headers={'X-Github-Event': 'push', 'Content-Type': 'application/json'}
+            )
+        self.assertEqual(self.get_json_msg(response.data),
+                         "Branch pushed doesn't match local branch, ignoring")
+        self.assertFalse(mocked_loads.called)
+        self.assertEqual(metrics.drain(), {'webhooks_rejected_early': 1})
+
+        with mock.patch('gitreload.config.Config.MAX_PAYLOAD_BYTES', 10):
+            response = self.client.post(
+                self.HOOK_COURSE_URL,
+                data={'payload': self._make_payload('test')},
+                headers={'X-Github-Event': 'push'}
+            )
+        self.assertEqual(response.status_code, 413)
+        self.assertEqual(self.get_json_msg(response.data), 'Payload too large')
+
+    def test_fanout(self):
+        """
+        A push is dispatched to every checkout of the repository with
+        the pushed branch checked out, whatever their names.
+        """
+        for name, branch in (('grader', 'master'), ('grader-live', 'master'),
+                             ('grader-devel', 'devel')):
+            repo = self._make_repo(name)
+            repo.remotes.origin.set_url('git@github.com:testuser/grader.git')
+            repo.git.symbolic_ref('HEAD', 'refs/heads/{0}'.format(branch))
+        payload = json.loads(self._make_payload('renamed'))
+        payload['repository']['html_url'] = 'https://github.com/testuser/grader'
+
+        with mock.patch('gitreload.config.Config.REPODIR', self.tmpdir):
+            response = self.client.post(
+                self.HOOK_GET_LATEST_URL,
+                data={'payload': json.dumps(payload)},
+                headers={'X-Github-Event': 'push'}
+            )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            self.get_json_msg(response.data),
+            'Added git update task to queue for 2 of 2 checkouts. Queue size was 2'
+        )
+
+        # Pushing again before the jobs start merges into them
+        with mock.patch('gitreload.config.Config.REPODIR', self.tmpdir):
+            response = self.client.post(
+                self.HOOK_GET_LATEST_URL,
+                data={'payload': json.dumps(payload)},
+                headers={'X-Github-Event': 'push'}
+            )
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(
+            self.get_json_msg(response.data),
+            'Merged git update task into queued tasks for 2 of 2 checkouts. Queue size was 2'
+        )
+        actions = [gitreload.web.queue.get(timeout=1) for _ in range(2)]
+        self.assertEqual(
+            sorted(action.repo_name for action in actions), ['grader', 'grader-live']
+        )
+        for action in actions:
+            gitreload.web.queued_jobs.pop()
+            gitreload.web.queue.task_done(action)
+
+    def test_cluster_forward(self):
+        """
+        Pushes for repos owned by another node are forwarded to it,
+        unless they were forwarded here already.
+        """
+        repo_name = 'test'
+        self._make_repo(repo_name)
+        peers = ['http://node0:5000', 'http://node1:5000']
+        peer = gitreload.cluster.HashRing(peers, 64).owner(repo_name)
+        reply = (202, {'Content-Type': 'application/json'}, b'{"msg": "remote"}')
+
+        with mock.patch('gitreload.config.Config.REPODIR', self.tmpdir), \
+                mock.patch('gitreload.config.Config.CLUSTER_PEERS', peers), \
+                mock.patch('gitreload.config.Config.CLUSTER_SELF',
+                           [other for other in peers if other != peer][0]), \
+                mock.patch('gitreload.cluster.forward', return_value=reply) as forward:
+            response = self.client.post(
+                self.HOOK_GET_LATEST_URL + '?force=1',
+                data={'payload': self._make_payload(repo_name)},
+                headers={'X-Github-Event': 'push'}
+            )
+            self.assertEqual(response.status_code, 202)
+            self.assertEqual(self.get_json_msg(response.data), 'remote')
+            self.assertEqual(forward.call_args[0][:2], (peer, '/update?force=1'))
+            self.assertEqual(len(gitreload.web.queued_jobs), 0)
+
+            response = self.client.post(
+                self.HOOK_GET_LATEST_URL,
+                data={'payload': self._make_payload(repo_name)},
+                headers={'X-Github-Event': 'push',
+                         gitreload.cluster.FORWARDED_HEADER: 'http://node2:5000'}
+            )
+            self.assertEqual(forward.call_count, 1)
+        self.assertEqual(response.status_code, 200)
+        action = gitreload.web.queue.get(timeout=1)
+        self.assertEqual(action.repo_name, repo_name)
+        gitreload.web.queued_jobs.pop()
+        gitreload.web.queue.task_done(action)
+
+    def test_cluster_queue(self):
+        """
+        The queue page gathers the queues of every node, unless only
+        the local one is asked for.
+        """
+        peers = {'http://node1:5000': {'queue_length': 1, 'queue': [{'repo_name': 'other'}]},
+                 'http://node2:5000': None}
+        with mock.patch('gitreload.config.Config.CLUSTER_PEERS',
+                        ['http://node0:5000'] + list(peers)), \
+                mock.patch('gitreload.config.Config.CLUSTER_SELF', 'http://node0:5000'), \
+                mock.patch('gitreload.cluster.peer_queues', return_value=peers):
+            status = json.loads(self.client.get('/queue').data.decode('utf-8'))
+            local = json.loads(self.client.get('/queue?local=1').data.decode('utf-8'))
+        self.assertEqual(status['queue_length'], 1)
+        self.assertEqual(status['queue'], [{'repo_name': 'other', 'node': 'http://node1:5000'}])
+        self.assertEqual(
+            status['nodes'],
+            {'http://node0:5000': 0, 'http://node1:5000': 1, 'http://node2:5000': None}
+        )
+        self.assertNotIn('nodes', local)
+
+    def test_dependents(self):
+        """
+        A push to a shared repo queues a re-import of the repos
+        depending on it, once each.
+        """
+        for repo_name in ('library', 'course', 'other'):
+            self._make_repo(repo_name)
+        linked = {'course': ['library'], 'other': ['library'], 'missing': ['library']}
+
+        with mock.patch('gitreload.config.Config.REPODIR', self.tmpdir), \
+                mock.patch('gitreload.config.Config.LINKED_REPOS', linked), \
+                mock.patch('gitreload.config.Config.ALSO_CLONE_REPOS',
+                           {'course': {'library': None}}):
+            # The second push and its re-imports merge into the queued ones
+            for status in (200, 202):
+                response = self.client.post(
+                    self.HOOK_GET_LATEST_URL,
+                    data={'payload': self._make_payload('library')},
+                    headers={'X-Github-Event': 'push'}
+                )
+                self.assertEqual(response.status_code, status)
+        self.assertEqual(
+            [(action.repo_name, action.action_text) for action in gitreload.web.queued_jobs],
+            [('library', 'GET_LATEST'), ('course', 'COURSE_IMPORT'), ('other', 'COURSE_IMPORT')]
+        )
+        for _ in range(3):
+            action = gitreload.web.queue.get(timeout=1)
+            gitreload.web.queued_jobs.pop()
+            gitreload.web.queue.task_done(action)
+
+        # A refused push doesn't re-import its dependents
+        with mock.patch('gitreload.config.Config.REPODIR', self.tmpdir), \
+                mock.patch('gitreload.web.submit', side_effect=QueueFullError(30)), \
+                mock.patch('gitreload.web.queue_dependents') as queue_dependents:
+            response = self.client.post(
+                self.HOOK_GET_LATEST_URL,
+                data={'payload': self._make_payload('library')},
+                headers={'X-Github-Event': 'push'}
+            )
+        self.assertEqual(response.status_code, 429)
+        queue_dependents.assert_not_called()
+
+    def test_prefetching(self):
+        """
+        With prefetching, webhook jobs are held in the queue until the
+        prefetcher releases them, also when the queue refuses them.
+        """
+        self._make_repo('test')
+        backend = gitreload.web.get_backend()
+        with mock.patch.object(backend, 'prefetcher') as mocked_prefetcher, \
+                mock.patch('gitreload.config.Config.REPODIR', self.tmpdir):
+            response = self.client.post(
+                self.HOOK_COURSE_URL,
+                data={'payload': self._make_payload('test')},
+                headers={'X-Github-Event': 'push'}
+            )
+            self.assertEqual(response.status_code, 200)
+            action = mocked_prefetcher.submit.call_args[0][0]
+            self.assertEqual(action.repo_name, 'test')
+            with mock.patch('gitreload.config.Config.MAX_QUEUE_DEPTH', 1), \
+                    mock.patch.object(backend, 'queue', gitreload.web.make_queue()):
+                backend.queue.put(action)
+                response = self.client.post(
+                    self.HOOK_GET_LATEST_URL,
+                    data={'payload': self._make_payload('test')},
+                    headers={'X-Github-Event': 'push'}
+                )
+                self.assertEqual(response.status_code, 429)
+                self.assertEqual(backend.queue.get(block=False).action_text, 'COURSE_IMPORT')
+            self.assertEqual(mocked_prefetcher.submit.call_count, 1)
+        with self.assertRaises(Empty):
+            backend.queue.get(block=False)
+        backend.queue.release('test')
+        action = backend.queue.get(block=False)
+        self.assertEqual(action.repo_name, 'test')
+        backend.queued_jobs.pop()
+        backend.queue.task_done(action)
+
     def test_queue_put(self):
         """
         Send correct request with right branch and make sure the queue
@@ -305,6 +727,86 @@ class TestWebApplication(GitreloadTestBase):
         self.assertEqual(self.get_json_msg(response.data),
                          'Server configuration issue')
 
+    def test_action_kwargs(self):
+        """
+        Make sure the pushed tree SHA and force flag are passed along to
+        the queued action.
+        """
+        repo_name = 'test'
+        self._make_repo(repo_name)
+        payload = json.loads(self._make_payload(repo_name))
+        payload['head_commit'] = {'id': 'abc', 'tree_id': 'def'}
+
+        with mock.patch('gitreload.config.Config.REPODIR', self.tmpdir):
+            response = self.client.post(
+                '{0}?force=1'.format(self.HOOK_COURSE_URL),
+                data={'payload': json.dumps(payload)},
+                headers={'X-Github-Event': 'push'}
+            )
+        self.assertEqual(response.status_code, 200)
+        action = gitreload.web.queue.get(timeout=1)
+        gitreload.web.queued_jobs.pop()
+        gitreload.web.queue.task_done()
+        self.assertEqual(action.kwargs, {'tree_sha': 'def', 'force': True})
+
+    def test_debounced_merge(self):
+        """
+        Pushes arriving within the debounce window are merged into the
+        job that is already waiting, only the first of them superseding
+        a running command.
+        """
+        repo_name = 'test'
+        self._make_repo(repo_name)
+
+        with mock.patch('gitreload.config.Config.REPODIR', self.tmpdir), \
+                mock.patch('gitreload.config.Config.DEBOUNCE_OVERRIDES', {repo_name: 0.5}), \
+                mock.patch('gitreload.config.Config.SUPERSEDE_REPOS', [repo_name]), \
+                mock.patch('gitreload.web.supersede') as supersede:
+            for _ in range(2):
+                response = self.client.post(
+                    self.HOOK_GET_LATEST_URL,
+                    data={'payload': self._make_payload(repo_name)},
+                    headers={'X-Github-Event': 'push'}
+                )
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(self.get_json_msg(response.data),
+                         'Merged git update task into queued task. Queue size was 1')
+        self.assertEqual(len(gitreload.web.queued_jobs), 1)
+        self.assertEqual(supersede.call_count, 1)
+        gitreload.web.queue.get(timeout=2)
+        gitreload.web.queued_jobs.pop()
+        gitreload.web.queue.task_done()
+
+    def test_queue_full(self):
+        """
+        Make sure a full queue answers with a 429 and Retry-After
+        """
+        repo_name = 'test'
+        self._make_repo(repo_name)
+
+        with mock.patch('gitreload.config.Config.MAX_QUEUE_DEPTH', 1), \
+                mock.patch('gitreload.config.Config.QUEUE_RETRY_AFTER', 30):
+            gitreload.web.get_backend().queue = gitreload.web.make_queue()
+        with mock.patch('gitreload.config.Config.REPODIR', self.tmpdir):
+            self.client.post(
+                self.HOOK_GET_LATEST_URL,
+                data={'payload': self._make_payload(repo_name)},
+                headers={'X-Github-Event': 'push'}
+            )
+            response = self.client.post(
+                self.HOOK_COURSE_URL,
+                data={'payload': self._make_payload(repo_name)},
+                headers={'X-Github-Event': 'push'}
+            )
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.headers['Retry-After'], '30')
+        self.assertEqual(self.get_json_msg(response.data),
+                         'Queue is full, try again later')
+        self.assertEqual(len(gitreload.web.queued_jobs), 1)
+        gitreload.web.queue.get(timeout=1)
+        gitreload.web.queued_jobs.pop()
+        gitreload.web.queue.task_done()
+
     def test_update_repo(self):
         """
         Send correct request with right branch and make sure the queue
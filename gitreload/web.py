@@ -1,22 +1,182 @@
 """
 Flask app module for gitreload
 """
+import atexit
+import hashlib
+import hmac
 import json
 import logging
 import os
-from multiprocessing import JoinableQueue, Manager
+import threading
+import time
+import uuid
+from collections import Counter, namedtuple
+from contextlib import suppress
+from fnmatch import fnmatch
+from itertools import islice
+from urllib.parse import parse_qs
 
 from flask import Flask, request, Response
-from git import Repo, InvalidGitRepositoryError, NoSuchPathError
+from werkzeug.http import parse_etags
 
+from gitreload import cluster, metrics, resources, ssh
 from gitreload.config import Config, configure_logging
-from gitreload.processing import GitAction, ActionCall
+from gitreload.durations import DurationHistory
+from gitreload.health import HealthMonitor, check_readiness
+from gitreload.links import dependents
+from gitreload.maintenance import Maintainer
+from gitreload.payload import loads, peek_body
+from gitreload.prefetch import Prefetcher
+from gitreload.processing import GitAction, GitActionThread, ActionCall, close_repos, supersede
+from gitreload.reconcile import Reconciler
+from gitreload.refs import BranchIndex, CheckoutIndex, list_checkouts, origin_url
+from gitreload.scheduler import (
+    JobQueue, QueueFullError, QueueManager, ShortestJobFirst
+)
+from gitreload.statefile import try_lock
 
 
 log = logging.getLogger('gitreload')  # pylint: disable=C0103
-queue = JoinableQueue()  # pylint: disable=C0103
-manager = Manager()  # pylint: disable=C0103
-queued_jobs = manager.list([])  # pylint: disable=C0103,E1101
+
+# Former module level attributes now provided by the Backend
+BACKEND_ATTRIBUTES = (
+    'manager', 'queue', 'queued_jobs', 'workers', 'reconciler', 'maintainer'
+)
+
+
+class Backend:
+    """
+    The job queue and list of queued jobs, along with the workers and
+    background sweeps using them.
+
+    With the ``process`` executor the workers are GitAction processes
+    and the queue and list are hosted by a multiprocessing manager.
+    With the ``thread`` executor they are GitActionThread threads
+    sharing a plain JobQueue and list with the web application.
+    """
+    # pylint: disable=R0902
+    WORKER_CLASSES = {
+        'process': GitAction,
+        'thread': GitActionThread,
+    }
+
+    def __init__(self, executor='process'):
+        """
+        Create the queue and list of queued jobs, starting the manager
+        hosting them for the process executor
+        """
+        self.pid = os.getpid()
+        self.worker_class = self.WORKER_CLASSES[executor]
+        if executor == 'process':
+            self.manager = QueueManager()
+            self.manager.start()  # pylint: disable=E1101
+            self.queue_class = self.manager.JobQueue  # pylint: disable=E1101
+            self.queued_jobs = self.manager.list([])  # pylint: disable=E1101
+        else:
+            self.manager = None
+            self.queue_class = JobQueue
+            self.queued_jobs = []
+        self.queue = make_queue(self.queue_class)
+        self.workers = []
+        self.sweeps_lock = None
+        self.reconciler = None
+        self.maintainer = None
+        self.health = None
+        self.prefetcher = None
+
+    def stop(self):
+        """
+        Stop the worker processes ahead of the manager they are waiting
+        on, worker threads are daemons and go away on exit, and close
+        the Repos cached by worker threads.  The background sweeps are
+        stopped before handing them over to another process.
+        """
+        for sweeper in (self.reconciler, self.maintainer):
+            if sweeper:
+                sweeper.stop()
+        if self.sweeps_lock:
+            self.sweeps_lock.close()
+        if self.health:
+            self.health.stop()
+        if self.prefetcher:
+            self.prefetcher.stop()
+        processes = [worker for worker in self.workers if hasattr(worker, 'terminate')]
+        for worker in processes:
+            worker.terminate()
+        for worker in processes:
+            worker.join()
+        if self.manager:
+            self.manager.shutdown()  # pylint: disable=E1101
+        close_repos()
+
+
+_backend = None  # pylint: disable=C0103
+_backend_lock = threading.RLock()  # pylint: disable=C0103
+
+
+def get_backend():
+    """
+    Return the backend of this process, starting it along with the
+    workers and background sweeps on first use.  Nothing is started
+    on import, so the app can be imported cheaply and preloaded before
+    forking (e.g. by ``gunicorn --preload``), with each process
+    starting its own backend.  Only the process holding the sweeps lock
+    runs the reconciler and maintainer.
+    """
+    global _backend  # pylint: disable=C0103,W0603
+    with _backend_lock:
+        if _backend is None or _backend.pid != os.getpid():
+            started = time.monotonic()
+            resources.check_classes()
+            ssh.cleanup_stale_sockets()
+            _backend = Backend(Config.EXECUTOR)
+            _backend.workers = start_workers(Config.NUM_THREADS)
+            _backend.sweeps_lock = claim_sweeps()
+            if _backend.sweeps_lock:
+                _backend.reconciler = start_reconciler(Config.RECONCILE_INTERVAL)
+                _backend.maintainer = start_maintainer(Config.MAINTENANCE_INTERVAL)
+            _backend.prefetcher = start_prefetcher(_backend, Config.PREFETCH_CONCURRENCY)
+            _backend.health = start_health_monitor(_backend, Config.HEALTH_INTERVAL)
+            atexit.register(_backend.stop)
+            elapsed = time.monotonic() - started
+            metrics.incr('backend_startup_ms', int(elapsed * 1000))
+            log.info('Started %s backend with %s worker(s) in %.3f seconds',
+                     Config.EXECUTOR, Config.NUM_THREADS, elapsed)
+        return _backend
+
+
+def __getattr__(name):
+    """
+    Keep ``gitreload.web.queue`` and the other former module level
+    attributes working, starting the backend when they are used.
+    """
+    if name in BACKEND_ATTRIBUTES:
+        return getattr(get_backend(), name)
+    raise AttributeError('module {0!r} has no attribute {1!r}'.format(__name__, name))
+
+
+def make_queue(queue_class=None):
+    """
+    Create the job queue shared with the workers, configured with the
+    queue depth limits and scheduling policy.
+    """
+    queue_class = queue_class or get_backend().queue_class
+    policy = None
+    if Config.SCHEDULING_POLICY == 'sjf':
+        policy = ShortestJobFirst(Config.SJF_AGING, Config.SJF_DEFAULT_ESTIMATE)
+    new_queue = queue_class(
+        Config.MAX_QUEUE_DEPTH,
+        Config.MAX_REPO_QUEUE_DEPTH,
+        Config.QUEUE_RETRY_AFTER,
+        policy,
+    )
+    new_queue.set_lane_limit(ActionCall.LANES['BULK'], Config.BULK_CONCURRENCY)
+    new_queue.set_lane_limit(ActionCall.LANES['MAINTENANCE'], 1, idle_only=True)
+    return new_queue
+
+
+branches = BranchIndex()  # pylint: disable=C0103
+checkouts = CheckoutIndex(Config.CHECKOUT_INDEX_TTL)  # pylint: disable=C0103
 
 app = Flask('gitreload')  # pylint: disable=C0103
 
@@ -32,81 +192,465 @@ def start_workers(num_threads):
     """
     Function to start the import workers
     """
+    backend = get_backend()
     local_workers = []
     log.debug('Starting up %s worker(s)', num_threads)
     # Create manager for monitoring queue
     for i in range(num_threads):
-        worker_thread = GitAction(queue, i, queued_jobs)
+        worker_thread = backend.worker_class(backend.queue, i, backend.queued_jobs)
         worker_thread.start()
         local_workers.append(worker_thread)
     return local_workers
 
 
-def verify_hook():
+def debounce_for(action):
+    """
+    Get the debounce window for an action, with per repo overrides
+    taking precedence over per action type ones.
+    """
+    for key in (action.repo_name, action.action_text):
+        if key in Config.DEBOUNCE_OVERRIDES:
+            return Config.DEBOUNCE_OVERRIDES[key]
+    return Config.DEBOUNCE_SECONDS
+
+
+def forget(action):
+    """
+    Remove the entry of ``action``, or of the job it was merged into,
+    from the list of queued jobs.
+    """
+    with suppress(ValueError):
+        get_backend().queued_jobs.remove(action)
+
+
+def submit(action):
+    """
+    Queue an action for the workers, returning the JobQueue status.
+    Merged actions aren't counted as new queued jobs, and neither are
+    any lower priority jobs shed to make room for the action.  Raises
+    QueueFullError if the queue has no room for it.
+    """
+    backend = get_backend()
+    # Hold the job until its push is prefetched, before a worker can take it
+    prefetching = backend.prefetcher and action.lane == ActionCall.LANES['WEBHOOK']
+    if prefetching:
+        backend.queue.hold(action.repo_name)
+    backend.queued_jobs.append(action)
+    try:
+        status, shed = backend.queue.put(
+            action, debounce_for(action), Config.DEBOUNCE_MAX_DELAY,
+            DurationHistory.from_config().estimate(action)
+        )
+    except QueueFullError:
+        forget(action)
+        if prefetching:
+            backend.queue.release(action.repo_name)
+        raise
+    if prefetching:
+        backend.prefetcher.submit(action)
+    for item in shed:
+        log.warning('Queue full, shed queued job %s', item)
+        forget(item)
+    if status == JobQueue.MERGED:
+        # The running command was already superseded when the job
+        # merged into was queued
+        forget(action)
+    elif action.lane == ActionCall.LANES['WEBHOOK'] and \
+            {'*', action.repo_name} & set(Config.SUPERSEDE_REPOS):
+        supersede(action)
+    return status
+
+
+def queue_action(action, task_name):
+    """
+    Submit an action and build the response for the webhook, asking
+    the sender to retry later if the queue is full.
+    """
+    try:
+        status = submit(action)
+    except QueueFullError as exc:
+        log.warning('Queue full, refusing %s', action)
+        return Response(
+            json_dump_msg('Queue is full, try again later'), 429,
+            {'Retry-After': str(exc.retry_after)}
+        )
+    queued_jobs = get_backend().queued_jobs
+    if status == JobQueue.MERGED:
+        return Response(json_dump_msg(
+            'Merged {0} task into queued task. '
+            'Queue size was {1}'.format(task_name, len(queued_jobs))
+        ), 202)
+    return json_dump_msg('Added {0} task to queue. '
+                         'Queue size was {1}'.format(task_name, len(queued_jobs)))
+
+
+def queue_fanout(actions, task_name):
+    """
+    Submit the actions for all checkouts of a pushed branch and build
+    the response for the webhook, asking the sender to retry later
+    only if none of them could be queued, and answering 202 if all of
+    them were merged into queued jobs.
+    """
+    accepted = merged = 0
+    retry_after = None
+    for action in actions:
+        try:
+            status = submit(action)
+        except QueueFullError as exc:
+            log.warning('Queue full, refusing %s', action)
+            retry_after = exc.retry_after
+        else:
+            accepted += 1
+            merged += status == JobQueue.MERGED
+    if not accepted:
+        return Response(
+            json_dump_msg('Queue is full, try again later'), 429,
+            {'Retry-After': str(retry_after)}
+        )
+    queued_jobs = get_backend().queued_jobs
+    if merged == accepted:
+        return Response(json_dump_msg(
+            'Merged {0} task into queued tasks for {1} of {2} checkouts. '
+            'Queue size was {3}'.format(task_name, merged, len(actions), len(queued_jobs))
+        ), 202)
+    return json_dump_msg(
+        'Added {0} task to queue for {1} of {2} checkouts{3}. '
+        'Queue size was {4}'.format(
+            task_name, accepted, len(actions),
+            ', {0} merged into queued tasks'.format(merged) if merged else '',
+            len(queued_jobs)
+        )
+    )
+
+
+def submit_background(action):
+    """
+    Queue an action found necessary by a background sweep, unless a
+    job for it is already queued or running.
+    """
+    if any(item.key == action.key for item in get_backend().queued_jobs[:]):
+        return
+    submit(action)
+
+
+def claim_sweeps():
+    """
+    Lock file held by the one process of the host that runs the
+    background sweeps, or None if another process already runs them
+    or there are none to run
+    """
+    if not (Config.RECONCILE_INTERVAL or Config.MAINTENANCE_INTERVAL):
+        return None
+    os.makedirs(Config.RUNTIME_DIR, exist_ok=True)
+    lock_file = try_lock(os.path.join(Config.RUNTIME_DIR, 'sweeps.lock'))
+    if lock_file is None:
+        log.info('Background sweeps run in another process')
+    return lock_file
+
+
+def start_reconciler(interval):
+    """
+    Start the background reconciler if an interval is configured
+    """
+    if not interval:
+        return None
+    log.debug('Starting reconciler every %s seconds', interval)
+    local_reconciler = Reconciler(submit_background, interval)
+    local_reconciler.start()
+    return local_reconciler
+
+
+def start_maintainer(interval):
+    """
+    Start the background maintainer if an interval is configured
+    """
+    if not interval:
+        return None
+    log.debug('Starting maintainer every %s seconds', interval)
+    local_maintainer = Maintainer(submit_background, interval)
+    local_maintainer.start()
+    return local_maintainer
+
+
+def start_prefetcher(backend, concurrency):
+    """
+    Start prefetching pushes for the jobs of ``backend`` if a
+    concurrency is configured
+    """
+    if not concurrency:
+        return None
+    log.debug('Prefetching pushes with %s thread(s)', concurrency)
+    return Prefetcher(backend.queue, concurrency)
+
+
+def start_health_monitor(backend, interval):
+    """
+    Run the health checks of ``backend`` once and keep refreshing
+    them in the background if an interval is configured
+    """
+    if not interval:
+        return None
+    log.debug('Refreshing health checks every %s seconds', interval)
+    monitor = HealthMonitor(backend, interval)
+    monitor.refresh()
+    monitor.start()
+    return monitor
+
+
+def check_push(repo_name, ref):
+    """
+    Check a push of ``ref`` to ``repo_name`` against the checkouts,
+    returning the response to send if the push is to be ignored, and
+    None if it is for the branch checked out in the repo.
+    """
+    # Check that repo is already checked out as that is our method for
+    # validating this repo is good to pull.
+    if not os.path.isdir(Config.REPODIR):
+        log.critical("Repo directory %s doesn't exist", Config.REPODIR)
+        return Response(json_dump_msg('Server configuration issue'), 500)
+
+    try:
+        local_branch = branches.branch(os.path.join(Config.REPODIR, repo_name))
+    except OSError:
+        log.critical('Repository %s not in list of available '
+                     'repositories', repo_name)
+        return Response(json_dump_msg('Repository not valid'), 500)
+
+    if local_branch is None:
+        message = 'Unable to get current branch of checked out repo'
+        log.error(message)
+        return Response(json_dump_msg(message), 500)
+
+    # No sense importing course when the current branch hasn't been updated
+    if not local_branch == ref:
+        message = "Branch pushed doesn't match local branch, ignoring"
+        log.info(message)
+        return Response(json_dump_msg(message))
+    return None
+
+
+HOOK_ACTIONS = {
+    'COURSE_IMPORT': 'course import',
+    'GET_LATEST': 'git update',
+}
+HOOK_PATHS = {
+    'COURSE_IMPORT': '/',
+    'GET_LATEST': '/update',
+}
+
+# A received webhook, independent of the server it came in through.
+# ``read_body`` returns the raw body and is only called for pushes,
+# ``forwarded`` is set for hooks forwarded by another cluster node.
+HookRequest = namedtuple(
+    'HookRequest', ['event', 'content_length', 'form', 'force', 'read_body', 'forwarded']
+)
+
+
+def forward_hook(action_text, hook):
+    """
+    Forward a push for a repo owned by another cluster node to that
+    node, returning its response, or None if the push is to be handled
+    here.
+    """
+    limit = Config.MAX_PAYLOAD_BYTES
+    if not cluster.enabled() or hook.forwarded or hook.event != 'push' \
+            or (limit and (hook.content_length or 0) > limit):
+        return None
+    data = hook.read_body()
+    repo_name = peek_body(data, hook.form)[0]
+    if repo_name is None:
+        try:
+            payload = loads(
+                parse_qs(data.decode('ascii', 'replace'))['payload'][0] if hook.form else data
+            )
+            repo_name = payload['repository']['name']
+        except (KeyError, TypeError, ValueError):
+            return None
+    peer = cluster.owner(repo_name)
+    if peer is None:
+        return None
+
+    log.info('Forwarding push for %s to cluster node %s', repo_name, peer)
+    metrics.incr('webhooks_forwarded')
+    try:
+        status, headers, body = cluster.forward(
+            peer,
+            HOOK_PATHS[action_text] + ('?force=1' if hook.force else ''),
+            data,
+            {
+                'X-Github-Event': hook.event,
+                'Content-Type': (
+                    'application/x-www-form-urlencoded' if hook.form else 'application/json'
+                ),
+            },
+        )
+    except OSError as exc:
+        log.error('Unable to forward push for %s to %s: %s', repo_name, peer, exc)
+        return Response(json_dump_msg('Unable to reach cluster node owning repository'), 502)
+    return Response(body, status, {
+        name: value for name, value in headers.items()
+        if name.lower() in ('content-type', 'retry-after')
+    })
+
+
+def verify_hook(hook):
     """
     This will validate the trigger from github by
     checking for the right event type, that the
     repo is on disk, and that the trigger
-    is for the current branch
+    is for the current branch.
+
+    The pushed branch is dispatched to every checkout of the pushed
+    repository (by origin URL) that has it checked out, or failing
+    that to the checkout named like the repository.  These are first
+    looked up from the start of the body, so only the payloads of
+    accepted pushes are decoded in full.  Returns the names and origin
+    URLs of the checkouts with the payload.
     """
     # If we are just getting pinged, return a nice message
-    if request.headers.get('X-Github-Event') == "ping":
+    if hook.event == "ping":
         log.debug('Received ping from github')
         return Response(json_dump_msg('pong')), None
 
     # If we are receiving anything but a push event then we will just
     # cut out early.
-    if request.headers.get('X-Github-Event', '') != "push":
-        log.info('Received ignored event %s',
-                 request.headers.get('X-Github-Event'))
+    if hook.event != "push":
+        log.info('Received ignored event %s', hook.event)
         return Response(json_dump_msg('We do not handle that event')), None
 
     log.debug('Received push event from github')
 
+    # Don't even read bodies announced to be too large
+    limit = Config.MAX_PAYLOAD_BYTES
+    size = hook.content_length or 0
+    data = b'' if limit and size > limit else hook.read_body()
+    size = max(size, len(data))
+    if limit and size > limit:
+        log.warning('Refusing payload of %s bytes', size)
+        return Response(json_dump_msg('Payload too large'), 413), None
+
+    repo_name, ref, url = peek_body(data, hook.form)
+    targets = checkouts.lookup(Config.REPODIR, url, ref) if url and ref else []
+    if not targets and repo_name is not None and ref is not None:
+        rejected = check_push(repo_name, ref)
+        if rejected:
+            metrics.incr('webhooks_rejected_early')
+            return rejected, None
+
     # Gather payload depending on type returned
-    if request.json:
-        payload = request.json
-        log.debug('Received JSON type hook')
+    if hook.form:
+        payload = loads(parse_qs(data.decode('ascii', 'replace'))['payload'][0])
+        log.debug('Received form type hook of %s bytes', len(data))
     else:
-        payload = json.loads(request.form['payload'])
-        log.debug('Received form type hook')
-    log.debug('Received payload: %s', payload)
+        payload = loads(data)
+        log.debug('Received JSON type hook of %s bytes', len(data))
 
     repo_name = payload['repository']['name']
     owner = payload['repository']['owner']
     log.info('Push event from %s repository owned by %s', repo_name, owner)
+    url = payload['repository'].get('html_url')
+    if not targets and url:
+        targets = checkouts.lookup(Config.REPODIR, url, payload['ref'])
+    if targets:
+        return targets, payload
+
+    # Fall back to the checkout named like the repository
+    rejected = check_push(repo_name, payload['ref'])
+    if rejected:
+        return rejected, None
+    repo_url = origin_url(os.path.join(Config.REPODIR, repo_name))
+    if repo_url is None:
+        log.critical('Repository %s has no origin remote', repo_name)
+        return Response(json_dump_msg('Repository not valid'), 500), None
+    return [(repo_name, repo_url)], payload
 
-    # Check that repo is already checked out as that is our method for
-    # validating this repo is good to pull.
-    if not os.path.isdir(Config.REPODIR):
-        log.critical("Repo directory %s doesn't exist", Config.REPODIR)
-        return Response(json_dump_msg('Server configuration issue'), 500), None
 
-    # Get GitPython repo object from disk
-    try:
-        repo = Repo(os.path.join(Config.REPODIR, repo_name))
-    except (InvalidGitRepositoryError, NoSuchPathError, ):
-        log.critical('Repository %s (%s) not in list of available '
-                     'repositories', repo_name, owner)
-        return Response(json_dump_msg('Repository not valid'), 500), None
+def action_kwargs(payload, force=False):
+    """
+    Gather the optional ActionCall arguments carried by a push payload
+    and whether the request asked to force the action.
+    """
+    kwargs = {}
+    if payload.get('after'):
+        kwargs['sha'] = payload['after']
+    head_commit = payload.get('head_commit') or {}
+    if head_commit.get('tree_id'):
+        kwargs['tree_sha'] = head_commit['tree_id']
+    if force:
+        kwargs['force'] = True
+    return kwargs
+
+
+def queue_dependents(repo_names):
+    """
+    Queue a re-import of every repo depending on the pushed repos,
+    once however many of its dependencies were pushed.
+    """
+    names = {name for repo_name in repo_names for name in dependents(repo_name)}
+    for name in sorted(names - set(repo_names)):
+        repo_url = origin_url(os.path.join(Config.REPODIR, name))
+        if repo_url is None:
+            log.warning('Not re-importing %s, it is not checked out', name)
+            continue
+        try:
+            submit(ActionCall(name, repo_url, ActionCall.ACTION_TYPES['COURSE_IMPORT']))
+        except QueueFullError:
+            log.warning('Queue full, not re-importing %s', name)
+        else:
+            metrics.incr('dependent_imports')
+
+
+def receive_hook(action_text, hook):
+    """
+    Verify a webhook and queue ``action_text`` for the pushed repo,
+    returning the response to send.  Shared by the Flask routes and
+    the ASGI receiver.
+    """
+    forwarded = forward_hook(action_text, hook)
+    if forwarded is not None:
+        return forwarded
 
-    log.info('Push event came from repo that has already been cloned, '
-             'running ')
+    targets, payload = verify_hook(hook)
+    if not payload:
+        return targets
 
-    try:
-        local_branch = repo.active_branch.path
-    except TypeError:
-        message = 'Unable to get current branch of checked out repo'
-        log.exception(message)
-        return Response(json_dump_msg(message), 500), None
+    task_name = HOOK_ACTIONS[action_text]
+    log.debug('Local and remote branch match, scheduling %s for %s',
+              task_name, ', '.join(name for name, _ in targets))
 
-    # No sense importing course when the current branch hasn't been updated
-    if not local_branch == payload['ref']:
-        message = "Branch pushed doesn't match local branch, ignoring"
-        log.info(message)
-        return Response(json_dump_msg(message)), None
+    # Go ahead and run the git import script. Use simple thread for now
+    # to prevent timeouts.
+    actions = [
+        ActionCall(
+            repo_name,
+            repo_url,
+            ActionCall.ACTION_TYPES[action_text],
+            **action_kwargs(payload, hook.force)
+        )
+        for repo_name, repo_url in targets
+    ]
+    if len(actions) == 1:
+        response = queue_action(actions[0], task_name)
+    else:
+        response = queue_fanout(actions, task_name)
+    # Dependents are only re-imported once the push itself is queued
+    if getattr(response, 'status_code', 200) != 429:
+        queue_dependents([repo_name for repo_name, _ in targets])
+    return response
 
-    return repo, repo_name
+
+def flask_hook():
+    """
+    The webhook of the current Flask request
+    """
+    return HookRequest(
+        request.headers.get('X-Github-Event', ''),
+        request.content_length,
+        not request.is_json,
+        bool(request.args.get('force')),
+        request.get_data,
+        bool(request.headers.get(cluster.FORWARDED_HEADER)),
+    )
 
 
 @app.route('/', methods=['POST'])
@@ -119,25 +663,7 @@ def hook_receive():
     If that is not available, we would need to at least do some
     sender information like making sure it is a github.com IP.
     """
-
-    return_value, repo_name = verify_hook()
-    if not repo_name:
-        return return_value
-
-    log.debug('Local and remote branch match, scheduling action')
-
-    # Go ahead and run the git import script. Use simple thread for now
-    # to prevent timeouts.
-    action = ActionCall(
-        repo_name,
-        return_value.remotes.origin.url,
-        ActionCall.ACTION_TYPES['COURSE_IMPORT']
-    )
-    queued_jobs.append(action)
-    queue.put(action)
-
-    return json_dump_msg('Added course import task to queue. '
-                         'Queue size was {0}'.format(len(queued_jobs)))
+    return receive_hook('COURSE_IMPORT', flask_hook())
 
 
 @app.route('/update', methods=['POST'])
@@ -146,62 +672,319 @@ def update_repo():
     Just updates the repo to the latest head of it's
     current branch
     """
+    return receive_hook('GET_LATEST', flask_hook())
 
-    return_value, repo_name = verify_hook()
-    if not repo_name:
-        return return_value
 
-    log.debug('Local and remote branch match, doing pull')
+QUEUE_FILTERS = {'repo': 'repo_name', 'action': 'action', 'state': 'state'}
+NDJSON = 'application/x-ndjson'
+
+
+def queue_jobs():
+    """
+    Jobs of the local queue with their state, ``running`` or
+    ``waiting``, yielded one at a time from one copy of the list of
+    queued jobs
+    """
+    backend = get_backend()
+    running = set(backend.queue.running_ids())
+    for item in backend.queued_jobs[:]:
+        yield {
+            'repo_name': item.repo_name,
+            'repo_url': item.repo_url,
+            'action': item.action_text,
+            'state': 'running' if item.job_id in running else 'waiting',
+        }
 
-    # Go ahead and run the git import script. Use simple thread for now
-    # to prevent timeouts.
-    action = ActionCall(
-        repo_name,
-        return_value.remotes.origin.url,
-        ActionCall.ACTION_TYPES['GET_LATEST']
-    )
-    queued_jobs.append(action)
-    queue.put(action)
 
-    return json_dump_msg('Added git update task to queue. '
-                         'Queue size was {0}'.format(len(queued_jobs)))
+def job_matches(job, filters):
+    """
+    Whether ``job`` matches the glob patterns of ``filters`` by
+    ``QUEUE_FILTERS`` name
+    """
+    return all(fnmatch(job[QUEUE_FILTERS[name]], pattern) for name, pattern in filters.items())
+
+
+def queue_counts(filters):
+    """
+    Length of the local queue, and how many of its jobs match
+    ``filters`` in total, by state and by action, without keeping
+    the list of jobs
+    """
+    length = matched = 0
+    counts = {'state': Counter(), 'action': Counter()}
+    for job in queue_jobs():
+        length += 1
+        if job_matches(job, filters):
+            matched += 1
+            for field, counter in counts.items():
+                counter[job[field]] += 1
+    return {'queue_length': length, 'matched': matched, 'counts': counts}
+
+
+def queue_status(local=False, filters=None):
+    """
+    Content of the queue, aggregated over all nodes of the cluster
+    unless ``local`` is set, with only the jobs matching the glob
+    patterns of ``filters`` by ``QUEUE_FILTERS`` name
+    """
+    filters = filters or {}
+    jobs = list(queue_jobs())
+    job_list = [job for job in jobs if job_matches(job, filters)]
+    queue_object = {'queue_length': len(jobs), 'queue': job_list}
+    if local or not cluster.enabled():
+        return queue_object
+
+    nodes = {Config.CLUSTER_SELF: queue_object['queue_length']}
+    for job in job_list:
+        job['node'] = Config.CLUSTER_SELF
+    for peer, peer_queue in cluster.peer_queues(filters).items():
+        # Unreachable nodes are reported with a null length
+        nodes[peer] = peer_queue and peer_queue['queue_length']
+        for job in (peer_queue or {}).get('queue', []):
+            job_list.append(dict(job, node=peer))
+    return {
+        'queue_length': sum(length or 0 for length in nodes.values()),
+        'queue': job_list,
+        'nodes': nodes,
+    }
+
+
+def queue_etag(args):
+    """
+    Entity tag of the local queue as shown for the query ``args``,
+    changing whenever jobs are added, started or finished
+    """
+    backend = get_backend()
+    state = [backend.queue.version(), len(backend.queued_jobs), sorted(args.items())]
+    return hashlib.sha1(json.dumps(state).encode('utf-8')).hexdigest()[:20]
+
+
+def queue_response(args, if_none_match=None):
+    """
+    Response to a request for the queue with the query ``args``:
+
+    - ``repo``, ``action`` and ``state`` filter the jobs by glob pattern
+    - ``offset`` and ``limit`` select a page of the matching jobs
+    - ``counts`` only reports how many jobs match, by state and action
+    - ``format=ndjson`` streams the matching jobs one per line
+    - ``local`` limits the queue to this node in cluster mode
+
+    The response carries an ETag, and polls with a matching
+    ``If-None-Match`` get an empty 304 response.  For the local queue
+    this is checked before any job is looked at.
+    """
+    try:
+        offset = max(int(args.get('offset') or 0), 0)
+        limit = max(int(args.get('limit') or 0), 0)
+    except ValueError:
+        return Response(json_dump_msg('offset and limit must be integers'), 400)
+    local = bool(args.get('local')) or not cluster.enabled()
+    etags = parse_etags(if_none_match)
+    etag = queue_etag(args) if local else None
+    if etag and etag in etags:
+        return Response(status=304, headers={'ETag': '"{0}"'.format(etag)})
+
+    filters = {name: args[name] for name in QUEUE_FILTERS if args.get(name)}
+    stop = offset + limit if limit else None
+    if local and args.get('format') == 'ndjson':
+        # Rows are produced one by one while the response is sent
+        jobs = (job for job in queue_jobs() if job_matches(job, filters))
+        body = (json.dumps(job) + '\n' for job in islice(jobs, offset, stop))
+        mimetype = NDJSON
+    elif local and args.get('counts'):
+        body = json.dumps(queue_counts(filters))
+        mimetype = 'application/json'
+    else:
+        status = queue_status(local, filters)
+        jobs = status.pop('queue')
+        status['matched'] = len(jobs)
+        page = jobs[offset:stop]
+        if args.get('format') == 'ndjson':
+            body = (json.dumps(job) + '\n' for job in page)
+            mimetype = NDJSON
+        else:
+            if args.get('counts'):
+                status['counts'] = {
+                    field: Counter(job[field] for job in jobs) for field in ('state', 'action')
+                }
+            else:
+                status['queue'] = page
+                status['offset'] = offset
+                status['next_offset'] = offset + len(page) if offset + len(page) < len(jobs) else None
+            body = json.dumps(status)
+            mimetype = 'application/json'
+            if etag is None:
+                etag = hashlib.sha1(body.encode('utf-8')).hexdigest()[:20]
+                if etag in etags:
+                    return Response(status=304, headers={'ETag': '"{0}"'.format(etag)})
+    response = Response(body, mimetype=mimetype)
+    if etag:
+        response.set_etag(etag)
+    return response
 
 
 @app.route('/queue', methods=['GET'])
 def get_queue_length():
     """
-    Returns the content of the queue in json
+    Returns the content of the queue in json, see ``queue_response``
+    for the supported query arguments
     """
-    # Format ActionCall to a dictionary for serializing
-    job_list = []
-    for item in queued_jobs:
-        job_list.append({
-            'repo_name': item.repo_name,
-            'repo_url': item.repo_url,
-            'action': item.action_text
-        })
-    queue_object = {'queue_length': len(queued_jobs), 'queue': job_list}
-    return json.dumps(queue_object)
+    return queue_response(request.args.to_dict(), request.headers.get('If-None-Match'))
 
 
-# Application startup configuration
-configure_logging()
-workers = start_workers(Config.NUM_THREADS)  # pylint: disable=C0103
+def liveness_response():
+    """
+    Answer of the liveness probe, the process is up if it answers
+    """
+    return Response(json.dumps({'status': 'ok'}), mimetype='application/json')
+
+
+def readiness_response():
+    """
+    Answer of the readiness probe from the last health checks of this
+    process's backend, or from checks run right away if there is no
+    health monitor, 503 if it isn't started or fit to take jobs.
+    Probes never start the backend, the server hooks or the ASGI
+    lifespan startup do.
+    """
+    backend = _backend
+    if backend is None or backend.pid != os.getpid():
+        status = {'ready': False, 'reason': 'backend not started'}
+    elif backend.health is None:
+        status = check_readiness(backend)
+    else:
+        status = backend.health.readiness()
+    return Response(
+        json.dumps(status), 200 if status['ready'] else 503, mimetype='application/json'
+    )
+
+
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    """
+    Liveness probe
+    """
+    return liveness_response()
+
+
+@app.route('/readyz', methods=['GET'])
+def readyz():
+    """
+    Readiness probe, never touching the filesystem or the job queue
+    """
+    return readiness_response()
+
+
+def admin_authorized():
+    """
+    Check that the request carries the configured admin token as a
+    bearer token.  Admin endpoints are disabled without a token.
+    """
+    if not Config.ADMIN_TOKEN:
+        return False
+    return hmac.compare_digest(
+        request.headers.get('Authorization', ''),
+        'Bearer {0}'.format(Config.ADMIN_TOKEN)
+    )
+
+
+@app.route('/refresh', methods=['POST'])
+def refresh_all():
+    """
+    Queue an action (``GET_LATEST`` by default) for every checkout in
+    REPODIR whose name matches the optional glob ``pattern``.  The
+    jobs are queued as one batch in the bulk lane, so they run with
+    limited concurrency and at low priority.  Checkouts without an
+    ``origin`` remote are skipped and listed in the response.
+    """
+    if not admin_authorized():
+        return Response(json_dump_msg('Not authorized'), 403)
+    params = request.get_json(silent=True) or request.form
+    action_text = params.get('action', 'GET_LATEST')
+    if action_text not in ActionCall.ACTION_TYPES:
+        return Response(json_dump_msg('Unknown action'), 400)
+    pattern = params.get('pattern', '*')
+
+    batch_id = uuid.uuid4().hex
+    repo_names = [
+        name for name in list_checkouts(Config.REPODIR) if fnmatch(name, pattern)
+    ]
+    skipped = []
+    for repo_name in repo_names:
+        repo_url = origin_url(os.path.join(Config.REPODIR, repo_name))
+        if repo_url is None:
+            log.warning('Not refreshing %s, it has no origin remote', repo_name)
+            skipped.append(repo_name)
+            continue
+        submit(ActionCall(
+            repo_name,
+            repo_url,
+            ActionCall.ACTION_TYPES[action_text],
+            lane=ActionCall.LANES['BULK'],
+            priority=ActionCall.PRIORITIES['LOW'],
+            batch=batch_id,
+        ))
+    log.info('Queued %s of %s repos as batch %s',
+             action_text, len(repo_names) - len(skipped), batch_id)
+    return json.dumps(dict(batch_status(batch_id), skipped=skipped))
+
+
+def batch_status(batch_id):
+    """
+    Progress of a refresh batch for the admin endpoints
+    """
+    progress = get_backend().queue.batch_progress(batch_id) or {'total': 0, 'done': 0, 'pending': 0}
+    return dict(progress, batch_id=batch_id)
+
+
+@app.route('/refresh/<batch_id>', methods=['GET'])
+def refresh_progress(batch_id):
+    """
+    Returns the progress of a refresh batch in json
+    """
+    if not admin_authorized():
+        return Response(json_dump_msg('Not authorized'), 403)
+    if get_backend().queue.batch_progress(batch_id) is None:
+        return Response(json_dump_msg('No such batch'), 404)
+    return json.dumps(batch_status(batch_id))
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """
+    Returns the counters reported by the workers and this process in
+    json
+    """
+    job_queue = get_backend().queue
+    job_queue.add_metrics(metrics.drain())
+    return json.dumps(job_queue.metrics(), sort_keys=True)
+
+
+def create_app():
+    """
+    Application factory, e.g. for ``gunicorn 'gitreload.web:create_app()'``.
+    The backend is started by the first request that needs it, or
+    after forking by ``gitreload.gunicorn_hooks``.
+    """
+    configure_logging()
+    return app
 
 
 # Manual startup overrides (e.g. command line or direct run).
-def run_web(host='0.0.0.0', port=5000, log_level=None):
+def run_web(host='0.0.0.0', port=None, log_level=None):
     """
-    Stub method for running the built in flask application runner
+    Stub method for running the built in flask application runner,
+    listening on ``PORT`` unless given another ``port``
     """
     # Setup configuration
     configure_logging(log_level)
+    get_backend()
     if app.debug:
         log.critical('Running in debug mode. '
                      'Do not run this way in production')
 
     log.info('Starting up self running flask application')
-    app.run(host=host, port=port)
+    app.run(host=host, port=port or Config.PORT)
 
 
 if __name__ == '__main__':
@@ -39,9 +39,12 @@ setup(
     include_package_data=True,
     entry_points={'console_scripts': [
         'gitreload = gitreload.web:run_web',
+        'gitreload-admin = gitreload.admin:main',
     ]},
     zip_safe=True,
+    python_requires='>=3.7',
     install_requires=install_requires,
+    extras_require={'fast': ['orjson==3.*,>=3.4.0']},
     data_files=[],
     classifiers=[
         'Development Status :: 3 - Alpha',
@@ -53,7 +56,7 @@ setup(
         'Operating System :: OS Independent',
         'Programming Language :: Python',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.6',
+        'Programming Language :: Python :: 3.7',
         'Topic :: Education',
     ],
 )